@@ -0,0 +1,292 @@
+#!/usr/bin/python3
+"""
+Compares part_b_resolver.py result CSVs across hosts and resolvers.
+
+    python3 analyze.py h*_default_results.csv h*_dns_results.csv [--baseline default]
+                       [--bootstrap 2000] [--seed 1] [--ips] [--out summary.csv] [--cdf cdf.csv]
+
+The host and the resolver come from the file name: h1_dns_results.csv is host
+h1, resolver 'dns'. Every group (host x resolver, plus 'all' hosts per
+resolver) gets its success rate, mean and p50/p90/p95/p99 latency of the
+successful lookups (nearest rank, like part_b_resolver.percentile), the
+wall-clock throughput like multihost.py, and 95% bootstrap confidence
+intervals for the success rate and p50. Each host is then compared with the
+baseline resolver on the same host: success-rate and p50 deltas with their CIs.
+
+Everything is vectorized: the CSVs are read by pandas without the 'ips' column
+(only --ips reads it, in a second pass), the latencies of all groups are sorted
+once, and percentiles and CDFs are read off the sorted blocks by index. The
+bootstrap resamples a histogram of 1%-wide latency bins (multinomial counts)
+and the success count (binomial), so a replicate costs the number of bins, not
+the number of rows.
+"""
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+PERCENTILES = [50, 90, 95, 99]
+# the CDF is written as the latency at every whole percentile
+CDF_PERCENTILES = np.arange(0, 101)
+BOOTSTRAP_SAMPLES = 2000
+CONFIDENCE = 95
+# bootstrap histogram: 1%-wide bins from 1 us to 1000 s, plus one for anything outside
+HIST_EDGES = np.concatenate(([0.0], np.geomspace(1e-3, 1e6, int(np.log(1e9) / np.log(1.01)) + 1), [np.inf]))
+
+
+def labels_for(path):
+    """h1_dns_results.csv -> ('h1', 'dns')."""
+    parts = os.path.splitext(os.path.basename(path))[0].split('_')
+    resolver = '_'.join(p for p in parts[1:] if p != 'results')
+    return parts[0], resolver or 'results'
+
+
+def load_results(paths):
+    """
+    One frame with success, rtt_ms, end_time, host and resolver for every row
+    of every CSV. CSVs from before end_time was written get NaN there.
+    """
+    frames = []
+    for path in paths:
+        columns = pd.read_csv(path, nrows=0).columns
+        usecols = [c for c in ('success', 'rtt_ms', 'end_time') if c in columns]
+        frame = pd.read_csv(path, usecols=usecols, na_filter=False,
+                            dtype={'success': np.int8, 'rtt_ms': np.float64, 'end_time': np.float64})
+        if 'end_time' not in frame:
+            frame['end_time'] = np.nan
+        host, resolver = labels_for(path)
+        frames.append(frame.assign(host=host, resolver=resolver))
+    results = pd.concat(frames, ignore_index=True)
+    results['host'] = results['host'].astype('category')
+    results['resolver'] = results['resolver'].astype('category')
+    return results
+
+
+def load_ips(paths):
+    """The 'ips' column of every CSV, in load_results() order; only read for --ips."""
+    return pd.concat([pd.read_csv(path, usecols=['ips'], dtype={'ips': str}, keep_default_na=False)['ips']
+                      for path in paths], ignore_index=True)
+
+
+def sorted_blocks(codes, groups, values, by_value):
+    """
+    'values' sorted within each group code: (sorted values, block starts, block
+    sizes). 'by_value' is the argsort of 'values', shared by every grouping; a
+    stable (radix) sort of the codes in that order keeps each block sorted.
+    """
+    order = by_value[np.argsort(codes[by_value], kind='stable')]
+    sizes = np.bincount(codes, minlength=groups)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    return values[order], starts, sizes
+
+
+def nearest_rank(values, starts, sizes, pcts):
+    """Percentiles of every block, one row per group (NaN for empty groups)."""
+    pcts = np.asarray(pcts, dtype=np.float64)
+    ranks = np.maximum(np.round(np.outer(sizes, pcts / 100.0)).astype(np.int64), 1)
+    index = starts[:, None] + np.minimum(ranks, np.maximum(sizes, 1)[:, None]) - 1
+    if not len(values):
+        return np.full(index.shape, np.nan)
+    return np.where(sizes[:, None] > 0, values[np.minimum(index, len(values) - 1)], np.nan)
+
+
+def bootstrap(block, successes, total, samples, rng):
+    """
+    (p50 replicates, success-rate replicates) of one group. The median of a
+    replicate falls in one 1% bin; its value is the order statistic of the
+    original block at the same relative position within that bin.
+    """
+    success_reps = rng.binomial(total, successes / total, size=samples) / total if total else np.full(samples, np.nan)
+    n = len(block)
+    if not n:
+        return np.full(samples, np.nan), success_reps
+    bounds = np.searchsorted(block, HIST_EDGES)
+    counts = np.diff(bounds)
+    used = counts > 0
+    counts, firsts = counts[used], bounds[:-1][used]
+    draws = rng.multinomial(n, counts / n, size=samples)
+    rank = max(1, int(round(0.5 * n)))
+    below = np.cumsum(draws, axis=1)
+    bins = np.argmax(below >= rank, axis=1)
+    replicate = np.arange(samples)
+    drawn = draws[replicate, bins]
+    position = (rank - (below[replicate, bins] - drawn) - 0.5) / drawn
+    p50_reps = block[firsts[bins] + (position * counts[bins]).astype(np.int64)]
+    return p50_reps, success_reps
+
+
+def interval(replicates):
+    low = (100 - CONFIDENCE) / 2
+    return tuple(np.nanpercentile(replicates, [low, 100 - low])) if np.isfinite(replicates).any() else (np.nan, np.nan)
+
+
+def analyze(results, samples=BOOTSTRAP_SAMPLES, seed=None):
+    """
+    Summary rows for every (host, resolver) group and every resolver over all
+    hosts, plus the CDF table. Returns (summary frame, cdf frame, replicates).
+    """
+    rng = np.random.default_rng(seed)
+    success = results['success'].to_numpy() == 1
+    rtt = results['rtt_ms'].to_numpy()
+    end = results['end_time'].to_numpy()
+    hosts = results['host'].cat.categories
+    resolvers = results['resolver'].cat.categories
+    host_codes = results['host'].cat.codes.to_numpy().astype(np.int64)
+    resolver_codes = results['resolver'].cat.codes.to_numpy().astype(np.int64)
+    # per-host groups first, then one 'all' group per resolver when there is more than one host
+    levels = [(host_codes * len(resolvers) + resolver_codes, [(h, r) for h in hosts for r in resolvers])]
+    if len(hosts) > 1:
+        levels.append((resolver_codes, [('all', r) for r in resolvers]))
+
+    by_value = np.argsort(rtt[success], kind='stable')
+    rows, cdf_rows, replicates = [], [], {}
+    for codes, names in levels:
+        groups = len(names)
+        totals = np.bincount(codes, minlength=groups)
+        ok = np.bincount(codes, weights=success, minlength=groups)
+        values, starts, sizes = sorted_blocks(codes[success], groups, rtt[success], by_value)
+        sums = np.bincount(codes[success], weights=rtt[success], minlength=groups)
+        pcts = nearest_rank(values, starts, sizes, PERCENTILES)
+        cdf = nearest_rank(values, starts, sizes, CDF_PERCENTILES)
+        # wall-clock span from end_time where every row has it, else the sum of the lookup times
+        frame = pd.DataFrame({'code': codes, 'start': end - rtt / 1000.0, 'end': end, 'rtt': rtt})
+        spans = frame.groupby('code').agg(start=('start', 'min'), end=('end', 'max'), rtt=('rtt', 'sum'),
+                                          missing=('end', lambda e: e.isna().any()))
+        spans = spans.reindex(range(groups))
+        span = np.where(spans['missing'].fillna(True), spans['rtt'] / 1000.0, spans['end'] - spans['start'])
+        for g, (host, resolver) in enumerate(names):
+            if not totals[g]:
+                continue
+            block = values[starts[g]:starts[g] + sizes[g]]
+            p50_reps, success_reps = bootstrap(block, ok[g], totals[g], samples, rng)
+            replicates[(host, resolver)] = (p50_reps, success_reps)
+            row = {'host': host, 'resolver': resolver, 'queries': int(totals[g]), 'successes': int(ok[g]),
+                   'success_pct': 100.0 * ok[g] / totals[g]}
+            row['success_ci_low'], row['success_ci_high'] = (100.0 * v for v in interval(success_reps))
+            row['span_s'] = span[g]
+            row['throughput_qps'] = ok[g] / span[g] if span[g] > 0 else 0.0
+            row['avg_ms'] = sums[g] / sizes[g] if sizes[g] else np.nan
+            for pct, value in zip(PERCENTILES, pcts[g]):
+                row[f'p{pct}_ms'] = value
+            row['p50_ci_low'], row['p50_ci_high'] = interval(p50_reps)
+            rows.append(row)
+            cdf_rows.append(pd.DataFrame({'host': host, 'resolver': resolver, 'percentile': CDF_PERCENTILES,
+                                          'rtt_ms': cdf[g]}))
+    cdf_table = pd.concat(cdf_rows, ignore_index=True) if cdf_rows else pd.DataFrame()
+    return pd.DataFrame(rows), cdf_table, replicates
+
+
+def compare(summary, replicates, baseline):
+    """Success-rate (percentage points) and p50 deltas of every resolver against 'baseline' on the same host."""
+    rows = []
+    base = summary[summary['resolver'] == baseline].set_index('host')
+    for _, row in summary[summary['resolver'] != baseline].iterrows():
+        if row['host'] not in base.index:
+            continue
+        other = base.loc[row['host']]
+        p50_reps, success_reps = replicates[(row['host'], row['resolver'])]
+        base_p50, base_success = replicates[(row['host'], baseline)]
+        delta = {'host': row['host'], 'resolver': row['resolver'], 'baseline': baseline,
+                 'success_delta_pp': row['success_pct'] - other['success_pct'],
+                 'p50_delta_ms': row['p50_ms'] - other['p50_ms']}
+        delta['success_ci_low'], delta['success_ci_high'] = (100.0 * v for v in interval(success_reps - base_success))
+        delta['p50_ci_low'], delta['p50_ci_high'] = interval(p50_reps - base_p50)
+        rows.append(delta)
+    return pd.DataFrame(rows)
+
+
+def ip_summary(results, ips):
+    """
+    Addresses per successful answer and distinct addresses seen, per (host,
+    resolver). Answers repeat a lot, so each distinct answer string is split once.
+    """
+    answered = ips.to_numpy() != ''
+    frame = pd.DataFrame({'host': results['host'][answered], 'resolver': results['resolver'][answered],
+                          'ips': ips[answered]})
+    answers = frame.value_counts(['host', 'resolver', 'ips'], sort=False).rename('count').reset_index()
+    # categorical columns also list the combinations never seen
+    answers = answers[answers['count'] > 0]
+    answers['addresses'] = answers['ips'].str.count(';') + 1
+    answers['weighted'] = answers['addresses'] * answers['count']
+    groups = answers.groupby(['host', 'resolver'], observed=True)
+    per_answer = groups['weighted'].sum() / groups['count'].sum()
+    distinct = (answers.assign(ips=answers['ips'].str.split(';')).explode('ips')
+                .groupby(['host', 'resolver'], observed=True)['ips'].nunique())
+    return pd.DataFrame({'addresses_per_answer': per_answer, 'distinct_addresses': distinct}).reset_index()
+
+
+def print_summary(summary):
+    print("\n--- DNS Results by Host and Resolver ---")
+    print(f"{'host':>6}{'resolver':>10}{'queries':>9}{'ok %':>7}{'95% CI':>14}{'qps':>9}{'avg ms':>9}"
+          f"{'p50 ms':>9}{'95% CI':>18}{'p90 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for r in summary.itertuples():
+        print(f"{r.host:>6}{r.resolver:>10}{r.queries:>9}{r.success_pct:>7.1f}"
+              f"{f'[{r.success_ci_low:.1f}, {r.success_ci_high:.1f}]':>14}{r.throughput_qps:>9.2f}{r.avg_ms:>9.2f}"
+              f"{r.p50_ms:>9.2f}{f'[{r.p50_ci_low:.2f}, {r.p50_ci_high:.2f}]':>18}"
+              f"{r.p90_ms:>9.2f}{r.p95_ms:>9.2f}{r.p99_ms:>9.2f}")
+
+
+def print_deltas(deltas):
+    if deltas.empty:
+        return
+    print(f"\n--- Against the '{deltas['baseline'].iloc[0]}' Resolver on the Same Host ---")
+    print(f"{'host':>6}{'resolver':>10}{'success pp':>12}{'95% CI':>16}{'p50 ms':>10}{'95% CI':>20}")
+    for r in deltas.itertuples():
+        print(f"{r.host:>6}{r.resolver:>10}{r.success_delta_pp:>+12.1f}"
+              f"{f'[{r.success_ci_low:+.1f}, {r.success_ci_high:+.1f}]':>16}{r.p50_delta_ms:>+10.2f}"
+              f"{f'[{r.p50_ci_low:+.2f}, {r.p50_ci_high:+.2f}]':>20}")
+
+
+def print_ips(table):
+    print("\n--- Answers ---")
+    print(f"{'host':>6}{'resolver':>10}{'addrs/answer':>14}{'distinct addrs':>16}")
+    for r in table.itertuples():
+        print(f"{r.host:>6}{r.resolver:>10}{r.addresses_per_answer:>14.2f}{r.distinct_addresses:>16}")
+
+
+if __name__ == '__main__':
+    flags_with_values = ('--out', '--cdf', '--baseline', '--bootstrap', '--seed')
+    paths = [a for i, a in enumerate(sys.argv[1:], 1) if a.endswith('.csv') and sys.argv[i - 1] not in flags_with_values]
+    resolvers = sorted({labels_for(path)[1] for path in paths})
+    baseline = 'default' if 'default' in resolvers else (resolvers[0] if resolvers else None)
+    if '--baseline' in sys.argv:
+        baseline = sys.argv[sys.argv.index('--baseline') + 1]
+    if not paths or baseline not in resolvers:
+        print("Usage: analyze.py h1_dns_results.csv [h1_default_results.csv ...] [--baseline default] "
+              "[--bootstrap 2000] [--seed 1] [--ips] [--out summary.csv] [--cdf cdf.csv]")
+        if paths:
+            print(f"--baseline must be one of the loaded resolvers: {', '.join(resolvers)}")
+        sys.exit(1)
+    samples = BOOTSTRAP_SAMPLES
+    seed = None
+    if '--bootstrap' in sys.argv:
+        samples = int(sys.argv[sys.argv.index('--bootstrap') + 1])
+    if '--seed' in sys.argv:
+        seed = int(sys.argv[sys.argv.index('--seed') + 1])
+
+    started = time.perf_counter()
+    results = load_results(paths)
+    loaded = time.perf_counter()
+    print(f"[Loaded] {len(paths)} files, {len(results)} rows in {loaded - started:.2f} s")
+    summary, cdf, replicates = analyze(results, samples, seed)
+    deltas = compare(summary, replicates, baseline)
+    print(f"[Analyzed] {len(summary)} groups, {samples} bootstrap samples each, in {time.perf_counter() - loaded:.2f} s")
+    print_summary(summary)
+    print_deltas(deltas)
+    if '--ips' in sys.argv:
+        print_ips(ip_summary(results, load_ips(paths)))
+    if '--out' in sys.argv:
+        out_path = sys.argv[sys.argv.index('--out') + 1]
+        table = summary
+        # with a single resolver there is nothing to compare against
+        if not deltas.empty:
+            table = summary.merge(deltas.drop(columns='baseline').rename(
+                columns=lambda c: c if c in ('host', 'resolver') else f'vs_{baseline}_{c}'),
+                on=['host', 'resolver'], how='left')
+        table.to_csv(out_path, index=False, float_format='%.3f')
+        print(f"Summary saved to '{out_path}'")
+    if '--cdf' in sys.argv:
+        cdf_path = sys.argv[sys.argv.index('--cdf') + 1]
+        cdf.to_csv(cdf_path, index=False, float_format='%.3f')
+        print(f"CDF saved to '{cdf_path}'")
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Runs part_b_resolver.py on several Mininet hosts at once and merges their CSVs.
+
+Every job is started with popen on its own host and waits at a file barrier
+(part_b_resolver.py --barrier); when all of them are ready the barrier is
+opened, so the hosts load the resolver concurrently instead of one after the
+other. The report gives throughput and latency percentiles per host and for
+all hosts combined. On its own it merges existing CSVs:
+
+    python3 multihost.py h1_dns_results.csv h2_dns_results.csv ... [--out aggregate.csv]
+"""
+import csv
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from part_b_resolver import percentile
+
+# how long the hosts get to start python and read their lists
+BARRIER_TIMEOUT = 30.0
+RESOLVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'part_b_resolver.py')
+
+def run_parallel(net, jobs, extra_args=()):
+    """
+    jobs is [(host name, domain list, output csv), ...]. Returns [(host name,
+    output csv), ...] of the jobs that finished, empty if the start failed.
+    """
+    barrier_dir = tempfile.mkdtemp(prefix='dns_barrier_')
+    procs = []
+    try:
+        for host_name, domains, out in jobs:
+            cmd = ['python3', RESOLVER_SCRIPT, os.path.abspath(domains), os.path.abspath(out),
+                   '--barrier', barrier_dir] + list(extra_args)
+            proc = net.get(host_name).popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            procs.append((host_name, out, proc))
+        deadline = time.time() + BARRIER_TIMEOUT
+        while sum(1 for f in os.listdir(barrier_dir) if f.startswith('ready.')) < len(procs):
+            if time.time() > deadline or any(proc.poll() is not None for _, _, proc in procs):
+                print("[Error] Not every host reached the start barrier, aborting.")
+                for _, _, proc in procs:
+                    proc.kill()
+                return []
+            time.sleep(0.01)
+        open(os.path.join(barrier_dir, 'go'), 'w').close()
+        print(f"--- {len(procs)} hosts started at the barrier: {', '.join(h for h, _, _ in procs)} ---")
+        finished = []
+        for host_name, out, proc in procs:
+            output = proc.communicate()[0].decode(errors='replace')
+            print(f"--- {host_name} ---\n{output}")
+            if proc.returncode == 0:
+                finished.append((host_name, out))
+            else:
+                print(f"[Error] {host_name} exited with code {proc.returncode}")
+        return finished
+    finally:
+        shutil.rmtree(barrier_dir, ignore_errors=True)
+
+def read_rows(path):
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+def summarize(name, rows):
+    """Throughput over the wall-clock span of the rows and latency percentiles of the successful ones."""
+    latencies = sorted(float(r['rtt_ms']) for r in rows if r['success'] == '1')
+    if rows and all(r.get('end_time') for r in rows):
+        ends = [float(r['end_time']) for r in rows]
+        starts = [float(r['end_time']) - float(r['rtt_ms']) / 1000.0 for r in rows]
+        span = max(ends) - min(starts)
+    else:
+        # CSVs from before end_time was written: the lookups ran one after another
+        span = sum(float(r['rtt_ms']) for r in rows) / 1000.0
+    return {
+        'host': name,
+        'queries': len(rows),
+        'successes': len(latencies),
+        'failures': len(rows) - len(latencies),
+        'span_s': span,
+        'throughput_qps': len(latencies) / span if span > 0 else 0.0,
+        'avg_ms': sum(latencies) / len(latencies) if latencies else 0.0,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+    }
+
+def merge_results(results):
+    """results is [(host name, csv path), ...]; one summary per host plus 'all'."""
+    report = []
+    combined = []
+    for name, path in results:
+        rows = read_rows(path)
+        combined += rows
+        report.append(summarize(name, rows))
+    if len(results) > 1:
+        report.append(summarize('all', combined))
+    return report
+
+def print_report(report):
+    print("\n--- Multi-Host DNS Benchmark ---")
+    print(f"{'host':>6}{'queries':>9}{'ok':>6}{'failed':>8}{'span s':>9}{'qps':>9}{'avg ms':>9}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for r in report:
+        print(f"{r['host']:>6}{r['queries']:>9}{r['successes']:>6}{r['failures']:>8}{r['span_s']:>9.2f}"
+              f"{r['throughput_qps']:>9.2f}{r['avg_ms']:>9.2f}{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}{r['p99_ms']:>9.2f}")
+
+def write_report(report, path):
+    columns = ['host', 'queries', 'successes', 'failures', 'span_s', 'throughput_qps',
+               'avg_ms', 'p50_ms', 'p95_ms', 'p99_ms']
+    with open(path, 'w', newline='') as out:
+        w = csv.DictWriter(out, fieldnames=columns)
+        w.writeheader()
+        for r in report:
+            w.writerow({k: f"{v:.3f}" if isinstance(v, float) else v for k, v in r.items()})
+
+if __name__ == '__main__':
+    paths = [a for i, a in enumerate(sys.argv[1:], 1) if a.endswith('.csv') and sys.argv[i - 1] != '--out']
+    if not paths:
+        print("Usage: multihost.py h1_results.csv [h2_results.csv ...] [--out aggregate.csv]")
+        sys.exit(1)
+    # h1_dns_results.csv -> h1
+    merged = merge_results([(os.path.basename(p).split('_')[0], p) for p in paths])
+    print_report(merged)
+    if '--out' in sys.argv:
+        out_path = sys.argv[sys.argv.index('--out') + 1]
+        write_report(merged, out_path)
+        print(f"Report saved to '{out_path}'")
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
-import sys, socket, time, csv
+import sys, os, socket, time, csv
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 def resolve(domain):
     start = time.perf_counter()
@@ -14,56 +15,103 @@ def resolve(domain):
         elapsed = (time.perf_counter() - start) * 1000.0 # Convert to ms
         return False, elapsed, []
 
+def percentile(sorted_values, pct):
+    # nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+# how often a process waiting at the start barrier looks for the go file
+BARRIER_POLL = 0.001
+
+def wait_at_barrier(barrier_dir, name):
+    # tells the orchestrator this job is ready, then blocks until it creates 'go',
+    # so jobs on several hosts start measuring at the same moment
+    open(os.path.join(barrier_dir, f"ready.{name}"), 'w').close()
+    go = os.path.join(barrier_dir, 'go')
+    while not os.path.exists(go):
+        time.sleep(BARRIER_POLL)
+
+def read_domains(infile):
+    with open(infile) as inf:
+        return [line.strip() for line in inf if line.strip()]
+
 if __name__ == '__main__':
     if len(sys.argv) < 3:
-        print("Usage: part_b_resolver.py domain_list.txt out.csv [--pause 0.01]")
+        print("Usage: part_b_resolver.py domain_list.txt out.csv [--pause 0.01] [--concurrency 8] [--barrier dir]")
         sys.exit(1)
         
     infile = sys.argv[1]
     outfile = sys.argv[2]
     pause = 0.0
+    concurrency = 1
+    barrier_dir = None
     
     if '--pause' in sys.argv:
         pause = float(sys.argv[sys.argv.index('--pause')+1])
+    if '--concurrency' in sys.argv:
+        concurrency = int(sys.argv[sys.argv.index('--concurrency')+1])
+    if '--barrier' in sys.argv:
+        barrier_dir = sys.argv[sys.argv.index('--barrier')+1]
 
-    print(f"Starting DNS resolution for domains in '{infile}'...")
+    print(f"Starting DNS resolution for domains in '{infile}' (concurrency {concurrency})...")
+    domains = read_domains(infile)
     
-    with open(infile) as inf, open(outfile, 'w', newline='') as outf:
+    with open(outfile, 'w', newline='') as outf:
         w = csv.writer(outf)
-        w.writerow(['timestamp','domain','success','rtt_ms','ips'])
+        # completion_order is the order rows finished in, which differs from the
+        # input order once several lookups run at the same time; end_time is the
+        # epoch time the lookup finished, comparable across hosts of one machine
+        w.writerow(['timestamp','domain','success','rtt_ms','ips','completion_order','end_time'])
         
         count = 0
         successes = 0
         total_latency_ms = 0.0
+        latencies = []
+        if barrier_dir:
+            wait_at_barrier(barrier_dir, os.path.basename(outfile))
         t0 = time.perf_counter()
 
-        for line in inf:
-            dom = line.strip()
-            if not dom:
-                continue
-            
-            ok, rtt, ips = resolve(dom)
-            w.writerow([time.strftime("%Y-%m-%dT%H:%M:%S"), dom, int(ok), f"{rtt:.3f}", ";".join(ips)])
-            
+        def record(dom, ok, rtt, ips):
+            global count, successes, total_latency_ms
+            w.writerow([time.strftime("%Y-%m-%dT%H:%M:%S"), dom, int(ok), f"{rtt:.3f}", ";".join(ips), count,
+                        f"{time.time():.6f}"])
+            outf.flush()
             if ok:
                 successes += 1
                 total_latency_ms += rtt
-                
+                latencies.append(rtt)
             count += 1
-            if pause:
-                time.sleep(pause)
+
+        if concurrency <= 1:
+            for dom in domains:
+                ok, rtt, ips = resolve(dom)
+                record(dom, ok, rtt, ips)
+                if pause:
+                    time.sleep(pause)
+        else:
+            # getaddrinfo blocks in the C resolver, threads let N lookups wait at
+            # once; rows are written from this thread as each lookup completes
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                futures = {pool.submit(resolve, dom): dom for dom in domains}
+                for fut in as_completed(futures):
+                    ok, rtt, ips = fut.result()
+                    record(futures[fut], ok, rtt, ips)
                 
         t_total_s = time.perf_counter() - t0
     
     failed_resolutions = count - successes
     # Only calculate average latency for successful queries
     avg_latency_ms = total_latency_ms / successes if successes > 0 else 0.0
-    # Throughput is successful queries per second
+    # Throughput is successful queries per second of wall-clock time
     avg_throughput_qps = successes / t_total_s if t_total_s > 0 else 0.0
+    latencies.sort()
 
     print(f"Total Queries:            {count}")
     print(f"Successful Resolutions:   {successes}")
     print(f"Failed Resolutions:       {failed_resolutions}")
     print(f"Total Time Taken:         {t_total_s:.2f} seconds")
     print(f"Average Lookup Latency:   {avg_latency_ms:.2f} ms")
+    print(f"Latency p50/p95/p99:      {percentile(latencies, 50):.2f} / {percentile(latencies, 95):.2f} / {percentile(latencies, 99):.2f} ms")
     print(f"Average Throughput:       {avg_throughput_qps:.2f} queries/sec")
@@ -1,4 +1,6 @@
 #!/usr/bin/env python3
+import sys
+import multihost
 from mininet.net import Mininet, NAT
 from mininet.node import Controller, OVSSwitch
 from mininet.link import TCLink
@@ -41,7 +43,17 @@ class AssignmentTopo(Topo):
         # Connect the NAT node to the central switch
         self.addLink(s2, nat)
 
-def run():
+def run_parallel_benchmark(net, extra_args=()):
+    # every host resolves its own list, all four at the same time
+    jobs = [(h, f'domains_{h}_unique.txt', f'{h}_default_results.csv') for h in ['h1', 'h2', 'h3', 'h4']]
+    finished = multihost.run_parallel(net, jobs, extra_args)
+    if finished:
+        report = multihost.merge_results(finished)
+        multihost.print_report(report)
+        multihost.write_report(report, 'aggregate_default_results.csv')
+        print("Aggregate report saved to 'aggregate_default_results.csv'")
+
+def run(parallel=False, extra_args=()):
     topo = AssignmentTopo()
     net = Mininet(topo=topo, controller=Controller, link=TCLink, switch=OVSSwitch, autoSetMacs=True)
     net.start()
@@ -58,6 +70,14 @@ def run():
         
     print("\nNetwork started with internet connectivity.\n")
 
+    if parallel:
+        print("--- Starting Part B: DNS resolution on h1-h4 in parallel... ---")
+        run_parallel_benchmark(net, extra_args)
+        print("\nStarting Mininet CLI...\n")
+        CLI(net)
+        net.stop()
+        return
+
     # --- Automatically Run Part B DNS Resolution Script ---
     print("--- Starting Part B: DNS resolution test on h1... ---")
     h1 = net.get('h1')
@@ -90,6 +110,11 @@ def run():
     net.stop()
 
 if __name__ == '__main__':
-    run()
+    # --parallel runs the four host workloads concurrently on h1-h4 (with an
+    # optional --concurrency N passed on to part_b_resolver.py)
+    extra = []
+    if '--concurrency' in sys.argv:
+        extra = ['--concurrency', sys.argv[sys.argv.index('--concurrency') + 1]]
+    run(parallel='--parallel' in sys.argv, extra_args=extra)
 
 
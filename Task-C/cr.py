@@ -1,13 +1,29 @@
 #!/usr/bin/python3
 
+import asyncio
+import os
 import socket
 import socketserver
+import sys
 import time
 import datetime
 
-# Chosen upstream DNS to relay queries
-UPSTREAM_DNS_SERVER = "8.8.8.8"
+# the wire format, the async engine and the upstream selection are shared with Task-D
+TASK_D_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Task-D')
+sys.path.append(TASK_D_DIR)
+import async_engine
+import dnswire
+from upstream_pool import UpstreamSocketPool
+from upstreams import UpstreamSelector, format_upstream_stats, hedged_query, hedged_query_async
+
+# Chosen upstream DNS servers to relay queries (--upstreams a,b,c). Each query goes to the
+# fastest healthy one and is hedged to the runner-up after that server's p95 (Task-D/upstreams.py)
+UPSTREAM_DNS_SERVERS = ["8.8.8.8", "1.1.1.1", "9.9.9.9"]
 UPSTREAM_DNS_PORT = 53
+UPSTREAM_TIMEOUT = 2.0
+UPSTREAM_SELECTOR = None
+# sync engine: one socket pool per upstream server
+UPSTREAM_POOLS = {}
 
 DNS_CACHE = {}
 
@@ -18,27 +34,12 @@ class ForwardingDNSHandler(socketserver.BaseRequestHandler):
     processes incoming DNS requests.
     server provides proxy-like or forwarding capability for DNS.
     """
-    def extract_domain_name(self, packet):
-        """extarcts packets"""
+    @staticmethod
+    def extract_domain_name(packet):
+        """extarcts the queried domain (label walk, handles compression)"""
         try:
-            # DNS header is 12 bytes long
-            # The query name starts after the header
-            header = packet[:12]
-            question = packet[12:]
-            # Find the end of the QNAME field
-            qname_termination = question.find(b'\x00')
-            raw_qname = question[:qname_termination]
-            # Convert DNS QNAME to dot-separated domain
-            domain_parts = []
-            idx = 0
-            while idx < len(raw_qname):
-                seg_len = raw_qname[idx]
-                idx += 1
-                domain_parts.append(raw_qname[idx: idx + seg_len].decode('utf-8'))
-                idx += seg_len
-            domain_name = ".".join(domain_parts)
-            return domain_name
-        except Exception as err:
+            return dnswire.read_name(packet, 12)[0]
+        except (dnswire.WireError, IndexError) as err:
             print(f"[Forwarder] Failed to parse domain: {err}")
             return None
 
@@ -60,17 +61,13 @@ class ForwardingDNSHandler(socketserver.BaseRequestHandler):
         if cache_state != "HIT":
             print("i. Cache State: NOT_FOUND")
         #print("c. Resolution Strategy: Forward (Non-recursive)")
-        # forward the query to the real DNS server
-        relay_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        relay_socket.settimeout(2.0)
-
+        # forward the query to the real DNS servers
         try:
             send_time = time.time()
-            relay_socket.sendto(payload, (UPSTREAM_DNS_SERVER, UPSTREAM_DNS_PORT))
-            print(f"d. Upstream DNS Contacted: {UPSTREAM_DNS_SERVER}")
-            print("e. Action: Relayed Upstream")
-            response, _ = relay_socket.recvfrom(512)
+            response, server = hedged_query(UPSTREAM_SELECTOR, UPSTREAM_POOLS, payload, UPSTREAM_TIMEOUT)
             recv_time = time.time()
+            print(f"d. Upstream DNS Contacted: {server}")
+            print("e. Action: Relayed Upstream")
             latency = (recv_time - send_time) * 1000
             print(f"f. Upstream Response: Received")
             print(f"g. Upstream RTT: {latency:.2f} ms")
@@ -81,15 +78,77 @@ class ForwardingDNSHandler(socketserver.BaseRequestHandler):
         except Exception as err:
             print(f"[Forwarder] Error during forwarding: {err}")
         finally:
-            relay_socket.close()
             print("------------------------\n")
 
+async def handle_async(payload, requester_ip, transport, pools, received_ns=None):
+    """same as ForwardingDNSHandler.handle, for the async engine (record printed at once)"""
+    log_time = datetime.datetime.now().isoformat()
+    requested_domain = ForwardingDNSHandler.extract_domain_name(payload)
+    if not requested_domain:
+        return  # skip malformed queries
+
+    record = ["DNS Query Log (Alternate)",
+              f"a. Timestamp: {log_time}",
+              f"b. Domain Name: {requested_domain}",
+              "i. Cache State: NOT_FOUND"]
+    try:
+        send_time = time.time()
+        response, server = await hedged_query_async(UPSTREAM_SELECTOR, pools, payload, UPSTREAM_TIMEOUT)
+        latency = (time.time() - send_time) * 1000
+        record += [f"d. Upstream DNS Contacted: {server}",
+                   "e. Action: Relayed Upstream",
+                   "f. Upstream Response: Received",
+                   f"g. Upstream RTT: {latency:.2f} ms",
+                   f"h. Overall Time: {latency:.2f} ms"]
+        transport.sendto(response, requester_ip)
+    except asyncio.TimeoutError:
+        record.append("f. Upstream Response: Timeout")
+    except Exception as err:
+        record.append(f"[Forwarder] Error during forwarding: {err}")
+    finally:
+        record.append("------------------------\n")
+        print("\n".join(record))
+
+async def serve_async(listen_ip, listen_port):
+    """Starts one upstream socket pool per server and runs Task-D's async engine on them."""
+    pools = {}
+    try:
+        for upstream in UPSTREAM_DNS_SERVERS:
+            pools[upstream] = async_engine.UpstreamPool(upstream, UPSTREAM_DNS_PORT)
+            await pools[upstream].start()
+        await async_engine.serve(listen_ip, listen_port, handle_async, pools)
+    finally:
+        for pool in pools.values():
+            pool.close()
+
 if __name__ == "__main__":
     LISTEN_IP, LISTEN_PORT = "10.0.0.5", 53
-    print(f"DNS Forwarder active at {LISTEN_IP}:{LISTEN_PORT}...")
+    # --engine sync|async picks the serving engine, --port lets both run side by side
+    engine = "sync"
+    if '--engine' in sys.argv:
+        engine = sys.argv[sys.argv.index('--engine') + 1]
+    if '--port' in sys.argv:
+        LISTEN_PORT = int(sys.argv[sys.argv.index('--port') + 1])
+    if '--upstreams' in sys.argv:
+        UPSTREAM_DNS_SERVERS = sys.argv[sys.argv.index('--upstreams') + 1].split(',')
+    if engine not in ("sync", "async"):
+        print(f"Usage: python3 {sys.argv[0]} [--engine sync|async] [--port 53] [--upstreams a,b,c]")
+        sys.exit(1)
+    UPSTREAM_SELECTOR = UpstreamSelector(UPSTREAM_DNS_SERVERS)
+    print(f"DNS Forwarder active at {LISTEN_IP}:{LISTEN_PORT} ({engine} engine)...")
     try:
-        with socketserver.UDPServer((LISTEN_IP, LISTEN_PORT), ForwardingDNSHandler) as server:
-            server.serve_forever()
+        if engine == "async":
+            asyncio.run(serve_async(LISTEN_IP, LISTEN_PORT))
+        else:
+            for upstream in UPSTREAM_DNS_SERVERS:
+                UPSTREAM_POOLS[upstream] = UpstreamSocketPool(upstream, UPSTREAM_DNS_PORT)
+            with socketserver.UDPServer((LISTEN_IP, LISTEN_PORT), ForwardingDNSHandler) as server:
+                server.serve_forever()
+    except KeyboardInterrupt:
+        print(format_upstream_stats(UPSTREAM_SELECTOR.stats()))
     except Exception as err:
         print(f"!! [Forwarder] LAUNCH FAILURE: {err} !!")
         print("!! You may need 'sudo' to execute this script !!")
+    finally:
+        for pool in UPSTREAM_POOLS.values():
+            pool.close()
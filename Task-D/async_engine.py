@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+"""
+asyncio serving engine for the forwarder.
+
+socketserver.UDPServer handles one datagram at a time, so a slow upstream answer
+stalls every other client. Here every query is its own task: the client socket
+keeps accepting datagrams while earlier queries wait on the upstream, and the
+upstream traffic is multiplexed over a small pool of sockets by transaction ID.
+"""
+import asyncio
+import random
+import struct
+import time
+from dnswire import question_section
+from upstream_pool import open_upstream_socket
+
+# number of upstream sockets shared by all in-flight queries
+UPSTREAM_SOCKETS = 4
+# per-query upstream timeout (seconds)
+QUERY_TIMEOUT = 2.0
+
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    """
+    One upstream socket. Outstanding queries are kept by transaction ID and a
+    response is only accepted if its question matches the one that was sent.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.transport = None
+        self.pending = {}
+        self.source_port = None
+        self.peak_in_flight = 0
+        self.sent = 0
+        self.received = 0
+        self.timeouts = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.source_port = transport.get_extra_info('sockname')[1]
+
+    def datagram_received(self, data, addr):
+        if len(data) < 12:
+            return
+        qid = struct.unpack_from('!H', data)[0]
+        entry = self.pending.get(qid)
+        if entry is None:
+            return  # late answer for a query that already timed out
+        question, future = entry
+        if data[12:12 + len(question)] != question:
+            return  # ID collision or spoofed answer, keep waiting
+        del self.pending[qid]
+        self.received += 1
+        if not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        # ICMP errors on a connected UDP socket cannot be tied to one query,
+        # the affected queries simply run into their timeout
+        pass
+
+    def connection_lost(self, exc):
+        for _, future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("upstream socket closed"))
+        self.pending.clear()
+
+
+class UpstreamPool:
+    """
+    Small set of connected UDP sockets towards one upstream server, each bound
+    to a random source port. Queries go to the socket with the fewest in flight.
+    """
+
+    def __init__(self, server, port=53, size=UPSTREAM_SOCKETS):
+        self.server = server
+        self.port = port
+        self.size = size
+        self.protocols = []
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for index in range(self.size):
+            sock = open_upstream_socket(self.server, self.port)
+            _, protocol = await loop.create_datagram_endpoint(
+                lambda index=index: UpstreamProtocol(index), sock=sock)
+            self.protocols.append(protocol)
+
+    def stats(self):
+        return [{
+            'server': self.server,
+            'socket': p.index,
+            'source_port': p.source_port,
+            'in_flight': len(p.pending),
+            'peak_in_flight': p.peak_in_flight,
+            'sent': p.sent,
+            'received': p.received,
+            'timeouts': p.timeouts,
+        } for p in self.protocols]
+
+    def close(self):
+        for protocol in self.protocols:
+            if protocol.transport is not None:
+                protocol.transport.close()
+
+    async def query(self, payload, timeout=QUERY_TIMEOUT):
+        """
+        Sends 'payload' upstream and waits for the matching answer.
+        The query goes out under a fresh random ID (clients pick their IDs
+        independently, so theirs may clash); the client's ID is put back on
+        the answer. Raises asyncio.TimeoutError when no answer arrives in time.
+        """
+        protocol = min(self.protocols, key=lambda p: len(p.pending))
+        qid = random.getrandbits(16)
+        while qid in protocol.pending:
+            qid = random.getrandbits(16)
+        future = asyncio.get_running_loop().create_future()
+        protocol.pending[qid] = (question_section(payload), future)
+        protocol.peak_in_flight = max(protocol.peak_in_flight, len(protocol.pending))
+        protocol.sent += 1
+        protocol.transport.sendto(struct.pack('!H', qid) + payload[2:])
+        try:
+            response = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            protocol.timeouts += 1
+            raise
+        finally:
+            entry = protocol.pending.get(qid)
+            if entry is not None and entry[1] is future:
+                del protocol.pending[qid]
+        return payload[:2] + response[2:]
+
+
+class ClientProtocol(asyncio.DatagramProtocol):
+    """Listening socket, spawns one task per incoming query."""
+
+    def __init__(self, handler, pools):
+        self.handler = handler
+        self.pools = pools
+        self.transport = None
+        self.tasks = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        # the read time lets the handler tell how long the task waited for the loop
+        task = asyncio.ensure_future(self.handler(data, addr, self.transport, self.pools,
+                                                  time.perf_counter_ns()))
+        # keep a reference so the task is not garbage collected mid-flight
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+
+async def serve(listen_ip, listen_port, handler, pools, reuse_port=False):
+    """
+    Runs the async engine forever. 'pools' (already started UpstreamPool objects,
+    by server, the caller closes them) are handed to 'handler', a coroutine
+    function taking (payload, client_addr, transport, pools, received_ns), where
+    received_ns is the perf_counter_ns time the datagram was read.
+    'reuse_port' lets several worker processes bind the same address.
+    """
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: ClientProtocol(handler, pools), local_addr=(listen_ip, listen_port),
+        reuse_port=reuse_port or None)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        transport.close()
@@ -2,6 +2,7 @@ import sys
 import subprocess
 import time
 import re
+import loadgen
 # extarct the pcap files to txt file and then use it as an input
 def read_domains_from_txt(txt_filename):
     domains = []
@@ -78,16 +79,19 @@ def run_performance_test(domain_list):
     print(f"  Overall Throughput:   {queries_per_second:.2f} queries/sec")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
+    if len(sys.argv) < 2 or sys.argv[1].startswith('--'):
         # Updated usage message to reflect the change to .txt file input
-        print(f"Usage: python3 {sys.argv[0]} <path_to_domains_file.txt>")
+        print(f"Usage: python3 {sys.argv[0]} <path_to_domains_file.txt> {loadgen.NATIVE_USAGE}")
         sys.exit(1)
         
     txt_filename = sys.argv[1]
     # Call the new function to read from the text file
     domains_to_test = read_domains_from_txt(txt_filename)
     
-    if domains_to_test:
+    if domains_to_test and '--native' in sys.argv:
+        # raw UDP queries from asyncio instead of two dig processes per domain
+        loadgen.run_native_benchmark(domains_to_test, **loadgen.parse_native_args(sys.argv))
+    elif domains_to_test:
         run_performance_test(domains_to_test)
     else:
         print("--> Benchmark finished with no domains to test.")
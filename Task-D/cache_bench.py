@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+"""
+Memory and speed of the answer cache backends at 10k, 100k and 1M entries:
+a plain dict of wire bytes (the baseline), DNSCache and CompactDNSCache.
+Bytes per entry are measured with tracemalloc while the cache is filled (the
+answers are built inside the measurement, so only the cache holds them). A
+second fill of a new cache times put, then get is timed on random names; both
+in ns per operation, without tracemalloc.
+"""
+import gc
+import random
+import sys
+import time
+import tracemalloc
+import dnswire
+from compact_cache import OBJECT_OVERHEAD, CompactDNSCache, index_bytes, record_size
+from dns_cache import DNSCache
+
+SIZES = [10000, 100000, 1000000]
+LOOKUPS = 200000
+
+
+def make_answer(i):
+    """A-record answer for a distinct name; 1 to 4 records like typical lookups."""
+    name = f"host{i}.zone{i % 1000}.example.com"
+    answer = bytearray(dnswire.build_query(0, name))
+    count = i % 4 + 1
+    answer[2:4] = dnswire.U16.pack(0x8180)
+    answer[6:8] = dnswire.U16.pack(count)
+    for n in range(count):
+        answer += b'\xc0\x0c' + dnswire.RR_FIXED.pack(dnswire.TYPE_A, dnswire.CLASS_IN, 3600, 4) + bytes(
+            [10, n, (i >> 8) & 0xFF, i & 0xFF])
+    return bytes(answer)
+
+
+class PlainDict(dict):
+    """The naive cache: {(qname, qtype, qclass): wire bytes}."""
+
+    def put(self, key, response):
+        self[key] = response
+
+    def lookup(self, key, query):
+        return self.get(key)
+
+
+def make_cache(backend, size, arena_bytes):
+    if backend == 'dict':
+        return PlainDict()
+    if backend == 'DNSCache':
+        return DNSCache(max_entries=size, max_bytes=1 << 40)
+    # the arena is sized to hold every answer, so nothing is evicted while filling
+    return CompactDNSCache(max_entries=size, max_bytes=index_bytes(size) + OBJECT_OVERHEAD + arena_bytes)
+
+
+def measure(backend, size, keys, answers, lookups, rng):
+    """(bytes per entry, put ns/op, get ns/op)."""
+    arena_bytes = sum(record_size(key, answer[7], len(answer)) for key, answer in zip(keys, answers))
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    cache = make_cache(backend, size, arena_bytes)
+    for i in range(size):
+        answer = make_answer(i)
+        cache.put(dnswire.cache_key(answer), answer)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del cache
+    gc.collect()
+
+    cache = make_cache(backend, size, arena_bytes)
+    put = cache.put
+    start = time.perf_counter_ns()
+    for key, answer in zip(keys, answers):
+        put(key, answer)
+    put_ns = (time.perf_counter_ns() - start) / size
+
+    sample = [rng.randrange(size) for _ in range(lookups)]
+    lookup_keys = [keys[i] for i in sample]
+    queries = [dnswire.build_query(rng.randrange(65536), key[0]) for key in lookup_keys]
+    get = cache.lookup if backend == 'dict' else cache.get
+    start = time.perf_counter_ns()
+    for key, query in zip(lookup_keys, queries):
+        get(key, query)
+    get_ns = (time.perf_counter_ns() - start) / lookups
+    return used / size, put_ns, get_ns
+
+
+def run_benchmark(sizes, lookups, out_path):
+    rng = random.Random(1)
+    print(f"--> {lookups} gets per measurement; the 'dict' get is the bare lookup, the caches "
+          f"also copy the answer and patch ID, question and TTLs\n")
+    print(f"{'entries':>9}{'backend':>10}{'bytes/entry':>13}{'put ns/op':>11}{'get ns/op':>11}")
+    rows = []
+    for size in sizes:
+        answers = [make_answer(i) for i in range(size)]
+        keys = [dnswire.cache_key(answer) for answer in answers]
+        for backend in ('dict', 'DNSCache', 'compact'):
+            per_entry, put_ns, get_ns = measure(backend, size, keys, answers, lookups, rng)
+            rows.append((size, backend, per_entry, put_ns, get_ns))
+            print(f"{size:>9}{backend:>10}{per_entry:>13.0f}{put_ns:>11.0f}{get_ns:>11.0f}")
+    if out_path:
+        with open(out_path, 'w') as f:
+            f.write("entries,backend,bytes_per_entry,put_ns,get_ns\n")
+            for row in rows:
+                f.write("%d,%s,%.1f,%.0f,%.0f\n" % row)
+        print(f"\n[Saved] {out_path}")
+
+
+if __name__ == "__main__":
+    sizes = SIZES
+    lookups = LOOKUPS
+    out_path = None
+    if '--sizes' in sys.argv:
+        sizes = [int(n) for n in sys.argv[sys.argv.index('--sizes') + 1].split(',')]
+    if '--lookups' in sys.argv:
+        lookups = int(sys.argv[sys.argv.index('--lookups') + 1])
+    if '--out' in sys.argv:
+        out_path = sys.argv[sys.argv.index('--out') + 1]
+    run_benchmark(sizes, lookups, out_path)
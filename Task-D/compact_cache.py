@@ -0,0 +1,394 @@
+#!/usr/bin/python3
+"""
+Compact answer cache for cr.py --cache-backend compact, for millions of names.
+
+DNSCache keeps every answer as a CacheEntry object with a bytes object, a key
+tuple with its string, two lists of ints and an OrderedDict node around it:
+several hundred bytes of Python objects per answer. This backend keeps the same
+answers in memory allocated once, sized by a cap in bytes:
+  arena   - one bytearray used as a ring log. A record is a 10-byte header
+            (entry id, key, wire and TTL-table lengths), the key, the wire
+            bytes and the TTL field offsets (2 bytes each); the TTLs
+            themselves are read back from the wire.
+  entries - parallel array.array columns indexed by entry id: record offset,
+            record size, key hash, stored / expires time, hits and flags.
+  index   - an open-addressing hash table (linear probing, backward-shift
+            deletion) of entry ids, twice the entry capacity.
+New records are written at the tail of the ring; when it runs out of room,
+the records at the head are dropped, i.e. entries are evicted in the order
+they were stored (popular ones are stored again by prefetching before they
+expire). Deleted and replaced records leave dead bytes that are reclaimed when
+the head passes them.
+
+The interface is DNSCache's (get, get_stale, put, dump, load, stats, ...),
+snapshots are interchangeable between the two.
+"""
+import struct
+import threading
+import time
+from array import array
+import dnswire
+from dns_cache import (STALE_MAX_AGE, STALE_ANSWER_TTL, PREFETCH_MIN_HITS, PREFETCH_WINDOW,
+                       answer_lifetime, read_snapshot, write_snapshot)
+
+# default memory cap (arena plus index), cr.py can override it
+MAX_BYTES = 64 * 1024 * 1024
+# expected record size, used to size the index when no entry limit is given
+RECORD_ESTIMATE = 96
+# left out of the arena for the Python objects around the buffers (headers, lock, attributes)
+OBJECT_OVERHEAD = 4096
+
+# entry id, key length, wire length, TTL count
+RECORD_HEADER = struct.Struct('<IHHH')
+KEY_HEAD = struct.Struct('!H')
+KEY_TAIL = struct.Struct('!HH')
+U32 = struct.Struct('!I')
+
+EMPTY = -1
+LIVE, NEGATIVE, PREFETCHING = 1, 2, 4
+
+# per entry id: the columns below plus its place on the free id stack ('I'),
+# and at least two index slots of 4 bytes
+COLUMN_TYPES = {'offsets': 'I', 'sizes': 'I', 'hashes': 'q', 'stored_at': 'd', 'expires_at': 'd',
+                'hit_counts': 'I', 'flags': 'B'}
+COLUMN_BYTES = sum(array(code).itemsize for code in COLUMN_TYPES.values()) + array('I').itemsize
+SLOT_BYTES = array('i').itemsize
+INDEX_BYTES_PER_ENTRY = COLUMN_BYTES + 2 * SLOT_BYTES
+
+
+# struct for a TTL table of n offsets, by n
+TTL_TABLES = {}
+
+
+def ttl_table(count):
+    table = TTL_TABLES.get(count)
+    if table is None:
+        table = TTL_TABLES[count] = struct.Struct(f'<{count}H')
+    return table
+
+
+def encode_key(key):
+    """Key bytes led by their length, so a prefix match in the arena is an exact match."""
+    name, qtype, qclass = key
+    raw = name.encode('ascii', 'backslashreplace')
+    return KEY_HEAD.pack(len(raw) + KEY_TAIL.size) + raw + KEY_TAIL.pack(qtype, qclass)
+
+
+def index_slots(max_entries):
+    """Slots of the hash table: the power of two at or above twice the entries."""
+    slots = 1
+    while slots < 2 * max_entries:
+        slots <<= 1
+    return slots
+
+
+def index_bytes(max_entries):
+    """Bytes taken by the columns, the free id stack and the index for 'max_entries'."""
+    return max_entries * COLUMN_BYTES + index_slots(max_entries) * SLOT_BYTES
+
+
+def record_size(key, ttl_count, wire_length):
+    """Arena bytes taken by one record."""
+    return RECORD_HEADER.size + len(encode_key(key)) + wire_length + 2 * ttl_count
+
+
+class CompactDNSCache:
+    """
+    Answer cache in a preallocated arena. 'max_bytes' caps the arena and the
+    index together; 'max_entries' defaults to what fits at RECORD_ESTIMATE
+    bytes a record, rounded down to fill a power-of-two index.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=MAX_BYTES, clock=time.monotonic, serve_stale=True):
+        if max_entries is None:
+            # the index has a power-of-two size: round down to one, then take
+            # the entries it holds at two slots each
+            slots = 1
+            while slots <= max_bytes // (RECORD_ESTIMATE + INDEX_BYTES_PER_ENTRY):
+                slots <<= 1
+            max_entries = slots // 2
+        arena_bytes = max_bytes - index_bytes(max_entries) - OBJECT_OVERHEAD
+        if max_entries < 1 or arena_bytes < 512:
+            raise ValueError(f"{max_bytes} bytes is too small for {max_entries} entries")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.serve_stale = serve_stale
+        self.prefetch_hook = None
+        self.arena = bytearray(min(arena_bytes, 0xFFFFFFFF))
+        self.head = 0
+        self.tail = 0
+        # end of the data before the tail wrapped to the start, None when not wrapped
+        self.wrap_end = None
+        # repeating a one-item array allocates exactly; building from bytes or a range over-allocates
+        for column, code in COLUMN_TYPES.items():
+            setattr(self, column, array(code, [0]) * max_entries)
+        slots = index_slots(max_entries)
+        self.index = array('i', [EMPTY]) * slots
+        self.mask = slots - 1
+        # stack of unused ids, the lowest on top; a fixed array and its height, so it never reallocates
+        self.free_ids = array('I', [0]) * max_entries
+        # filled in place, a temporary array of all ids would briefly go over max_bytes
+        for i in range(max_entries):
+            self.free_ids[i] = max_entries - 1 - i
+        self.free_count = max_entries
+        self.count = 0
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetches = 0
+        self.stale_hits = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    # ---- index
+
+    def _find(self, key_bytes, key_hash):
+        """Entry id for the key, EMPTY if it is not cached."""
+        arena, index, hashes, offsets = self.arena, self.index, self.hashes, self.offsets
+        slot = key_hash & self.mask
+        while True:
+            entry_id = index[slot]
+            if entry_id == EMPTY:
+                return EMPTY
+            if hashes[entry_id] == key_hash and arena.startswith(key_bytes, offsets[entry_id] + RECORD_HEADER.size):
+                return entry_id
+            slot = (slot + 1) & self.mask
+
+    def _unindex(self, entry_id):
+        index, hashes, mask = self.index, self.hashes, self.mask
+        slot = hashes[entry_id] & mask
+        while index[slot] != entry_id:
+            slot = (slot + 1) & mask
+        # backward-shift deletion keeps every probe chain unbroken without tombstones
+        nxt = slot
+        while True:
+            nxt = (nxt + 1) & mask
+            moved = index[nxt]
+            if moved == EMPTY:
+                break
+            home = hashes[moved] & mask
+            if (slot < nxt and slot < home <= nxt) or (slot > nxt and (home > slot or home <= nxt)):
+                continue
+            index[slot] = moved
+            slot = nxt
+        index[slot] = EMPTY
+
+    def _delete(self, entry_id):
+        # the record's bytes stay in the arena until the head passes them
+        self._unindex(entry_id)
+        self.flags[entry_id] = 0
+        self.size_bytes -= self.sizes[entry_id]
+        self.free_ids[self.free_count] = entry_id
+        self.free_count += 1
+        self.count -= 1
+
+    # ---- arena
+
+    def _evict_head(self):
+        """Drops the oldest record of the ring."""
+        head = self.head
+        entry_id, key_length, wire_length, ttl_count = RECORD_HEADER.unpack_from(self.arena, head)
+        size = RECORD_HEADER.size + key_length + wire_length + 2 * ttl_count
+        if self.flags[entry_id] & LIVE and self.offsets[entry_id] == head:
+            self._delete(entry_id)
+            self.evictions += 1
+        self.head = head + size
+        if self.wrap_end is not None and self.head >= self.wrap_end:
+            self.head = 0
+            self.wrap_end = None
+
+    def _reserve(self, size):
+        """Arena offset for a record of 'size' bytes, evicting the oldest records for room."""
+        capacity = len(self.arena)
+        while True:
+            if self.wrap_end is None:
+                if self.head == self.tail and not self.count:
+                    self.head = self.tail = 0
+                if self.tail + size <= capacity:
+                    break
+                # no room before the end: continue at the start of the arena
+                self.wrap_end = self.tail
+                self.tail = 0
+            if self.tail + size <= self.head:
+                break
+            self._evict_head()
+        offset = self.tail
+        self.tail += size
+        return offset
+
+    def _write(self, key, key_bytes, key_hash, wire, ttl_offsets, stored_at, lifetime, hits, negative):
+        """Stores a record under a fresh entry id, the key must not be cached. Lock held."""
+        # with every id taken, all entries are live and the oldest gives up its id
+        while not self.free_count:
+            self._evict_head()
+        self.free_count -= 1
+        entry_id = self.free_ids[self.free_count]
+        size = RECORD_HEADER.size + len(key_bytes) + len(wire) + 2 * len(ttl_offsets)
+        offset = self._reserve(size)
+        pos = offset + RECORD_HEADER.size
+        RECORD_HEADER.pack_into(self.arena, offset, entry_id, len(key_bytes), len(wire), len(ttl_offsets))
+        self.arena[pos:pos + len(key_bytes)] = key_bytes
+        pos += len(key_bytes)
+        self.arena[pos:pos + len(wire)] = wire
+        pos += len(wire)
+        ttl_table(len(ttl_offsets)).pack_into(self.arena, pos, *ttl_offsets)
+        self.offsets[entry_id] = offset
+        self.sizes[entry_id] = size
+        self.hashes[entry_id] = key_hash
+        self.stored_at[entry_id] = stored_at
+        self.expires_at[entry_id] = stored_at + lifetime
+        self.hit_counts[entry_id] = hits
+        self.flags[entry_id] = LIVE | (NEGATIVE if negative else 0)
+        slot = key_hash & self.mask
+        while self.index[slot] != EMPTY:
+            slot = (slot + 1) & self.mask
+        self.index[slot] = entry_id
+        self.count += 1
+        self.size_bytes += size
+
+    def _copy_for(self, entry_id, query, elapsed, fixed_ttl=None):
+        """The cached answer with the query's ID and question and counted-down TTLs."""
+        arena = self.arena
+        offset = self.offsets[entry_id]
+        _, key_length, wire_length, ttl_count = RECORD_HEADER.unpack_from(arena, offset)
+        start = offset + RECORD_HEADER.size + key_length
+        response = arena[start:start + wire_length]
+        question_end = dnswire.skip_name(query, 12) + 4
+        response[:2] = query[:2]
+        response[12:question_end] = query[12:question_end]
+        unpack_from, pack_into = U32.unpack_from, U32.pack_into
+        for ttl_off in ttl_table(ttl_count).unpack_from(arena, start + wire_length):
+            if fixed_ttl is not None:
+                ttl = fixed_ttl
+            else:
+                ttl = unpack_from(response, ttl_off)[0]
+                ttl = ttl - elapsed if ttl > elapsed else 0
+            pack_into(response, ttl_off, ttl)
+        return bytes(response)
+
+    # ---- DNSCache interface
+
+    def get(self, key, query):
+        """Ready-to-send response for 'query' or None on a miss, like DNSCache.get()."""
+        key_bytes = encode_key(key)
+        key_hash = hash(key_bytes)
+        now = self.clock()
+        prefetch = False
+        with self.lock:
+            entry_id = self._find(key_bytes, key_hash)
+            if entry_id == EMPTY:
+                self.misses += 1
+                return None
+            expires_at = self.expires_at[entry_id]
+            if now >= expires_at:
+                if not self.serve_stale or now >= expires_at + STALE_MAX_AGE:
+                    self._delete(entry_id)
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.hit_counts[entry_id] = hits = min(self.hit_counts[entry_id] + 1, 0xFFFFFFFF)
+            stored_at = self.stored_at[entry_id]
+            if (self.prefetch_hook is not None and not self.flags[entry_id] & PREFETCHING
+                    and hits >= PREFETCH_MIN_HITS
+                    and expires_at - now <= (expires_at - stored_at) * PREFETCH_WINDOW):
+                self.flags[entry_id] |= PREFETCHING
+                self.prefetches += 1
+                prefetch = True
+            response = self._copy_for(entry_id, query, int(now - stored_at))
+        if prefetch:
+            self.prefetch_hook(key, query)
+        return response
+
+    def get_stale(self, key, query):
+        """Expired data with every TTL set to STALE_ANSWER_TTL, or None (RFC 8767)."""
+        if not self.serve_stale:
+            return None
+        key_bytes = encode_key(key)
+        now = self.clock()
+        with self.lock:
+            entry_id = self._find(key_bytes, hash(key_bytes))
+            if entry_id == EMPTY or now >= self.expires_at[entry_id] + STALE_MAX_AGE:
+                return None
+            self.stale_hits += 1
+            return self._copy_for(entry_id, query, 0, STALE_ANSWER_TTL)
+
+    def prefetch_failed(self, key):
+        key_bytes = encode_key(key)
+        with self.lock:
+            entry_id = self._find(key_bytes, hash(key_bytes))
+            if entry_id != EMPTY:
+                self.flags[entry_id] &= ~PREFETCHING
+
+    def put(self, key, response):
+        """Stores an upstream answer, returns the lifetime used (0 if not cached)."""
+        lifetime, ttl_offsets, _, negative = answer_lifetime(response)
+        key_bytes = encode_key(key)
+        size = RECORD_HEADER.size + len(key_bytes) + len(response) + 2 * len(ttl_offsets or ())
+        # a record may take up to half the arena, so one put never empties the whole ring
+        if lifetime <= 0 or size > len(self.arena) // 2 or len(response) > 0xFFFF:
+            return 0
+        key_hash = hash(key_bytes)
+        with self.lock:
+            hits = 0
+            entry_id = self._find(key_bytes, key_hash)
+            if entry_id != EMPTY:
+                # a refresh keeps the popularity the entry has earned
+                hits = self.hit_counts[entry_id]
+                self._delete(entry_id)
+            self._write(key, key_bytes, key_hash, response, ttl_offsets, self.clock(), lifetime, hits, negative)
+        return lifetime
+
+    def _live_records(self):
+        """(entry id, offset) of every live record, oldest first. Lock held."""
+        arena, flags, offsets = self.arena, self.flags, self.offsets
+        spans = [(self.head, self.wrap_end), (0, self.tail)] if self.wrap_end is not None else [(self.head, self.tail)]
+        for pos, end in spans:
+            while pos < end:
+                entry_id, key_length, wire_length, ttl_count = RECORD_HEADER.unpack_from(arena, pos)
+                if flags[entry_id] & LIVE and offsets[entry_id] == pos:
+                    yield entry_id, pos
+                pos += RECORD_HEADER.size + key_length + wire_length + 2 * ttl_count
+
+    def dump(self, path):
+        """Writes every entry to 'path' in the DNSCache snapshot format, oldest first."""
+        now = self.clock()
+        with self.lock:
+            entries = []
+            for entry_id, pos in self._live_records():
+                _, key_length, wire_length, _ = RECORD_HEADER.unpack_from(self.arena, pos)
+                start = pos + RECORD_HEADER.size + key_length
+                entries.append((self.stored_at[entry_id], self.expires_at[entry_id], self.hit_counts[entry_id],
+                                bool(self.flags[entry_id] & NEGATIVE), bytes(self.arena[start:start + wire_length])))
+        return write_snapshot(path, now, entries)
+
+    def load(self, path):
+        """Adds the entries of a snapshot (see DNSCache.load), returns how many were loaded."""
+        now = self.clock()
+        keep_for = STALE_MAX_AGE if self.serve_stale else 0
+        loaded = 0
+        for key, wire, ttl_offsets, _, age, lifetime, hits, negative in read_snapshot(path, keep_for):
+            key_bytes = encode_key(key)
+            if record_size(key, len(ttl_offsets), len(wire)) > len(self.arena) // 2 or len(wire) > 0xFFFF:
+                continue
+            key_hash = hash(key_bytes)
+            with self.lock:
+                if self._find(key_bytes, key_hash) != EMPTY:
+                    continue
+                self._write(key, key_bytes, key_hash, wire, ttl_offsets, now - age, lifetime, hits, negative)
+            loaded += 1
+        return loaded
+
+    def stats(self):
+        return {
+            'entries': self.count,
+            'bytes': self.size_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'prefetches': self.prefetches,
+            'stale_hits': self.stale_hits,
+        }
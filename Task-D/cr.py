@@ -1,17 +1,439 @@
 #!/usr/bin/python3
 
+import asyncio
+import glob
+import os
 import socket
 import socketserver
+import sys
+import threading
 import time
-import datetime
+from concurrent.futures import ThreadPoolExecutor
+import async_engine
+import dnstcp
+import dnswire
+import metrics
+import negative_cache
+import querylog
+from compact_cache import CompactDNSCache
+from dns_cache import DNSCache
+from metrics import StageTimer
+from negative_cache import NegativeCache, format_negative_stats
+from shared_cache import SharedCache, format_shared_stats
+from iterative import DelegationCache, IterativeResolver
+from querylog import QueryLogger, QueryRecord
+from singleflight import AsyncSingleFlight, SingleFlight, format_coalescing_stats
+from supervisor import EXIT_NO_RESTART, Supervisor
+from upstream_pool import UpstreamSocketPool, format_pool_stats
+from upstreams import UpstreamSelector, format_upstream_stats, hedged_query, hedged_query_async
 
 # Chosen upstream DNS to relay queries
-UPSTREAM_DNS_SERVER = "8.8.8.8"
+UPSTREAM_DNS_SERVERS = ["8.8.8.8", "1.1.1.1", "9.9.9.9"]
 UPSTREAM_DNS_PORT = 53
+UPSTREAM_TIMEOUT = 2.0
 
-DNS_CACHE = {}
+# long-lived upstream sockets shared by all queries (opened at server start)
+UPSTREAM_POOL_SIZE = 4
+UPSTREAM_POOLS = {}
+# queries go to the fastest healthy upstream and are hedged to the runner-up
+# once they take longer than that upstream's p95
+HEDGING_ENABLED = True
+UPSTREAM_SELECTOR = None
+# print the per-socket pool counters every N upstream queries
+POOL_REPORT_INTERVAL = 1000
+upstream_queries = 0
 
-CACHE_ENABLED = False
+# upstream queries advertise an EDNS(0) buffer of dnswire.EDNS_PAYLOAD_SIZE; an
+# upstream answer that still comes back truncated (TC) is fetched again over a
+# persistent TCP connection to the same server. Answers bigger than the client's
+# own UDP buffer are sent truncated, and the client retries on the TCP listener.
+TCP_ENABLED = True
+TCP_POOLS = {}
+tcp_fallbacks = 0
+truncated_answers = 0
+
+# identical (qname, qtype, qclass) queries arriving while one is already
+# waiting on the upstream share its answer instead of being sent again
+COALESCING_ENABLED = True
+COALESCER = SingleFlight()
+ASYNC_COALESCER = AsyncSingleFlight()
+
+# answer cache limits (entries and total wire bytes), LRU eviction past either;
+# with --cache-backend compact CACHE_MAX_BYTES caps the whole arena and index
+CACHE_MAX_ENTRIES = 10000
+CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+DNS_CACHE = DNSCache(max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES)
+
+CACHE_ENABLED = True
+
+# --shared-cache path: a second tier in a memory-mapped file that every resolver
+# process on the host reads and fills (shared_cache.py), kept across restarts
+SHARED_CACHE = None
+
+# NXDOMAIN / NODATA answers and upstream failures (SERVFAIL, timeouts) are kept
+# in a cache of their own (negative_cache.py), so junk names neither evict real
+# answers nor go upstream again and again
+NEGATIVE_CACHE_ENABLED = True
+NEGATIVE_CACHE = NegativeCache()
+
+# popular entries hit close to expiry are refreshed in the background; expired
+# entries answer clients when the upstream times out (DNSCache serve_stale)
+PREFETCH_ENABLED = True
+PREFETCH_WORKERS = 2
+PREFETCH_EXECUTOR = None
+PREFETCH_TASKS = set()
+
+# --cache-file: the cache is loaded from this snapshot at startup and written back at shutdown
+CACHE_SNAPSHOT = None
+
+# "forward" relays to UPSTREAM_DNS_SERVERS, "iterative" walks Root -> TLD -> Authoritative
+RESOLUTION_MODE = "forward"
+# NS/glue delegations are cached separately from the final answers in DNS_CACHE
+DELEGATION_CACHE = DelegationCache()
+ITERATIVE_RESOLVER = IterativeResolver(DELEGATION_CACHE)
+
+# one record per query, written by a background thread (text to stdout by default)
+QUERY_LOG = QueryLogger("text")
+queries_served = 0
+
+# --metrics-port / --metrics-socket: per-stage latency histograms and counters
+# in the Prometheus text format (metrics.py); None keeps the hot path free of them
+METRICS = None
+METRICS_PORT = None
+METRICS_SOCKET = None
+
+# --workers N runs N processes sharing the listen address through SO_REUSEPORT,
+# each one sends its counters to the supervisor every WORKER_STATS_INTERVAL seconds
+WORKER_STATS_INTERVAL = 2.0
+
+def lookup_cache(payload):
+    """Returns (cache_key, cached_response); the response is None on a miss."""
+    if not CACHE_ENABLED:
+        return None, None
+    try:
+        cache_key = dnswire.cache_key(payload)
+        response = DNS_CACHE.get(cache_key, payload)
+        if response is None and SHARED_CACHE is not None:
+            response = SHARED_CACHE.get(cache_key, payload)
+            if response is not None:
+                # its TTLs are already counted down, so the local copy expires with the shared one
+                DNS_CACHE.put(cache_key, response)
+        return cache_key, response
+    except Exception as err:
+        print(f"[Forwarder] Cache lookup failed: {err}")
+        return None, None
+
+def store_in_cache(cache_key, response, cost_ms=0.0):
+    """
+    Answers go to DNS_CACHE, NXDOMAIN / NODATA to NEGATIVE_CACHE, and SERVFAIL
+    holds the name down. 'cost_ms' is what the upstream took, for the savings count.
+    """
+    if not CACHE_ENABLED or cache_key is None:
+        return
+    if NEGATIVE_CACHE_ENABLED:
+        _, flags, _, ancount, _, _ = dnswire.unpack_header(response)
+        if flags & 0x000F == dnswire.RCODE_SERVFAIL:
+            NEGATIVE_CACHE.hold_down(cache_key, cost_ms)
+            return
+        if ancount == 0 and NEGATIVE_CACHE.put(cache_key, response, cost_ms):
+            return
+    cache_answer(cache_key, response)
+
+def cache_answer(cache_key, response):
+    """Stores in DNS_CACHE and the shared tier, returns the lifetime (0 if not cached)."""
+    lifetime = DNS_CACHE.put(cache_key, response)
+    if lifetime and SHARED_CACHE is not None:
+        SHARED_CACHE.put(cache_key, response)
+    return lifetime
+
+def hold_down(cache_key, cost_ms):
+    """The upstream timed out (or iterative resolution failed) for this query."""
+    if CACHE_ENABLED and NEGATIVE_CACHE_ENABLED and cache_key is not None:
+        NEGATIVE_CACHE.hold_down(cache_key, cost_ms)
+
+def load_cache_snapshots(path):
+    """
+    Warm start from 'path' and the path.w0, path.w1, ... files of a --workers run.
+    The newest file goes first, so its entries win over older copies of a name.
+    """
+    snapshots = [p for p in [path] + glob.glob(f"{glob.escape(path)}.w*") if os.path.exists(p)]
+    for snapshot in sorted(snapshots, key=os.path.getmtime, reverse=True):
+        try:
+            print(f"[Cache] Loaded {DNS_CACHE.load(snapshot)} entries from '{snapshot}'")
+        except (OSError, ValueError) as err:
+            print(f"[Cache] Could not load '{snapshot}': {err}")
+
+def save_cache_snapshot(path):
+    try:
+        print(f"[Cache] Saved {DNS_CACHE.dump(path)} entries to '{path}'")
+    except OSError as err:
+        print(f"[Cache] Could not save '{path}': {err}")
+
+def serve_stale(cache_key, payload, record):
+    """Expired cache data for a query the upstream did not answer (RFC 8767), or None."""
+    if not CACHE_ENABLED or cache_key is None:
+        return None
+    response = DNS_CACHE.get_stale(cache_key, payload)
+    if response is not None:
+        record.outcome = "Stale"
+    return response
+
+def refresh_entry(key, query):
+    """Prefetch for the socketserver engines, runs on PREFETCH_EXECUTOR."""
+    try:
+        if RESOLUTION_MODE == "iterative":
+            qname, qtype, _, _ = dnswire.parse_question(query)
+            response = ITERATIVE_RESOLVER.resolve(qname, qtype, dnswire.question_section(query))[0]
+        else:
+            count_upstream_query(UPSTREAM_POOLS, COALESCER)
+            response = forward(query)[0]
+    except (socket.timeout, OSError, dnswire.WireError):
+        response = None
+    if response is None or not cache_answer(key, response):
+        DNS_CACHE.prefetch_failed(key)
+
+async def refresh_entry_async(key, query, pools):
+    """Prefetch for the async engine."""
+    try:
+        if RESOLUTION_MODE == "iterative":
+            qname, qtype, _, _ = dnswire.parse_question(query)
+            loop = asyncio.get_running_loop()
+            response = (await loop.run_in_executor(None, ITERATIVE_RESOLVER.resolve, qname, qtype,
+                                                   dnswire.question_section(query)))[0]
+        else:
+            count_upstream_query(pools, ASYNC_COALESCER)
+            response = (await forward_async(query, pools))[0]
+    except (asyncio.TimeoutError, OSError, dnswire.WireError):
+        response = None
+    if response is None or not cache_answer(key, response):
+        DNS_CACHE.prefetch_failed(key)
+
+def forward(query):
+    """
+    Sends the query upstream with our EDNS(0) buffer size, over TCP again when
+    the answer is truncated (if TCP fails too, the truncated answer is passed
+    on). Returns (response without OPT record, server).
+    """
+    global tcp_fallbacks
+    query = dnswire.set_edns(query)
+    response, server = hedged_query(UPSTREAM_SELECTOR, UPSTREAM_POOLS, query, UPSTREAM_TIMEOUT)
+    if dnswire.unpack_header(response)[1] & dnswire.FLAG_TC and server in TCP_POOLS:
+        tcp_fallbacks += 1
+        try:
+            response = TCP_POOLS[server].query(query, UPSTREAM_TIMEOUT)
+        except OSError as err:
+            print(f"[Forwarder] TCP query to {server} failed: {err!r}")
+    return dnswire.strip_opt(response), server
+
+async def forward_async(query, pools):
+    """Async engine counterpart of forward()."""
+    global tcp_fallbacks
+    query = dnswire.set_edns(query)
+    response, server = await hedged_query_async(UPSTREAM_SELECTOR, pools, query, UPSTREAM_TIMEOUT)
+    if dnswire.unpack_header(response)[1] & dnswire.FLAG_TC and server in TCP_POOLS:
+        tcp_fallbacks += 1
+        try:
+            response = await TCP_POOLS[server].query(query, UPSTREAM_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as err:
+            print(f"[Forwarder] TCP query to {server} failed: {err!r}")
+    return dnswire.strip_opt(response), server
+
+def client_answer(response, query, over_tcp=False):
+    """
+    'response' (without OPT record) the way the client gets it: with our own OPT
+    record if the query had one, and over UDP cut down to a TC answer when it is
+    bigger than the client's buffer (512 bytes without EDNS(0)).
+    """
+    global truncated_answers
+    opt = dnswire.find_opt(query)
+    limit = dnswire.CLASSIC_UDP_SIZE
+    if opt is not None:
+        response = dnswire.add_opt(response)
+        limit = max(opt[1], limit)
+    if not over_tcp and len(response) > limit:
+        truncated_answers += 1
+        response = dnswire.truncated(response)
+        if opt is not None:
+            response = dnswire.add_opt(response)
+    return response
+
+def send_answer(client, response, query, requester_ip):
+    """'client' is the UDP socket / transport, or a dnstcp.StreamReply for TCP clients."""
+    client.sendto(client_answer(response, query, isinstance(client, dnstcp.StreamReply)), requester_ip)
+
+def resolve_iterative(payload, record):
+    """
+    Resolves the query by walking referrals from the root hints and notes the
+    hops in 'record'. Returns the response, None when resolution failed.
+    """
+    qname, qtype, _, _ = dnswire.parse_question(payload)
+    response, hops = ITERATIVE_RESOLVER.resolve(qname, qtype, dnswire.question_section(payload))
+    record.strategy = "Iterative"
+    record.hops = [str(hop) for hop in hops]
+    record.servers_visited = len(hops)
+    if response is None:
+        record.outcome = "Failed"
+        return None
+    record.outcome = "Received"
+    # the client gets its own transaction ID and question bytes back
+    return dnswire.answer_for(payload, response)
+
+def format_cache_stats(stats):
+    return (f"[Cache] entries {stats['entries']} ({stats['bytes']} bytes), hits {stats['hits']}, "
+            f"misses {stats['misses']}, evictions {stats['evictions']}, prefetches {stats['prefetches']}, "
+            f"stale answers {stats['stale_hits']}")
+
+def print_server_report(pools, coalescer):
+    for pool in pools.values():
+        print(format_pool_stats(pool.stats()))
+    print(format_upstream_stats(UPSTREAM_SELECTOR.stats()))
+    print(format_coalescing_stats(coalescer.stats()))
+    print(format_cache_stats(DNS_CACHE.stats()))
+    print(format_negative_stats(NEGATIVE_CACHE.stats()))
+    if SHARED_CACHE is not None:
+        print(format_shared_stats(SHARED_CACHE.stats()))
+    for pool in TCP_POOLS.values():
+        print(dnstcp.format_tcp_stats(pool.stats()))
+    print(f"[TCP] upstream fallbacks {tcp_fallbacks}, truncated answers to clients {truncated_answers}")
+
+def count_upstream_query(pools, coalescer):
+    """Counts upstream queries and prints the upstream report every POOL_REPORT_INTERVAL."""
+    global upstream_queries
+    upstream_queries += 1
+    if upstream_queries % POOL_REPORT_INTERVAL == 0:
+        print_server_report(pools, coalescer)
+
+def coalescing_key(payload, cache_key):
+    """Key shared by identical in-flight queries, None when they are not coalesced."""
+    if not COALESCING_ENABLED:
+        return None
+    if cache_key is not None:
+        return cache_key
+    try:
+        return dnswire.cache_key(payload)
+    except dnswire.WireError:
+        return None
+
+def start_record(payload, timer):
+    """New QueryRecord for the query, None for malformed packets. Ends the parse stage of 'timer'."""
+    requested_domain = ForwardingDNSHandler.extract_domain_name(payload)
+    if not requested_domain:
+        return None
+    try:
+        qtype = dnswire.parse_question(payload)[1]
+    except dnswire.WireError:
+        qtype = 0
+    record = QueryRecord(time.time(), requested_domain, qtype)
+    timer.lap(metrics.PARSE)
+    if METRICS is not None:
+        METRICS.begin()
+    return record
+
+def answer_from_cache(payload, record, timer):
+    """
+    Returns (cache_key, cached_response) and marks a hit in the record. Negative
+    answers and held-down failures come from NEGATIVE_CACHE.
+    """
+    cache_key, cached_response = lookup_cache(payload)
+    if cached_response is not None:
+        record.cache_state = "HIT"
+        record.strategy = "Cache"
+        record.outcome = "Received"
+    elif cache_key is not None and NEGATIVE_CACHE_ENABLED:
+        cached_response = answer_negative(cache_key, payload, record)
+    timer.lap(metrics.CACHE)
+    return cache_key, cached_response
+
+def answer_negative(cache_key, payload, record):
+    negative = NEGATIVE_CACHE.get(cache_key, payload)
+    if negative is None:
+        return None
+    response, kind = negative
+    record.cache_state = "NEGATIVE"
+    record.strategy = "Cache"
+    record.outcome = "Received"
+    if kind == negative_cache.FAILURE:
+        record.outcome = "Failed"
+        # while the name is held down, expired data still beats a SERVFAIL
+        response = serve_stale(cache_key, payload, record) or response
+    return response
+
+def mark_forwarded(record):
+    record.strategy = "Forward (Non-recursive)"
+    record.servers_visited = 1
+
+def finish_record(record, timer):
+    """Stamps the overall time and hands the record to the background log writer."""
+    global queries_served
+    queries_served += 1
+    timer.stop()
+    # from the moment the datagram was read, so queueing in the server counts
+    record.total_ms = timer.stages[metrics.TOTAL] / 1e6
+    QUERY_LOG.log(record)
+    if METRICS is not None:
+        METRICS.finish(timer, record.outcome)
+
+def metric_families():
+    """Cache and upstream counters added to every scrape of the metrics endpoint."""
+    cache = DNS_CACHE.stats()
+    negative = NEGATIVE_CACHE.stats()
+    lookups = cache['hits'] + cache['misses']
+    families = [
+        ('dns_cache_hits_total', 'counter', 'Answers served from the cache.', [({}, cache['hits'])]),
+        ('dns_cache_misses_total', 'counter', 'Cache lookups that missed.', [({}, cache['misses'])]),
+        ('dns_cache_hit_ratio', 'gauge', 'Cache hits per lookup since start.',
+         [({}, cache['hits'] / lookups if lookups else 0.0)]),
+        ('dns_cache_entries', 'gauge', 'Entries in the answer cache.', [({}, cache['entries'])]),
+        ('dns_cache_stale_answers_total', 'counter', 'Expired answers served because the upstream failed.',
+         [({}, cache['stale_hits'])]),
+        ('dns_cache_prefetches_total', 'counter', 'Background refreshes of popular entries.',
+         [({}, cache['prefetches'])]),
+        ('dns_negative_cache_entries', 'gauge', 'NXDOMAIN, NODATA and held-down failure entries.',
+         [({}, negative['entries'])]),
+        ('dns_negative_cache_hits_total', 'counter', 'Queries answered from the negative cache, by kind.',
+         [({'kind': 'nxdomain'}, negative['nxdomain_hits']), ({'kind': 'nxdomain_cut'}, negative['synthesized']),
+          ({'kind': 'nodata'}, negative['nodata_hits']), ({'kind': 'failure'}, negative['failure_hits'])]),
+        ('dns_negative_cache_saved_seconds_total', 'counter', 'Upstream time the negative cache hits saved.',
+         [({}, negative['saved_ms'] / 1000)]),
+        ('dns_truncated_answers_total', 'counter', 'Answers sent with TC because they exceeded the client buffer.',
+         [({}, truncated_answers)]),
+        ('dns_upstream_tcp_fallbacks_total', 'counter', 'Truncated upstream answers fetched again over TCP.',
+         [({}, tcp_fallbacks)]),
+    ]
+    if UPSTREAM_SELECTOR is not None:
+        upstreams = UPSTREAM_SELECTOR.stats()
+        families += [
+            ('dns_upstream_queries_total', 'counter', 'Queries sent to each upstream, hedges and retransmits included.',
+             [({'upstream': u['server']}, u['sent']) for u in upstreams]),
+            ('dns_upstream_errors_total', 'counter', 'Upstream queries that failed or timed out.',
+             [({'upstream': u['server']}, u['failures']) for u in upstreams]),
+            ('dns_upstream_srtt_seconds', 'gauge', 'Smoothed upstream round-trip time.',
+             [({'upstream': u['server']}, u['srtt_ms'] / 1000) for u in upstreams if u['srtt_ms'] is not None]),
+        ]
+    if SHARED_CACHE is not None:
+        shared = SHARED_CACHE.stats()
+        families += [
+            ('dns_shared_cache_hits_total', 'counter', 'Local cache misses answered from the shared tier.',
+             [({}, shared['hits'])]),
+            ('dns_shared_cache_misses_total', 'counter', 'Lookups the shared tier could not answer.',
+             [({}, shared['misses'])]),
+            ('dns_shared_cache_stores_total', 'counter', 'Answers written to the shared tier.',
+             [({}, shared['stores'])]),
+            ('dns_shared_cache_torn_reads_total', 'counter', 'Shared slot reads retried because a write was under way.',
+             [({}, shared['torn_reads'])]),
+        ]
+    return families
+
+def start_metrics(port, socket_path):
+    """Enables the instrumentation and its endpoint, returns the endpoint servers."""
+    global METRICS
+    METRICS = metrics.Metrics()
+    servers = metrics.start_endpoint(METRICS, metric_families, port, socket_path)
+    where = [f"127.0.0.1:{port}/metrics"] if port is not None else []
+    where += [f"unix:{socket_path}"] if socket_path is not None else []
+    print(f"[Metrics] Serving {', '.join(where)}")
+    return servers
 
 class ForwardingDNSHandler(socketserver.BaseRequestHandler):
     """
@@ -19,81 +441,378 @@ class ForwardingDNSHandler(socketserver.BaseRequestHandler):
     This server provides proxy-like or forwarding capability for DNS.
     """
 
-    def extract_domain_name(self, packet):
+    @staticmethod
+    def extract_domain_name(packet):
         """Extracts requested domain from DNS packet."""
         try:
-            # DNS header is 12 bytes long
-            # The query name starts after the header
-            header = packet[:12]
-            question = packet[12:]
-            # Find the end of the QNAME field
-            qname_termination = question.find(b'\x00')
-            raw_qname = question[:qname_termination]
-            # Convert DNS QNAME to dot-separated domain
-            domain_parts = []
-            idx = 0
-            while idx < len(raw_qname):
-                seg_len = raw_qname[idx]
-                idx += 1
-                domain_parts.append(raw_qname[idx: idx + seg_len].decode('utf-8'))
-                idx += seg_len
-            domain_name = ".".join(domain_parts)
-            return domain_name
-        except Exception as err:
+            return dnswire.read_name(packet, 12)[0]
+        except (dnswire.WireError, IndexError) as err:
             print(f"[Forwarder] Failed to parse domain: {err}")
             return None
 
     def handle(self):
-        payload, client_socket = self.request
-        requester_ip = self.client_address
-        log_time = datetime.datetime.now().isoformat()
-        requested_domain = self.extract_domain_name(payload)
+        payload, client_socket, received_ns = self.request
+        serve_query(payload, client_socket, self.client_address, received_ns)
+
+def serve_query(payload, client, requester_ip, received_ns=None):
+    """
+    Answers one query for the socketserver engines and the TCP listener; the
+    answer goes out through client.sendto() (see send_answer).
+    """
+    timer = StageTimer(received_ns)
+    record = start_record(payload, timer)
+    if record is None:
+        return  # Skip malformed queries
+
+    try:
+        cache_key, cached_response = answer_from_cache(payload, record, timer)
+        if cached_response is not None:
+            send_answer(client, cached_response, payload, requester_ip)
+            timer.lap(metrics.SEND)
+            return
 
-        if not requested_domain:
-            return  # Skip malformed queries
+        if RESOLUTION_MODE == "iterative":
+            response = resolve_iterative(payload, record)
+            timer.lap(metrics.UPSTREAM)
+            if response is not None:
+                send_answer(client, response, payload, requester_ip)
+                timer.lap(metrics.SEND)
+                store_in_cache(cache_key, response, timer.stages[metrics.UPSTREAM] / 1e6)
+                timer.lap(metrics.STORE)
+            else:
+                hold_down(cache_key, timer.stages[metrics.UPSTREAM] / 1e6)
+                response = serve_stale(cache_key, payload, record)
+                timer.lap(metrics.CACHE)
+                if response is not None:
+                    send_answer(client, response, payload, requester_ip)
+                    timer.lap(metrics.SEND)
+            return
 
-        print("DNS Query Log (Alternate)")
-        print(f"a. Timestamp: {log_time}")
-        print(f"b. Domain Name: {requested_domain}")
+        # Forward the query to the real DNS servers over the shared socket pools
+        mark_forwarded(record)
 
-        cache_state = "MISS"
+        def fetch(query):
+            count_upstream_query(UPSTREAM_POOLS, COALESCER)
+            return forward(query)
+
+        key = coalescing_key(payload, cache_key)
+        timer.lap(metrics.PARSE)
+        response, record.upstream = fetch(payload) if key is None else COALESCER.query(key, payload, fetch)
+        timer.lap(metrics.UPSTREAM)
+        record.upstream_rtt_ms = timer.stages[metrics.UPSTREAM] / 1e6
+        record.outcome = "Received"
+        send_answer(client, response, payload, requester_ip)
+        timer.lap(metrics.SEND)
+        store_in_cache(cache_key, response, record.upstream_rtt_ms)
+        timer.lap(metrics.STORE)
+    except socket.timeout:
+        timer.lap(metrics.UPSTREAM)
+        record.outcome = "Timeout"
+        hold_down(cache_key, timer.stages[metrics.UPSTREAM] / 1e6)
+        response = serve_stale(cache_key, payload, record)
+        timer.lap(metrics.CACHE)
+        if response is not None:
+            send_answer(client, response, payload, requester_ip)
+            timer.lap(metrics.SEND)
+    except Exception as err:
+        record.outcome = "Error"
+        record.error = str(err)
+    finally:
+        finish_record(record, timer)
+
+async def handle_async(payload, requester_ip, transport, pools, received_ns=None):
+    """Async engine counterpart of serve_query, 'transport' may be a dnstcp.StreamReply."""
+    timer = StageTimer(received_ns)
+    record = start_record(payload, timer)
+    if record is None:
+        return  # Skip malformed queries
+
+    try:
+        cache_key, cached_response = answer_from_cache(payload, record, timer)
+        if cached_response is not None:
+            send_answer(transport, cached_response, payload, requester_ip)
+            timer.lap(metrics.SEND)
+            return
 
-        if cache_state != "HIT":
-            print("i. Cache State: NOT_FOUND")
+        if RESOLUTION_MODE == "iterative":
+            # the iterative walk is blocking, keep it off the event loop
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(None, resolve_iterative, payload, record)
+            timer.lap(metrics.UPSTREAM)
+            if response is not None:
+                send_answer(transport, response, payload, requester_ip)
+                timer.lap(metrics.SEND)
+                store_in_cache(cache_key, response, timer.stages[metrics.UPSTREAM] / 1e6)
+                timer.lap(metrics.STORE)
+            else:
+                hold_down(cache_key, timer.stages[metrics.UPSTREAM] / 1e6)
+                response = serve_stale(cache_key, payload, record)
+                timer.lap(metrics.CACHE)
+                if response is not None:
+                    send_answer(transport, response, payload, requester_ip)
+                    timer.lap(metrics.SEND)
+            return
 
-        #  Recursive resolution logic could go here
-        print("c. Resolution Strategy: Forward (Non-recursive)")
-        # Forward the query to the real DNS server
-        relay_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        relay_socket.settimeout(2.0)
+        mark_forwarded(record)
 
+        async def fetch(query):
+            count_upstream_query(pools, ASYNC_COALESCER)
+            return await forward_async(query, pools)
+
+        key = coalescing_key(payload, cache_key)
+        timer.lap(metrics.PARSE)
+        response, record.upstream = await (fetch(payload) if key is None
+                                           else ASYNC_COALESCER.query(key, payload, fetch))
+        timer.lap(metrics.UPSTREAM)
+        record.upstream_rtt_ms = timer.stages[metrics.UPSTREAM] / 1e6
+        record.outcome = "Received"
+        send_answer(transport, response, payload, requester_ip)
+        timer.lap(metrics.SEND)
+        store_in_cache(cache_key, response, record.upstream_rtt_ms)
+        timer.lap(metrics.STORE)
+    except asyncio.TimeoutError:
+        timer.lap(metrics.UPSTREAM)
+        record.outcome = "Timeout"
+        hold_down(cache_key, timer.stages[metrics.UPSTREAM] / 1e6)
+        response = serve_stale(cache_key, payload, record)
+        timer.lap(metrics.CACHE)
+        if response is not None:
+            send_answer(transport, response, payload, requester_ip)
+            timer.lap(metrics.SEND)
+    except Exception as err:
+        record.outcome = "Error"
+        record.error = str(err)
+    finally:
+        finish_record(record, timer)
+
+class ReceiveTimestampMixin:
+    """Adds the perf_counter_ns read time to the (payload, socket) request, for the queue stage."""
+
+    def get_request(self):
+        (payload, client_socket), client_address = super().get_request()
+        return (payload, client_socket, time.perf_counter_ns()), client_address
+
+def run_sync_server(listen_ip, listen_port, threaded=False, reuse_port=False):
+    """
+    socketserver engines. 'threaded' runs every query in its own thread, which
+    the pool supports since answers are demultiplexed by transaction ID.
+    """
+    global UPSTREAM_SELECTOR, PREFETCH_EXECUTOR
+    UPSTREAM_SELECTOR = UpstreamSelector(UPSTREAM_DNS_SERVERS, HEDGING_ENABLED)
+    for server in UPSTREAM_DNS_SERVERS:
+        UPSTREAM_POOLS[server] = UpstreamSocketPool(server, UPSTREAM_DNS_PORT, UPSTREAM_POOL_SIZE)
+        TCP_POOLS[server] = dnstcp.TCPUpstreamPool(server, UPSTREAM_DNS_PORT)
+    if PREFETCH_ENABLED:
+        PREFETCH_EXECUTOR = ThreadPoolExecutor(PREFETCH_WORKERS)
+        DNS_CACHE.prefetch_hook = lambda key, query: PREFETCH_EXECUTOR.submit(refresh_entry, key, query)
+    server_class = socketserver.ThreadingUDPServer if threaded else socketserver.UDPServer
+    server_class = type(server_class.__name__, (ReceiveTimestampMixin, server_class),
+                        {'allow_reuse_port': reuse_port})
+    tcp_listener = None
+    try:
+        with server_class((listen_ip, listen_port), ForwardingDNSHandler) as server:
+            if TCP_ENABLED:
+                tcp_listener = dnstcp.start_listener(listen_ip, listen_port, serve_query, reuse_port)
+            server.serve_forever()
+    finally:
+        if tcp_listener is not None:
+            tcp_listener.shutdown()
+            tcp_listener.server_close()
+        DNS_CACHE.prefetch_hook = None
+        if PREFETCH_EXECUTOR is not None:
+            PREFETCH_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+        print_server_report(UPSTREAM_POOLS, COALESCER)
+        for pool in list(UPSTREAM_POOLS.values()) + list(TCP_POOLS.values()):
+            pool.close()
+
+def start_prefetch_task(key, query, pools):
+    # the hook is called from DNSCache.get() on the event loop thread
+    task = asyncio.ensure_future(refresh_entry_async(key, query, pools))
+    PREFETCH_TASKS.add(task)
+    task.add_done_callback(PREFETCH_TASKS.discard)
+
+def run_async_server(listen_ip, listen_port, reuse_port=False):
+    global UPSTREAM_SELECTOR
+    UPSTREAM_SELECTOR = UpstreamSelector(UPSTREAM_DNS_SERVERS, HEDGING_ENABLED)
+
+    async def main():
+        pools = {}
+        for server in UPSTREAM_DNS_SERVERS:
+            pools[server] = async_engine.UpstreamPool(server, UPSTREAM_DNS_PORT, UPSTREAM_POOL_SIZE)
+            await pools[server].start()
+            TCP_POOLS[server] = dnstcp.TCPUpstreamPool(server, UPSTREAM_DNS_PORT,
+                                                       connection_class=dnstcp.AsyncTCPUpstreamConnection)
+        if PREFETCH_ENABLED:
+            DNS_CACHE.prefetch_hook = lambda key, query: start_prefetch_task(key, query, pools)
+        tcp_listener = None
         try:
-            send_time = time.time()
-            relay_socket.sendto(payload, (UPSTREAM_DNS_SERVER, UPSTREAM_DNS_PORT))
-            print(f"d. Upstream DNS Contacted: {UPSTREAM_DNS_SERVER}")
-            print("e. Action: Relayed Upstream")
-            response, _ = relay_socket.recvfrom(512)
-            recv_time = time.time()
-            latency = (recv_time - send_time) * 1000
-            print(f"f. Upstream Response: Received")
-            print(f"g. Upstream RTT: {latency:.2f} ms")
-            print(f"h. Overall Time: {latency:.2f} ms")
-            # --- Placeholder: Cache store logic could go here ---
-            client_socket.sendto(response, requester_ip)
-        except socket.timeout:
-            print("f. Upstream Response: Timeout")
-        except Exception as err:
-            print(f"[Forwarder] Error during forwarding: {err}")
+            if TCP_ENABLED:
+                tcp_listener = await dnstcp.serve_async(listen_ip, listen_port, handle_async, pools, reuse_port)
+            await async_engine.serve(listen_ip, listen_port, handle_async, pools, reuse_port)
         finally:
-            relay_socket.close()
-            print("------------------------\n")
+            if tcp_listener is not None:
+                tcp_listener.close()
+            DNS_CACHE.prefetch_hook = None
+            print_server_report(pools, ASYNC_COALESCER)
+            for pool in list(pools.values()) + list(TCP_POOLS.values()):
+                pool.close()
+    asyncio.run(main())
+
+def run_server(engine, listen_ip, listen_port, reuse_port=False):
+    if engine == "async":
+        run_async_server(listen_ip, listen_port, reuse_port)
+    else:
+        run_sync_server(listen_ip, listen_port, threaded=(engine == "threaded"), reuse_port=reuse_port)
+
+def worker_stats():
+    return {
+        'queries': queries_served,
+        'cache_hits': DNS_CACHE.hits,
+        'cache_misses': DNS_CACHE.misses,
+        'prefetches': DNS_CACHE.prefetches,
+        'stale_answers': DNS_CACHE.stale_hits,
+        'shared_hits': SHARED_CACHE.hits if SHARED_CACHE is not None else 0,
+        'negative_hits': (NEGATIVE_CACHE.nxdomain_hits + NEGATIVE_CACHE.synthesized
+                          + NEGATIVE_CACHE.nodata_hits + NEGATIVE_CACHE.failure_hits),
+        'upstream': upstream_queries,
+        'coalesced': COALESCER.coalesced + ASYNC_COALESCER.coalesced,
+    }
+
+def format_worker_stats(stats):
+    return (f"{stats.get('queries', 0)} queries, cache hits {stats.get('cache_hits', 0)} / "
+            f"misses {stats.get('cache_misses', 0)}, prefetches {stats.get('prefetches', 0)}, "
+            f"stale answers {stats.get('stale_answers', 0)}, negative hits {stats.get('negative_hits', 0)}, "
+            f"shared hits {stats.get('shared_hits', 0)}, "
+            f"upstream {stats.get('upstream', 0)}, "
+            f"coalesced {stats.get('coalesced', 0)}")
+
+def run_worker(index, stats_queue, engine, listen_ip, listen_port, log_format, log_file, log_max_bytes):
+    """
+    One --workers process. It is forked from the supervisor, so the settings
+    parsed from the command line are inherited; the log writer thread is not.
+    """
+    global QUERY_LOG
+    # every worker writes (and rotates) its own file, path.w0, path.w1, ...
+    QUERY_LOG = QueryLogger(log_format, f"{log_file}.w{index}" if log_file else None,
+                            max_bytes=log_max_bytes)
+
+    def report():
+        while True:
+            time.sleep(WORKER_STATS_INTERVAL)
+            stats_queue.put((os.getpid(), worker_stats()))
+
+    threading.Thread(target=report, daemon=True).start()
+    metrics_servers = []
+    try:
+        if METRICS_PORT is not None or METRICS_SOCKET is not None:
+            # one endpoint per worker: port + index, socket path.w0, path.w1, ...
+            metrics_servers = start_metrics(None if METRICS_PORT is None else METRICS_PORT + index,
+                                            METRICS_SOCKET and f"{METRICS_SOCKET}.w{index}")
+        run_server(engine, listen_ip, listen_port, reuse_port=True)
+    except KeyboardInterrupt:
+        pass
+    except OSError as err:
+        print(f"!! [Forwarder] worker {index} LAUNCH FAILURE: {err} !!")
+        sys.exit(EXIT_NO_RESTART)
+    finally:
+        stats_queue.put((os.getpid(), worker_stats()))
+        metrics.stop_endpoint(metrics_servers)
+        if CACHE_SNAPSHOT:
+            save_cache_snapshot(f"{CACHE_SNAPSHOT}.w{index}")
+        QUERY_LOG.close()
 
 if __name__ == "__main__":
     LISTEN_IP, LISTEN_PORT = "10.0.0.5", 53
-    print(f"DNS Forwarder active at {LISTEN_IP}:{LISTEN_PORT}...")
+    # --engine sync|threaded|async picks the serving engine, --port lets them run side by side
+    engine = "sync"
+    if '--engine' in sys.argv:
+        engine = sys.argv[sys.argv.index('--engine') + 1]
+    if '--port' in sys.argv:
+        LISTEN_PORT = int(sys.argv[sys.argv.index('--port') + 1])
+    # --upstreams 8.8.8.8,1.1.1.1 replaces the upstream set
+    if '--upstreams' in sys.argv:
+        UPSTREAM_DNS_SERVERS = sys.argv[sys.argv.index('--upstreams') + 1].split(',')
+    # --upstream-port 5300 talks to a local stub_server.py instead of port 53
+    if '--upstream-port' in sys.argv:
+        UPSTREAM_DNS_PORT = int(sys.argv[sys.argv.index('--upstream-port') + 1])
+    if '--listen' in sys.argv:
+        LISTEN_IP = sys.argv[sys.argv.index('--listen') + 1]
+    workers = 1
+    if '--workers' in sys.argv:
+        workers = int(sys.argv[sys.argv.index('--workers') + 1])
+    # --mode forward|iterative picks how cache misses are resolved
+    if '--mode' in sys.argv:
+        RESOLUTION_MODE = sys.argv[sys.argv.index('--mode') + 1]
+    # --log-format text|jsonl|binary, --log-file to write (and rotate) a file instead of stdout;
+    # jsonl and binary need the file, on stdout they would be mixed with the server's own messages
+    log_format = "text"
+    log_file = None
+    if '--log-format' in sys.argv:
+        log_format = sys.argv[sys.argv.index('--log-format') + 1]
+    if '--log-file' in sys.argv:
+        log_file = sys.argv[sys.argv.index('--log-file') + 1]
+    log_max_bytes = querylog.LOG_MAX_BYTES
+    if '--log-max-bytes' in sys.argv:
+        log_max_bytes = int(sys.argv[sys.argv.index('--log-max-bytes') + 1])
+    if '--cache-file' in sys.argv:
+        CACHE_SNAPSHOT = sys.argv[sys.argv.index('--cache-file') + 1]
+    # --cache-backend compact keeps the answers in one preallocated arena, for millions of names
+    cache_backend = "dict"
+    if '--cache-backend' in sys.argv:
+        cache_backend = sys.argv[sys.argv.index('--cache-backend') + 1]
+    if '--cache-max-bytes' in sys.argv:
+        CACHE_MAX_BYTES = int(sys.argv[sys.argv.index('--cache-max-bytes') + 1])
+    # --shared-cache /dev/shm/cr-cache adds the memory-mapped tier shared with other resolver processes
+    shared_cache_path = None
+    if '--shared-cache' in sys.argv:
+        shared_cache_path = sys.argv[sys.argv.index('--shared-cache') + 1]
+    # --metrics-port 9153 / --metrics-socket path serve GET /metrics (Prometheus text)
+    if '--metrics-port' in sys.argv:
+        METRICS_PORT = int(sys.argv[sys.argv.index('--metrics-port') + 1])
+    if '--metrics-socket' in sys.argv:
+        METRICS_SOCKET = sys.argv[sys.argv.index('--metrics-socket') + 1]
+    if (engine not in ("sync", "threaded", "async") or RESOLUTION_MODE not in ("forward", "iterative")
+            or log_format not in ("text", "jsonl", "binary") or (log_format != "text" and not log_file)
+            or cache_backend not in ("dict", "compact") or workers < 1):
+        print(f"Usage: python3 {sys.argv[0]} [--engine sync|threaded|async] [--listen 10.0.0.5] [--port 53] "
+              "[--workers N] [--upstreams a,b,c] [--upstream-port 53] [--mode forward|iterative] [--log-format text|jsonl|binary] [--log-file path] "
+              "[--log-max-bytes N] [--cache-file path] [--cache-backend dict|compact] [--cache-max-bytes N] "
+              "[--shared-cache path] [--metrics-port 9153] [--metrics-socket path]")
+        sys.exit(1)
+    if workers == 1 and (log_format != "text" or log_file):
+        QUERY_LOG.close()
+        QUERY_LOG = QueryLogger(log_format, log_file, max_bytes=log_max_bytes)
+    if cache_backend == "compact":
+        DNS_CACHE = CompactDNSCache(max_bytes=CACHE_MAX_BYTES)
+    else:
+        DNS_CACHE = DNSCache(max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES)
+    if shared_cache_path:
+        SHARED_CACHE = SharedCache(shared_cache_path)
+        print(f"[Shared cache] {'Reusing' if SHARED_CACHE.reused else 'Created'} '{shared_cache_path}' "
+              f"({SHARED_CACHE.entries()} live entries)")
+    if CACHE_SNAPSHOT:
+        load_cache_snapshots(CACHE_SNAPSHOT)
+    print(f"DNS Forwarder active at {LISTEN_IP}:{LISTEN_PORT} ({engine} engine, {RESOLUTION_MODE} mode"
+          f"{f', {workers} workers' if workers > 1 else ''})...")
+    metrics_servers = []
     try:
-        with socketserver.UDPServer((LISTEN_IP, LISTEN_PORT), ForwardingDNSHandler) as server:
-            server.serve_forever()
+        if workers == 1 and (METRICS_PORT is not None or METRICS_SOCKET is not None):
+            metrics_servers = start_metrics(METRICS_PORT, METRICS_SOCKET)
+        if workers > 1:
+            supervisor = Supervisor(workers, run_worker, (engine, LISTEN_IP, LISTEN_PORT,
+                                                          log_format, log_file, log_max_bytes))
+            supervisor.run(format_worker_stats)
+        else:
+            run_server(engine, LISTEN_IP, LISTEN_PORT)
+    except KeyboardInterrupt:
+        pass
     except Exception as err:
         print(f"!! [Forwarder] LAUNCH FAILURE: {err} !!")
         print("!! You may need 'sudo' to execute this script !!")
+    finally:
+        metrics.stop_endpoint(metrics_servers)
+        if CACHE_SNAPSHOT and workers == 1:
+            save_cache_snapshot(CACHE_SNAPSHOT)
+        if SHARED_CACHE is not None:
+            SHARED_CACHE.close()
+        QUERY_LOG.close()
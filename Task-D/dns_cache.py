@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+"""
+TTL-aware answer cache for the forwarder in cr.py.
+
+Answers are kept as raw wire bytes keyed on (qname, qtype, qclass). The offsets
+of every TTL field are remembered at store time, so a hit only has to patch the
+transaction ID and the TTLs in a copy of the bytes - no re-encoding needed.
+
+Hits are counted per entry. A hit on a popular entry in the last part of its
+lifetime calls prefetch_hook(key, query) so the owner can refresh it in the
+background before it expires. Expired entries are kept for STALE_MAX_AGE more
+seconds and can still be served through get_stale() when the upstream fails
+(RFC 8767 serve-stale).
+
+dump() writes the entries to a snapshot file and load() reads them back, aged
+by the wall-clock time in between, so a restarted resolver starts warm.
+"""
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+import dnswire
+
+# default limits, cr.py can override them
+MAX_ENTRIES = 10000
+MAX_BYTES = 8 * 1024 * 1024
+# negative answers (NXDOMAIN / NODATA) are held for a shorter time
+NEGATIVE_TTL_CAP = 300
+# used when a negative answer carries no SOA to take the TTL from
+NEGATIVE_TTL_DEFAULT = 60
+# entries with at least PREFETCH_MIN_HITS hits are refreshed when hit within
+# the last PREFETCH_WINDOW of their lifetime
+PREFETCH_MIN_HITS = 3
+PREFETCH_WINDOW = 0.1
+# RFC 8767: how long past expiry data may still be served, and the TTL it gets
+STALE_MAX_AGE = 24 * 3600
+STALE_ANSWER_TTL = 30
+
+SNAPSHOT_MAGIC = b'DNSSNAP1'
+# wall-clock time of the dump, number of entries
+SNAPSHOT_HEADER = struct.Struct('<dI')
+# age, lifetime, hits, negative, wire length - followed by the wire bytes; the
+# key and the TTL offsets are recovered from the wire on load
+SNAPSHOT_ENTRY = struct.Struct('<ffIBH')
+
+
+def answer_lifetime(response):
+    """
+    (lifetime, ttl_offsets, ttls, negative) for an upstream answer; the
+    lifetime is 0 when the answer must not be cached (TC set, SERVFAIL, TTL 0).
+    """
+    _, flags, _, ancount, _, _ = dnswire.unpack_header(response)
+    rcode = flags & 0x000F
+    if flags & dnswire.FLAG_TC or rcode not in (dnswire.RCODE_NOERROR, dnswire.RCODE_NXDOMAIN):
+        return 0, None, None, False
+    ttl_offsets, ttls, soa_minimum = dnswire.scan_ttls(response)
+    negative = rcode == dnswire.RCODE_NXDOMAIN or ancount == 0
+    if negative:
+        lifetime = soa_minimum if soa_minimum is not None else NEGATIVE_TTL_DEFAULT
+        lifetime = min(lifetime, NEGATIVE_TTL_CAP)
+    else:
+        lifetime = min(ttls) if ttls else 0
+    return lifetime, ttl_offsets, ttls, negative
+
+
+def write_snapshot(path, now, entries):
+    """
+    Writes (stored_at, expires_at, hits, negative, wire) tuples to 'path'
+    (atomically); 'now' is the cache clock. Returns the number written.
+    """
+    chunks = [SNAPSHOT_MAGIC, SNAPSHOT_HEADER.pack(time.time(), len(entries))]
+    for stored_at, expires_at, hits, negative, wire in entries:
+        chunks.append(SNAPSHOT_ENTRY.pack(now - stored_at, expires_at - stored_at, hits, negative, len(wire)))
+        chunks.append(wire)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(b''.join(chunks))
+    os.replace(tmp_path, path)
+    return len(entries)
+
+
+def read_snapshot(path, keep_for):
+    """
+    Yields (key, wire, ttl_offsets, ttls, age, lifetime, hits, negative) for the
+    entries of a snapshot, aged by the time since the dump. Entries older than
+    their lifetime plus 'keep_for' seconds and unreadable ones are skipped.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(SNAPSHOT_MAGIC) or len(data) < len(SNAPSHOT_MAGIC) + SNAPSHOT_HEADER.size:
+        raise ValueError(f"{path} is not a cache snapshot")
+    dumped_at, count = SNAPSHOT_HEADER.unpack_from(data, len(SNAPSHOT_MAGIC))
+    downtime = max(time.time() - dumped_at, 0)
+    pos = len(SNAPSHOT_MAGIC) + SNAPSHOT_HEADER.size
+    for _ in range(count):
+        if pos + SNAPSHOT_ENTRY.size > len(data):
+            break  # truncated file, keep what was read
+        age, lifetime, hits, negative, length = SNAPSHOT_ENTRY.unpack_from(data, pos)
+        pos += SNAPSHOT_ENTRY.size
+        wire = data[pos:pos + length]
+        pos += length
+        age += downtime
+        if len(wire) != length or age >= lifetime + keep_for:
+            continue
+        try:
+            key = dnswire.cache_key(wire)
+            # snapshots from before the resolver added its own OPT records may carry the upstream's
+            wire = dnswire.strip_opt(wire)
+            ttl_offsets, ttls, _ = dnswire.scan_ttls(wire)
+        except (dnswire.WireError, IndexError, struct.error):
+            continue
+        yield key, wire, ttl_offsets, ttls, age, lifetime, hits, bool(negative)
+
+
+class CacheEntry:
+    __slots__ = ('wire', 'ttl_offsets', 'ttls', 'stored_at', 'expires_at', 'negative', 'hits',
+                 'prefetching')
+
+    def __init__(self, wire, ttl_offsets, ttls, stored_at, lifetime, negative):
+        self.wire = wire
+        self.ttl_offsets = ttl_offsets
+        self.ttls = ttls
+        self.stored_at = stored_at
+        self.expires_at = stored_at + lifetime
+        self.negative = negative
+        self.hits = 0
+        self.prefetching = False
+
+
+class DNSCache:
+    """
+    Bounded LRU cache of upstream answers.
+    Both the number of entries and the total size of the cached wire bytes are
+    capped; the least recently used entries are evicted first.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, clock=time.monotonic,
+                 serve_stale=True):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.serve_stale = serve_stale
+        self.prefetch_hook = None
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetches = 0
+        self.stale_hits = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _drop(self, key):
+        entry = self.entries.pop(key)
+        self.size_bytes -= len(entry.wire)
+
+    def get(self, key, query):
+        """
+        Returns a ready-to-send response for 'query' or None on a miss.
+        The cached copy gets the query's transaction ID and question bytes,
+        and every TTL is reduced by the time the entry spent in the cache.
+        """
+        now = self.clock()
+        prefetch = False
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if now >= entry.expires_at:
+                # past expiry the entry is only kept around for get_stale()
+                if not self.serve_stale or now >= entry.expires_at + STALE_MAX_AGE:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            entry.hits += 1
+            lifetime = entry.expires_at - entry.stored_at
+            if (self.prefetch_hook is not None and not entry.prefetching
+                    and entry.hits >= PREFETCH_MIN_HITS
+                    and entry.expires_at - now <= lifetime * PREFETCH_WINDOW):
+                entry.prefetching = prefetch = True
+                self.prefetches += 1
+        if prefetch:
+            self.prefetch_hook(key, query)
+        return self._copy_for(entry, query, entry.ttls, int(now - entry.stored_at))
+
+    def get_stale(self, key, query):
+        """
+        Expired data for 'query' with every TTL set to STALE_ANSWER_TTL, or None.
+        Meant for when the upstream could not be reached (RFC 8767).
+        """
+        if not self.serve_stale:
+            return None
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or now >= entry.expires_at + STALE_MAX_AGE:
+                return None
+            self.stale_hits += 1
+        return self._copy_for(entry, query, [STALE_ANSWER_TTL] * len(entry.ttls), 0)
+
+    def prefetch_failed(self, key):
+        """Lets the next late hit try the refresh again."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry.prefetching = False
+
+    @staticmethod
+    def _copy_for(entry, query, ttls, elapsed):
+        response = bytearray(entry.wire)
+        # question section has the same length in query and answer, copying it
+        # keeps the client's own letter case and transaction ID
+        question_end = dnswire.skip_name(query, 12) + 4
+        response[:2] = query[:2]
+        response[12:question_end] = query[12:question_end]
+        dnswire.patch_ttls(response, entry.ttl_offsets, ttls, elapsed)
+        return bytes(response)
+
+    def put(self, key, response):
+        """Stores an upstream answer, returns the lifetime used (0 if not cached)."""
+        lifetime, ttl_offsets, ttls, negative = answer_lifetime(response)
+        if lifetime <= 0 or len(response) > self.max_bytes:
+            return 0
+        entry = CacheEntry(bytes(response), ttl_offsets, ttls, self.clock(), lifetime, negative)
+        with self.lock:
+            if key in self.entries:
+                # a refresh keeps the popularity the entry has earned
+                entry.hits = self.entries[key].hits
+                self._drop(key)
+            self.entries[key] = entry
+            self.size_bytes += len(entry.wire)
+            while len(self.entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+        return lifetime
+
+    def dump(self, path):
+        """Writes every entry to 'path' (atomically), least recently used first."""
+        now = self.clock()
+        with self.lock:
+            entries = [(e.stored_at, e.expires_at, e.hits, e.negative, e.wire) for e in self.entries.values()]
+        return write_snapshot(path, now, entries)
+
+    def load(self, path):
+        """
+        Adds the entries of a snapshot written by dump(), aged by the time since
+        the dump. Entries too old to serve are skipped, as are keys already cached.
+        Returns the number of entries loaded.
+        """
+        now = self.clock()
+        keep_for = STALE_MAX_AGE if self.serve_stale else 0
+        loaded = 0
+        for key, wire, ttl_offsets, ttls, age, lifetime, hits, negative in read_snapshot(path, keep_for):
+            entry = CacheEntry(wire, ttl_offsets, ttls, now - age, lifetime, negative)
+            entry.hits = hits
+            with self.lock:
+                if key in self.entries:
+                    continue
+                self.entries[key] = entry
+                self.size_bytes += len(wire)
+                while len(self.entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                    self._drop(next(iter(self.entries)))
+                    self.evictions += 1
+            loaded += 1
+        return loaded
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'prefetches': self.prefetches,
+            'stale_hits': self.stale_hits,
+        }
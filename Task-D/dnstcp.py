@@ -0,0 +1,371 @@
+#!/usr/bin/python3
+"""
+DNS over TCP for the forwarder (RFC 7766), for answers that do not fit in UDP.
+
+Client side: a listener next to the UDP one. Every message on a connection is
+answered as it arrives, so a client may pipeline several queries; connections
+idle for TCP_IDLE_TIMEOUT seconds are closed. The query handlers reply through a
+StreamReply, which frames the answer instead of sending a datagram.
+
+Upstream side: a few persistent connections per upstream server, opened on
+first use and again whenever the server has closed an idle one. Queries are
+pipelined on them under random IDs and the answers, which may come back in any
+order, are matched by ID and question like on the UDP pools.
+"""
+import asyncio
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+from dnswire import question_section
+
+TCP_POOL_SIZE = 2
+CONNECT_TIMEOUT = 2.0
+TCP_IDLE_TIMEOUT = 10.0
+LENGTH = struct.Struct('!H')
+
+
+def frame(message):
+    """Message with its two-byte length prefix."""
+    return LENGTH.pack(len(message)) + message
+
+
+def recv_exactly(sock, size):
+    """Reads 'size' bytes from a blocking socket, raises ConnectionError at EOF."""
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise ConnectionError("connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def read_message(sock):
+    return recv_exactly(sock, LENGTH.unpack(recv_exactly(sock, 2))[0])
+
+
+class StreamReply:
+    """Stands in for the UDP socket / transport handed to the query handlers."""
+
+    def __init__(self, write):
+        self.write = write
+
+    def sendto(self, data, addr):
+        self.write(frame(data))
+
+
+class _Waiter:
+    __slots__ = ('question', 'event', 'response')
+
+    def __init__(self, question):
+        self.question = question
+        self.event = threading.Event()
+        self.response = None
+
+
+class _Stream:
+    """One live upstream connection and the queries waiting on it."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.waiters = {}
+        self.used = False
+
+
+class TCPUpstreamConnection:
+    """Threaded engines: one persistent connection with a receiver thread."""
+
+    def __init__(self, index, server, port):
+        self.index = index
+        self.server = server
+        self.port = port
+        self.lock = threading.Lock()
+        self.stream = None
+        self.connects = 0
+        self.sent = 0
+        self.received = 0
+        self.timeouts = 0
+
+    def in_flight(self):
+        stream = self.stream
+        return len(stream.waiters) if stream is not None else 0
+
+    def is_open(self):
+        return self.stream is not None
+
+    def _connect(self):
+        sock = socket.create_connection((self.server, self.port), CONNECT_TIMEOUT)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.stream = _Stream(sock)
+        self.connects += 1
+        threading.Thread(target=self._receive_loop, args=(self.stream,), daemon=True).start()
+
+    def _receive_loop(self, stream):
+        try:
+            while True:
+                data = read_message(stream.sock)
+                if len(data) < 12:
+                    continue
+                qid = LENGTH.unpack_from(data)[0]
+                with self.lock:
+                    waiter = stream.waiters.get(qid)
+                    if waiter is None or data[12:12 + len(waiter.question)] != waiter.question:
+                        continue
+                    del stream.waiters[qid]
+                    self.received += 1
+                waiter.response = data
+                waiter.event.set()
+        except OSError:
+            pass
+        with self.lock:
+            if self.stream is stream:
+                self.stream = None
+            waiters = list(stream.waiters.values())
+            stream.waiters.clear()
+        stream.sock.close()
+        # queries still waiting learn from the missing response that the connection went away
+        for waiter in waiters:
+            waiter.event.set()
+
+    def query(self, payload, timeout):
+        """Returns the answer with the ID of 'payload'; raises socket.timeout or ConnectionError."""
+        deadline = time.monotonic() + timeout
+        while True:
+            waiter = _Waiter(question_section(payload))
+            with self.lock:
+                if self.stream is None:
+                    self._connect()
+                stream = self.stream
+                reused = stream.used
+                stream.used = True
+                qid = random.getrandbits(16)
+                while qid in stream.waiters:
+                    qid = random.getrandbits(16)
+                stream.waiters[qid] = waiter
+                self.sent += 1
+                try:
+                    stream.sock.sendall(frame(LENGTH.pack(qid) + payload[2:]))
+                except OSError:
+                    del stream.waiters[qid]
+                    stream.sock.close()
+                    self.stream = None
+                    if reused:
+                        continue
+                    raise
+            if not waiter.event.wait(max(deadline - time.monotonic(), 0)):
+                with self.lock:
+                    stream.waiters.pop(qid, None)
+                    self.timeouts += 1
+                raise socket.timeout("upstream TCP query timed out")
+            if waiter.response is not None:
+                return payload[:2] + waiter.response[2:]
+            # the server closed a connection it considered idle, try once more on a new one
+            if not reused:
+                raise ConnectionError("upstream closed the TCP connection")
+
+    def close(self):
+        with self.lock:
+            stream, self.stream = self.stream, None
+        if stream is not None:
+            try:
+                # wakes the receiver thread, close() alone leaves it blocked in recv()
+                stream.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            stream.sock.close()
+
+
+class AsyncTCPUpstreamConnection:
+    """Async engine: one persistent connection read by its own task."""
+
+    def __init__(self, index, server, port):
+        self.index = index
+        self.server = server
+        self.port = port
+        self.lock = asyncio.Lock()
+        self.writer = None
+        self.pending = {}
+        self.used = False
+        self.reader_task = None
+        self.connects = 0
+        self.sent = 0
+        self.received = 0
+        self.timeouts = 0
+
+    def in_flight(self):
+        return len(self.pending)
+
+    def is_open(self):
+        return self.writer is not None
+
+    async def _connect(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.server, self.port),
+                                                CONNECT_TIMEOUT)
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.writer = writer
+        self.pending = {}
+        self.used = False
+        self.connects += 1
+        self.reader_task = asyncio.ensure_future(self._receive_loop(reader, writer, self.pending))
+
+    async def _receive_loop(self, reader, writer, pending):
+        try:
+            while True:
+                data = await reader.readexactly(LENGTH.unpack(await reader.readexactly(2))[0])
+                if len(data) < 12:
+                    continue
+                qid = LENGTH.unpack_from(data)[0]
+                entry = pending.get(qid)
+                if entry is None or data[12:12 + len(entry[0])] != entry[0]:
+                    continue
+                del pending[qid]
+                self.received += 1
+                if not entry[1].done():
+                    entry[1].set_result(data)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            if self.writer is writer:
+                self.writer = None
+            writer.close()
+            for _, future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("upstream closed the TCP connection"))
+            pending.clear()
+
+    async def query(self, payload, timeout):
+        """Returns the answer with the ID of 'payload'; raises asyncio.TimeoutError or ConnectionError."""
+        deadline = time.monotonic() + timeout
+        while True:
+            async with self.lock:
+                if self.writer is None:
+                    await self._connect()
+            pending = self.pending
+            reused = self.used
+            self.used = True
+            qid = random.getrandbits(16)
+            while qid in pending:
+                qid = random.getrandbits(16)
+            future = asyncio.get_running_loop().create_future()
+            pending[qid] = (question_section(payload), future)
+            self.sent += 1
+            self.writer.write(frame(LENGTH.pack(qid) + payload[2:]))
+            try:
+                response = await asyncio.wait_for(future, max(deadline - time.monotonic(), 0))
+                return payload[:2] + response[2:]
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise
+            except ConnectionError:
+                if not reused:
+                    raise
+            finally:
+                entry = pending.get(qid)
+                if entry is not None and entry[1] is future:
+                    del pending[qid]
+
+    def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class TCPUpstreamPool:
+    """
+    TCP_POOL_SIZE connections to one upstream; a query goes to the one with the
+    fewest in flight. 'connection_class' picks the threaded or the async kind.
+    """
+
+    def __init__(self, server, port=53, size=TCP_POOL_SIZE, connection_class=TCPUpstreamConnection):
+        self.server = server
+        self.connections = [connection_class(i, server, port) for i in range(size)]
+
+    def query(self, payload, timeout):
+        """A blocking call or a coroutine, depending on the connection class."""
+        return min(self.connections, key=lambda c: c.in_flight()).query(payload, timeout)
+
+    def stats(self):
+        return {
+            'server': self.server,
+            'open': sum(1 for c in self.connections if c.is_open()),
+            'size': len(self.connections),
+            'connects': sum(c.connects for c in self.connections),
+            'sent': sum(c.sent for c in self.connections),
+            'received': sum(c.received for c in self.connections),
+            'timeouts': sum(c.timeouts for c in self.connections),
+        }
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+
+
+def format_tcp_stats(stats):
+    return (f"[TCP] {stats['server']}: connections {stats['open']}/{stats['size']} open, "
+            f"{stats['connects']} opened, sent {stats['sent']}, received {stats['received']}, "
+            f"timeouts {stats['timeouts']}")
+
+
+class StreamHandler(socketserver.BaseRequestHandler):
+    """Threaded listener: answers every message on the connection in order."""
+
+    def handle(self):
+        self.request.settimeout(TCP_IDLE_TIMEOUT)
+        reply = StreamReply(self.request.sendall)
+        while True:
+            try:
+                payload = read_message(self.request)
+            except OSError:
+                return  # closed by the client or idle for too long
+            self.server.answer(payload, reply, self.client_address, time.perf_counter_ns())
+
+
+class TCPListener(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start_listener(listen_ip, listen_port, answer, reuse_port=False):
+    """
+    Serves TCP clients from a background thread; answer(payload, reply,
+    client_addr, received_ns) is the query handler. Stop with shutdown().
+    """
+    server_class = type('TCPListener', (TCPListener,), {'allow_reuse_port': reuse_port})
+    server = server_class((listen_ip, listen_port), StreamHandler)
+    server.answer = answer
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def serve_async(listen_ip, listen_port, handler, pools, reuse_port=False):
+    """
+    Async listener, every message becomes a task of the async engine's
+    handler(payload, client_addr, reply, pools, received_ns). Returns the asyncio server.
+    """
+
+    async def connection(reader, writer):
+        peer = writer.get_extra_info('peername')
+        reply = StreamReply(writer.write)
+        tasks = set()
+        try:
+            while True:
+                length = LENGTH.unpack(await asyncio.wait_for(reader.readexactly(2), TCP_IDLE_TIMEOUT))[0]
+                payload = await asyncio.wait_for(reader.readexactly(length), TCP_IDLE_TIMEOUT)
+                task = asyncio.ensure_future(handler(payload, peer, reply, pools, time.perf_counter_ns()))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            # queries read before the client closed its side still get their answers
+            if tasks:
+                await asyncio.wait(tasks)
+            writer.close()
+
+    return await asyncio.start_server(connection, listen_ip, listen_port, reuse_port=reuse_port or None)
@@ -0,0 +1,345 @@
+#!/usr/bin/python3
+"""
+DNS wire-format helpers shared by the resolver and the benchmark tools.
+
+Everything works on offsets into the original packet with struct.unpack_from
+(and memoryview where names are compressed), so walking a message does not
+slice it into intermediate bytes objects; the only copy made is the bytes of a
+name that is actually decoded. Names are followed through compression pointers
+and labels are walked by their length byte (a zero byte inside a label is fine). Responses are
+modified in place on a bytearray: patch_id() and patch_ttls().
+"""
+import socket
+import struct
+
+HEADER = struct.Struct('!HHHHHH')
+QUESTION_TAIL = struct.Struct('!HH')
+RR_FIXED = struct.Struct('!HHIH')
+U16 = struct.Struct('!H')
+U32 = struct.Struct('!I')
+
+TYPE_A = 1
+TYPE_NS = 2
+TYPE_CNAME = 5
+TYPE_SOA = 6
+TYPE_PTR = 12
+TYPE_MX = 15
+TYPE_TXT = 16
+TYPE_AAAA = 28
+TYPE_OPT = 41
+CLASS_IN = 1
+
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+
+FLAG_QR = 0x8000
+FLAG_AA = 0x0400
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+FLAG_RA = 0x0080
+
+# a name can hold at most 127 labels, more pointer jumps than that is a loop
+MAX_POINTER_JUMPS = 128
+
+# largest UDP answer a client without EDNS(0) accepts (RFC 1035)
+CLASSIC_UDP_SIZE = 512
+# UDP payload size advertised in our OPT records, small enough to never be
+# fragmented on an IPv6 path (DNS flag day 2020)
+EDNS_PAYLOAD_SIZE = 1232
+
+
+class WireError(ValueError):
+    """Raised for malformed or truncated messages."""
+
+
+def unpack_header(buf):
+    """Returns (id, flags, qdcount, ancount, nscount, arcount)."""
+    if len(buf) < 12:
+        raise WireError("message shorter than the DNS header")
+    return HEADER.unpack_from(buf, 0)
+
+
+def rcode(buf):
+    return U16.unpack_from(buf, 2)[0] & 0x000F
+
+
+def skip_name(buf, off):
+    """Returns the offset just past the (possibly compressed) name at 'off'."""
+    try:
+        while True:
+            length = buf[off]
+            if length == 0:
+                return off + 1
+            if length & 0xC0 == 0xC0:
+                # a compression pointer is two bytes and always ends the name
+                return off + 2
+            off += length + 1
+    except IndexError:
+        raise WireError("name runs past the end of the message") from None
+
+
+def read_name(buf, off):
+    """
+    Decodes the name at 'off', following compression pointers.
+    Returns (name, offset after the name in the original position).
+    """
+    # fast path: an uncompressed name is copied once and its length bytes
+    # (except the first) are turned into dots
+    start = off
+    dots = []
+    try:
+        length = buf[off]
+        while 0 < length < 0x40:
+            dots.append(off)
+            off += length + 1
+            length = buf[off]
+    except IndexError:
+        raise WireError("name runs past the end of the message") from None
+    if length == 0:
+        raw = bytearray(buf[start + 1:off])
+        for dot in dots[1:]:
+            raw[dot - start - 1] = 0x2E
+        return raw.decode('ascii', 'backslashreplace'), off + 1
+    return _read_compressed_name(buf, start)
+
+
+def _read_compressed_name(buf, off):
+    view = memoryview(buf)
+    labels = []
+    end = None
+    jumps = 0
+    try:
+        while True:
+            length = view[off]
+            if length & 0xC0 == 0xC0:
+                if end is None:
+                    end = off + 2
+                jumps += 1
+                if jumps > MAX_POINTER_JUMPS:
+                    raise WireError("compression pointer loop")
+                off = ((length & 0x3F) << 8) | view[off + 1]
+                continue
+            if length & 0xC0:
+                raise WireError("unsupported label type")
+            if length == 0:
+                break
+            if off + 1 + length > len(view):
+                raise WireError("label runs past the end of the message")
+            labels.append(view[off + 1:off + 1 + length])
+            off += length + 1
+    except IndexError:
+        raise WireError("name runs past the end of the message") from None
+    name = b'.'.join(labels).decode('ascii', 'backslashreplace')
+    return name, (end if end is not None else off + 1)
+
+
+def encode_name(name):
+    """'www.example.com' -> uncompressed wire format labels."""
+    out = bytearray()
+    for label in name.strip('.').split('.'):
+        if label:
+            raw = label.encode('ascii')
+            if len(raw) > 63:
+                raise WireError(f"label too long: {label}")
+            out.append(len(raw))
+            out += raw
+    out.append(0)
+    return bytes(out)
+
+
+def parse_question(buf, off=12):
+    """Returns (qname, qtype, qclass, offset after the question)."""
+    qname, off = read_name(buf, off)
+    if off + 4 > len(buf):
+        raise WireError("question runs past the end of the message")
+    qtype, qclass = QUESTION_TAIL.unpack_from(buf, off)
+    return qname, qtype, qclass, off + 4
+
+
+def iter_questions(buf):
+    """Yields (qname, qtype, qclass) for every question in the message."""
+    off = 12
+    for _ in range(unpack_header(buf)[2]):
+        qname, qtype, qclass, off = parse_question(buf, off)
+        yield qname, qtype, qclass
+
+
+def question_end(buf):
+    """Offset just past the last question, i.e. where the answer section starts."""
+    off = 12
+    for _ in range(unpack_header(buf)[2]):
+        off = skip_name(buf, off) + 4
+    return off
+
+
+def question_section(buf):
+    """Raw bytes of the first question, used to match answers to queries."""
+    return bytes(memoryview(buf)[12:skip_name(buf, 12) + 4])
+
+
+def answer_for(query, response):
+    """
+    Copy of 'response' carrying the transaction ID and question bytes of
+    'query', for handing one answer to a client that asked the same question.
+    """
+    end = skip_name(query, 12) + 4
+    return bytes(query[:2]) + bytes(response[2:12]) + bytes(query[12:end]) + bytes(response[end:])
+
+
+def qname_from_query(buf):
+    """Domain name of the first question, or None if the packet is malformed."""
+    try:
+        return read_name(buf, 12)[0]
+    except (WireError, IndexError):
+        return None
+
+
+def cache_key(buf):
+    """(qname, qtype, qclass) of the first question with the name lower-cased."""
+    qname, qtype, qclass, _ = parse_question(buf)
+    return qname.lower(), qtype, qclass
+
+
+def iter_records(buf):
+    """
+    Yields (section, name_off, rtype, rclass, ttl, ttl_off, rdata_off, rdlength)
+    for every resource record; section is 0 answer, 1 authority, 2 additional.
+    Names are not decoded, call read_name(buf, name_off) when needed.
+    """
+    _, _, qdcount, ancount, nscount, arcount = unpack_header(buf)
+    off = 12
+    for _ in range(qdcount):
+        off = skip_name(buf, off) + 4
+    size = len(buf)
+    for section, count in enumerate((ancount, nscount, arcount)):
+        for _ in range(count):
+            name_off = off
+            off = skip_name(buf, off)
+            if off + 10 > size:
+                raise WireError("record runs past the end of the message")
+            rtype, rclass, ttl, rdlength = RR_FIXED.unpack_from(buf, off)
+            rdata_off = off + 10
+            off = rdata_off + rdlength
+            if off > size:
+                raise WireError("rdata runs past the end of the message")
+            yield section, name_off, rtype, rclass, ttl, rdata_off - 6, rdata_off, rdlength
+
+
+def scan_ttls(buf):
+    """
+    Returns (ttl_offsets, ttls, soa_minimum) for every record except OPT, whose
+    TTL field carries EDNS flags. soa_minimum is min(SOA TTL, SOA MINIMUM) as
+    used for negative caching, None if there is no SOA.
+    """
+    offsets, ttls = [], []
+    soa_minimum = None
+    for _, _, rtype, _, ttl, ttl_off, rdata_off, rdlength in iter_records(buf):
+        if rtype == TYPE_OPT:
+            continue
+        offsets.append(ttl_off)
+        ttls.append(ttl)
+        if rtype == TYPE_SOA:
+            # MINIMUM is the last 32-bit field of the SOA rdata
+            soa_minimum = min(ttl, U32.unpack_from(buf, rdata_off + rdlength - 4)[0])
+    return offsets, ttls, soa_minimum
+
+
+def expand_rdata(buf, rtype, off, rdlength):
+    """Rdata with any embedded (compressed) names written out uncompressed."""
+    if rtype in (TYPE_NS, TYPE_CNAME, TYPE_PTR):
+        return encode_name(read_name(buf, off)[0])
+    if rtype == TYPE_MX:
+        return bytes(buf[off:off + 2]) + encode_name(read_name(buf, off + 2)[0])
+    if rtype == TYPE_SOA:
+        mname, nxt = read_name(buf, off)
+        rname, nxt = read_name(buf, nxt)
+        return encode_name(mname) + encode_name(rname) + bytes(buf[nxt:off + rdlength])
+    return bytes(buf[off:off + rdlength])
+
+
+def rdata_target(buf, rtype, off, rdlength):
+    """Decoded NS/CNAME target name or A address, None for other types."""
+    if rtype in (TYPE_NS, TYPE_CNAME):
+        return read_name(buf, off)[0].lower()
+    if rtype == TYPE_A and rdlength == 4:
+        return socket.inet_ntoa(bytes(buf[off:off + 4]))
+    return None
+
+
+def patch_id(buf, qid):
+    """Writes the transaction ID into a bytearray in place."""
+    U16.pack_into(buf, 0, qid)
+
+
+def patch_ttls(buf, offsets, ttls, elapsed=0):
+    """Rewrites TTL fields in place, each reduced by 'elapsed' seconds (not below 0)."""
+    pack_into = U32.pack_into
+    for off, ttl in zip(offsets, ttls):
+        pack_into(buf, off, ttl - elapsed if ttl > elapsed else 0)
+
+
+def build_query(qid, qname, qtype=TYPE_A, recursion_desired=True, qclass=CLASS_IN):
+    flags = FLAG_RD if recursion_desired else 0
+    return HEADER.pack(qid, flags, 1, 0, 0, 0) + encode_name(qname) + QUESTION_TAIL.pack(qtype, qclass)
+
+
+def build_rr(name, rtype, rclass, ttl, rdata):
+    return encode_name(name) + RR_FIXED.pack(rtype, rclass, ttl, len(rdata)) + rdata
+
+
+def find_opt(buf):
+    """(offset, advertised UDP payload size) of the OPT record, None without EDNS(0)."""
+    if unpack_header(buf)[5] == 0:
+        return None
+    for section, name_off, rtype, rclass, _, _, _, _ in iter_records(buf):
+        if section == 2 and rtype == TYPE_OPT:
+            # the owner of an OPT record is the root, its class the payload size
+            return name_off, rclass
+    return None
+
+
+def add_opt(buf, size=EDNS_PAYLOAD_SIZE):
+    """Copy of a message without OPT record with one advertising 'size' appended."""
+    out = bytearray(buf)
+    U16.pack_into(out, 10, unpack_header(buf)[5] + 1)
+    out += b'\x00' + RR_FIXED.pack(TYPE_OPT, size, 0, 0)
+    return bytes(out)
+
+
+def set_edns(buf, size=EDNS_PAYLOAD_SIZE):
+    """Copy of a query advertising 'size' as its UDP payload size, an OPT record is added if needed."""
+    opt = find_opt(buf)
+    if opt is None:
+        return add_opt(buf, size)
+    out = bytearray(buf)
+    U16.pack_into(out, opt[0] + 3, size)
+    return bytes(out)
+
+
+def strip_opt(buf):
+    """
+    Copy of the message without its OPT record (EDNS(0) is hop-by-hop), 'buf'
+    itself if there is none. Records after the OPT are written out without
+    compression, as pointers into them would move.
+    """
+    if unpack_header(buf)[5] == 0:
+        return buf
+    records = list(iter_records(buf))
+    for index, (section, name_off, rtype, _, _, _, rdata_off, rdlength) in enumerate(records):
+        if section == 2 and rtype == TYPE_OPT:
+            break
+    else:
+        return buf
+    out = bytearray(buf[:name_off])
+    for _, tail_off, tail_type, tail_class, ttl, _, tail_rdata, tail_length in records[index + 1:]:
+        out += build_rr(read_name(buf, tail_off)[0], tail_type, tail_class, ttl,
+                        expand_rdata(buf, tail_type, tail_rdata, tail_length))
+    U16.pack_into(out, 10, unpack_header(buf)[5] - 1)
+    return bytes(out)
+
+
+def truncated(buf):
+    """Header and question of the message with TC set and no records, for answers too big for the client."""
+    qid, flags, qdcount, _, _, _ = unpack_header(buf)
+    return HEADER.pack(qid, flags | FLAG_TC, qdcount, 0, 0, 0) + bytes(buf[12:question_end(buf)])
@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+"""
+Iterative resolution (Root -> TLD -> Authoritative) for cr.py --mode iterative.
+
+Queries are sent with RD=0 starting at the root hints and referrals are followed
+using their glue records. Delegations (NS names + glue addresses) are cached on
+their own, separate from final answers, so that e.g. a second lookup under .com
+starts directly at the .com servers. Every server contacted is recorded as a Hop
+with its stage and round-trip time. Queries advertise an EDNS(0) buffer and a
+truncated answer is asked again over TCP.
+"""
+import random
+import socket
+import threading
+import time
+import dnstcp
+import dnswire
+
+# IPv4 addresses of the 13 root servers (a.root-servers.net .. m.root-servers.net)
+ROOT_HINTS = [
+    "198.41.0.4", "170.247.170.2", "192.33.4.12", "199.7.91.13",
+    "192.203.230.10", "192.5.5.241", "192.112.36.4", "198.97.190.53",
+    "192.36.148.17", "192.58.128.30", "193.0.14.129", "199.7.83.42",
+    "202.12.27.33",
+]
+
+HOP_TIMEOUT = 2.0
+MAX_HOPS = 30
+MAX_CNAME_CHAIN = 8
+# how deep we go resolving NS names that came without glue
+MAX_NS_DEPTH = 4
+
+
+class Record:
+    __slots__ = ('name', 'rtype', 'rclass', 'ttl', 'rdata', 'target')
+
+    def __init__(self, name, rtype, rclass, ttl, rdata, target):
+        self.name = name
+        self.rtype = rtype
+        self.rclass = rclass
+        self.ttl = ttl
+        self.rdata = rdata      # uncompressed rdata bytes
+        self.target = target    # decoded name/address for NS, CNAME and A
+
+    def to_wire(self):
+        return dnswire.build_rr(self.name, self.rtype, self.rclass, self.ttl, self.rdata)
+
+
+def parse_response(buf):
+    """Returns (flags, answers, authority, additional) as lists of Record."""
+    flags = dnswire.unpack_header(buf)[1]
+    sections = ([], [], [])
+    for section, name_off, rtype, rclass, ttl, _, rdata_off, rdlength in dnswire.iter_records(buf):
+        if rtype == dnswire.TYPE_OPT:
+            continue
+        sections[section].append(Record(
+            dnswire.read_name(buf, name_off)[0].lower(), rtype, rclass, ttl,
+            dnswire.expand_rdata(buf, rtype, rdata_off, rdlength),
+            dnswire.rdata_target(buf, rtype, rdata_off, rdlength)))
+    return (flags,) + sections
+
+
+def stage_for_zone(zone):
+    if zone == '':
+        return "Root"
+    if '.' not in zone:
+        return "TLD"
+    return "Authoritative"
+
+
+def is_subdomain(name, zone):
+    return zone == '' or name == zone or name.endswith('.' + zone)
+
+
+class Hop:
+    __slots__ = ('stage', 'zone', 'server', 'outcome', 'rtt_ms')
+
+    def __init__(self, stage, zone, server, outcome, rtt_ms):
+        self.stage = stage
+        self.zone = zone
+        self.server = server
+        self.outcome = outcome
+        self.rtt_ms = rtt_ms
+
+    def __str__(self):
+        return (f"Stage: {self.stage} | Zone: {self.zone or '.'} | Server: {self.server} | "
+                f"Response: {self.outcome} | RTT: {self.rtt_ms:.2f} ms")
+
+
+class DelegationCache:
+    """zone -> (NS names, glue addresses), kept apart from the answer cache."""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.zones = {}
+        self.lock = threading.Lock()
+
+    def put(self, zone, ns_names, addresses, ttl):
+        with self.lock:
+            self.zones[zone] = (ns_names, addresses, self.clock() + ttl)
+
+    def closest(self, qname):
+        """Returns (zone, ns_names, addresses) of the deepest usable delegation for qname."""
+        labels = qname.split('.') if qname else []
+        now = self.clock()
+        with self.lock:
+            for i in range(len(labels)):
+                zone = '.'.join(labels[i:])
+                entry = self.zones.get(zone)
+                if entry is None:
+                    continue
+                if now >= entry[2]:
+                    del self.zones[zone]
+                    continue
+                return zone, entry[0], entry[1]
+        return '', [], list(ROOT_HINTS)
+
+    def __len__(self):
+        return len(self.zones)
+
+
+class IterativeResolver:
+
+    def __init__(self, delegations=None, timeout=HOP_TIMEOUT):
+        self.delegations = delegations if delegations is not None else DelegationCache()
+        self.timeout = timeout
+
+    def _ask(self, server, qname, qtype):
+        """
+        One RD=0 query over UDP, returns the raw response or None on timeout.
+        A truncated answer is replaced by the one over TCP when that works.
+        """
+        qid = random.getrandbits(16)
+        query = dnswire.set_edns(dnswire.build_query(qid, qname, qtype, recursion_desired=False))
+        question_end = dnswire.question_end(query)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect((server, 53))
+            sock.send(query)
+            deadline = time.monotonic() + self.timeout
+            while True:
+                data = sock.recv(4096)
+                # accept only the answer to our own question
+                if data[:2] == query[:2] and data[12:question_end].lower() == query[12:question_end].lower():
+                    break
+                sock.settimeout(max(deadline - time.monotonic(), 0.001))
+        except (socket.timeout, OSError):
+            return None
+        finally:
+            sock.close()
+        if dnswire.unpack_header(data)[1] & dnswire.FLAG_TC:
+            return self._ask_tcp(server, query) or data
+        return data
+
+    def _ask_tcp(self, server, query):
+        try:
+            with socket.create_connection((server, 53), self.timeout) as sock:
+                sock.sendall(dnstcp.frame(query))
+                data = dnstcp.read_message(sock)
+        except OSError:
+            return None
+        return data if data[:2] == query[:2] else None
+
+    def resolve(self, qname, qtype=dnswire.TYPE_A, question=None):
+        """
+        Returns (response, hops). 'response' is a full DNS message without a
+        meaningful ID (the caller patches the client's) or None on failure.
+        'question' is the client's raw question section; it is copied into the
+        response as is, since re-encoding the decoded qname may change its length.
+        """
+        if question is None:
+            question = dnswire.encode_name(qname) + dnswire.QUESTION_TAIL.pack(qtype, dnswire.CLASS_IN)
+        hops = []
+        answers = []
+        name = qname.lower().rstrip('.')
+        for _ in range(MAX_CNAME_CHAIN):
+            result = self._resolve_name(name, qtype, hops, 0)
+            if result is None:
+                return None, hops
+            rcode, final_answers, authority = result
+            answers += final_answers
+            # chase a CNAME when the answer does not already contain the target
+            cname = next((r for r in final_answers if r.rtype == dnswire.TYPE_CNAME and r.name == name), None)
+            if (cname is None or qtype == dnswire.TYPE_CNAME or
+                    any(r.rtype == qtype for r in final_answers)):
+                return self._assemble(question, rcode, answers, authority), hops
+            name = cname.target
+        return None, hops
+
+    def _resolve_name(self, name, qtype, hops, depth):
+        """Walks referrals for one name, returns (rcode, answers, authority) or None."""
+        zone, _, servers = self.delegations.closest(name)
+        while len(hops) < MAX_HOPS:
+            if not servers:
+                return None
+            response = None
+            for server in random.sample(servers, len(servers)):
+                start = time.perf_counter()
+                response = self._ask(server, name, qtype)
+                rtt = (time.perf_counter() - start) * 1000
+                if response is None:
+                    hops.append(Hop(stage_for_zone(zone), zone, server, "Timeout", rtt))
+                    if len(hops) >= MAX_HOPS:
+                        return None
+                    continue
+                flags = dnswire.unpack_header(response)[1]
+                if flags & 0x000F == dnswire.RCODE_SERVFAIL or flags & dnswire.FLAG_TC:
+                    hops.append(Hop(stage_for_zone(zone), zone, server, "Failure", rtt))
+                    response = None
+                    continue
+                break
+            if response is None:
+                return None
+            flags, answer, authority, additional = parse_response(response)
+            rcode = flags & 0x000F
+            if answer or rcode == dnswire.RCODE_NXDOMAIN or flags & dnswire.FLAG_AA:
+                hops.append(Hop(stage_for_zone(zone), zone, server, "Answer", rtt))
+                return rcode, answer, authority
+            ns_records = [r for r in authority if r.rtype == dnswire.TYPE_NS]
+            child = ns_records[0].name if ns_records else None
+            if child is None or not is_subdomain(name, child) or child == zone or not is_subdomain(child, zone):
+                # no usable referral: treat as a NODATA style answer
+                hops.append(Hop(stage_for_zone(zone), zone, server, "Answer", rtt))
+                return rcode, answer, authority
+            hops.append(Hop(stage_for_zone(zone), zone, server, f"Referral to {child}", rtt))
+            ns_names = [r.target for r in ns_records]
+            # glue is only trusted for names inside the zone of the server that sent it,
+            # otherwise any server could plant addresses for names it has no authority over
+            glued = {r.name for r in additional if r.rtype == dnswire.TYPE_A and r.name in ns_names
+                     and is_subdomain(r.name, zone)}
+            glue = sorted({r.target for r in additional if r.rtype == dnswire.TYPE_A and r.name in glued})
+            if not glue:
+                glue = self._resolve_ns_addresses(ns_names, hops, depth)
+            # a delegation without addresses would block every name under it for the NS TTL
+            if glue:
+                self.delegations.put(child, ns_names, glue, min(r.ttl for r in ns_records))
+            zone, servers = child, glue
+        return None
+
+    def _resolve_ns_addresses(self, ns_names, hops, depth):
+        """Looks up A records of NS names that came without glue."""
+        if depth >= MAX_NS_DEPTH:
+            return []
+        for ns_name in ns_names:
+            result = self._resolve_name(ns_name, dnswire.TYPE_A, hops, depth + 1)
+            if result is not None:
+                addresses = [r.target for r in result[1] if r.rtype == dnswire.TYPE_A]
+                if addresses:
+                    return addresses
+        return []
+
+    def _assemble(self, question, rcode, answers, authority):
+        """Builds the client response: recursion available, not authoritative."""
+        authority = [] if answers else [r for r in authority if r.rtype == dnswire.TYPE_SOA]
+        flags = dnswire.FLAG_QR | dnswire.FLAG_RD | dnswire.FLAG_RA | rcode
+        header = dnswire.HEADER.pack(0, flags, 1, len(answers), len(authority), 0)
+        return header + question + b''.join(r.to_wire() for r in answers + authority)
@@ -0,0 +1,361 @@
+#!/usr/bin/python3
+"""
+native DNS load generator used by bench.py / qbench.py --native.
+
+Raw queries are sent over asyncio UDP sockets, so there is no dig process per
+lookup and the RTT is taken with perf_counter_ns around the datagram itself.
+Two modes:
+  open loop   - queries leave at a fixed target rate (--qps), whether or not
+                earlier ones were answered, the way independent clients behave
+  closed loop - N clients (--concurrency) each send the next query as soon as
+                their previous one is answered or timed out
+  replay      - the queries of a capture leave at their original offsets,
+                optionally sped up (qbench.py --replay --speed N)
+For the paced modes the largest delay between a query's due time and its
+actual send is reported, it shows when the generator itself fell behind.
+With --retries N an unanswered query is sent again (same ID) after an RFC 6298
+RTO learned from the answers, doubling per attempt, the way a stub resolver
+retries; the RTT then still counts from the first send.
+"""
+import asyncio
+import csv
+import random
+import time
+import dnswire
+from upstreams import MAX_RTO_MS, RtoEstimator
+
+QUERY_TIMEOUT = 2.0
+# an ID space of 65536 per socket, spread in-flight queries over a few sockets
+CLIENT_SOCKETS = 4
+# open loop sends in small batches, the event loop cannot sleep much finer
+PACING_TICK = 0.001
+
+
+class LatencyHistogram:
+    """
+    HDR-style log-linear histogram of nanosecond values.
+    Each power of two is split into 2**(SUB_BITS-1) linear buckets, so the
+    relative error of a reported percentile stays below 2**-(SUB_BITS-1).
+    """
+    SUB_BITS = 8
+
+    def __init__(self):
+        self.half = 1 << (self.SUB_BITS - 1)
+        self.counts = {}
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        if value < (1 << self.SUB_BITS):
+            return value
+        shift = value.bit_length() - self.SUB_BITS
+        return shift * self.half + (value >> shift)
+
+    def _bucket_middle(self, index):
+        if index < (1 << self.SUB_BITS):
+            return index
+        shift = index // self.half - 1
+        mantissa = index - shift * self.half
+        return (mantissa << shift) + ((1 << shift) >> 1)
+
+    def record(self, value):
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.total += 1
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, pct):
+        if not self.total:
+            return 0
+        rank = max(1, int(round(pct / 100.0 * self.total)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(max(self._bucket_middle(index), self.min), self.max)
+        return self.max
+
+
+class QueryRecord:
+    __slots__ = ('index', 'domain', 'sent_ns', 'rtt_ns', 'rcode', 'status', 'retransmits')
+
+    def __init__(self, index, domain):
+        self.index = index
+        self.domain = domain
+        self.sent_ns = 0
+        self.rtt_ns = None
+        self.rcode = None
+        self.status = 'pending'
+        self.retransmits = 0
+
+
+class _ClientProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        received_ns = time.perf_counter_ns()
+        if len(data) < 12:
+            return
+        entry = self.pending.pop(dnswire.U16.unpack_from(data)[0], None)
+        if entry is None:
+            return  # answer arrived after its timeout
+        record, future = entry
+        record.rtt_ns = received_ns - record.sent_ns
+        record.rcode = dnswire.rcode(data)
+        record.status = 'ok'
+        if not future.done():
+            future.set_result(record)
+
+    def error_received(self, exc):
+        pass
+
+
+class LoadGenerator:
+
+    def __init__(self, server, port=53, qtype=dnswire.TYPE_A, timeout=QUERY_TIMEOUT,
+                 sockets=CLIENT_SOCKETS, retries=0):
+        self.server = server
+        self.port = port
+        self.qtype = qtype
+        self.timeout = timeout
+        self.socket_count = sockets
+        self.retries = retries
+        self.timer = RtoEstimator()
+        self.protocols = []
+        self.records = []
+        self.histogram = LatencyHistogram()
+        self.start_ns = 0
+        self.end_ns = 0
+        self.max_lag_ns = None
+
+    async def _open(self):
+        loop = asyncio.get_running_loop()
+        for _ in range(self.socket_count):
+            _, protocol = await loop.create_datagram_endpoint(
+                _ClientProtocol, remote_addr=(self.server, self.port))
+            self.protocols.append(protocol)
+
+    def _close(self):
+        for protocol in self.protocols:
+            protocol.transport.close()
+
+    async def _query(self, index, domain, qtype=None, due_ns=None):
+        record = QueryRecord(index, domain)
+        self.records.append(record)
+        protocol = self.protocols[index % len(self.protocols)]
+        qid = random.getrandbits(16)
+        while qid in protocol.pending:
+            qid = random.getrandbits(16)
+        future = asyncio.get_running_loop().create_future()
+        protocol.pending[qid] = (record, future)
+        packet = dnswire.build_query(qid, domain, qtype or self.qtype)
+        record.sent_ns = time.perf_counter_ns()
+        protocol.transport.sendto(packet)
+        if due_ns is not None:
+            self.max_lag_ns = max(self.max_lag_ns or 0, record.sent_ns - due_ns)
+        deadline = time.perf_counter() + self.timeout
+        rto = self.timer.rto()
+        try:
+            while True:
+                wait = deadline - time.perf_counter()
+                if record.retransmits < self.retries:
+                    wait = min(wait, rto)
+                try:
+                    # shield: giving up on one attempt must not cancel the query
+                    await asyncio.wait_for(asyncio.shield(future), max(wait, 0))
+                    break
+                except asyncio.TimeoutError:
+                    if time.perf_counter() >= deadline:
+                        raise
+                    if record.retransmits < self.retries:
+                        record.retransmits += 1
+                        rto = min(rto * 2, MAX_RTO_MS / 1000)
+                        protocol.transport.sendto(packet)
+            # Karn: with the same ID resent, the answer may belong to any copy
+            if not record.retransmits:
+                self.timer.sample(record.rtt_ns / 1e6)
+            self.histogram.record(record.rtt_ns)
+        except asyncio.TimeoutError:
+            record.status = 'timeout'
+        finally:
+            entry = protocol.pending.get(qid)
+            if entry is not None and entry[0] is record:
+                del protocol.pending[qid]
+        return record
+
+    async def run_open_loop(self, domains, qps, count):
+        """Sends 'count' queries (cycling over domains) at 'qps' per second."""
+        await self._open()
+        tasks = []
+        self.start_ns = time.perf_counter_ns()
+        interval_ns = int(1e9 / qps)
+        try:
+            sent = 0
+            while sent < count:
+                # send everything that is due by now, then yield for one tick
+                due = min(count, (time.perf_counter_ns() - self.start_ns) // interval_ns + 1)
+                while sent < due:
+                    tasks.append(asyncio.ensure_future(self._query(sent, domains[sent % len(domains)],
+                                                                   due_ns=self.start_ns + sent * interval_ns)))
+                    sent += 1
+                await asyncio.sleep(PACING_TICK)
+            await asyncio.gather(*tasks)
+        finally:
+            self.end_ns = time.perf_counter_ns()
+            self._close()
+
+    async def run_replay(self, schedule, speed=1.0):
+        """
+        schedule is [(offset seconds, qname, qtype), ...] in send order; each
+        query leaves at start + offset / speed.
+        """
+        await self._open()
+        tasks = []
+        self.start_ns = time.perf_counter_ns()
+        try:
+            for index, (offset, domain, qtype) in enumerate(schedule):
+                due_ns = self.start_ns + int(offset / speed * 1e9)
+                wait = (due_ns - time.perf_counter_ns()) / 1e9
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                tasks.append(asyncio.ensure_future(self._query(index, domain, qtype, due_ns)))
+            await asyncio.gather(*tasks)
+        finally:
+            self.end_ns = time.perf_counter_ns()
+            self._close()
+
+    async def run_closed_loop(self, domains, concurrency, count):
+        """'concurrency' clients share 'count' queries, each waits for its answer."""
+        await self._open()
+        next_index = 0
+
+        async def client():
+            nonlocal next_index
+            while next_index < count:
+                index = next_index
+                next_index += 1
+                await self._query(index, domains[index % len(domains)])
+
+        self.start_ns = time.perf_counter_ns()
+        try:
+            await asyncio.gather(*(client() for _ in range(concurrency)))
+        finally:
+            self.end_ns = time.perf_counter_ns()
+            self._close()
+
+    def summary(self):
+        duration = (self.end_ns - self.start_ns) / 1e9
+        answered = sum(1 for r in self.records if r.status == 'ok')
+        # the offered rate covers the sends only; the duration also waits out the last timeouts
+        sent = len(self.records)
+        send_window = (max(r.sent_ns for r in self.records) - self.start_ns) / 1e9 if self.records else 0.0
+        if sent > 1 and send_window > 0:
+            offered_qps = (sent - 1) / send_window
+        else:
+            offered_qps = sent / duration if duration > 0 else 0.0
+        h = self.histogram
+        return {
+            'sent': sent,
+            'answered': answered,
+            'timeouts': len(self.records) - answered,
+            'retransmits': sum(r.retransmits for r in self.records),
+            'retransmitted_queries': sum(1 for r in self.records if r.retransmits),
+            'noerror': sum(1 for r in self.records if r.rcode == dnswire.RCODE_NOERROR),
+            'duration_s': duration,
+            'send_window_s': send_window,
+            'offered_qps': offered_qps,
+            'answered_qps': answered / duration if duration > 0 else 0.0,
+            'p50_ms': h.percentile(50) / 1e6,
+            'p90_ms': h.percentile(90) / 1e6,
+            'p99_ms': h.percentile(99) / 1e6,
+            'p999_ms': h.percentile(99.9) / 1e6,
+            'max_ms': (h.max or 0) / 1e6,
+            'max_lag_ms': None if self.max_lag_ns is None else self.max_lag_ns / 1e6,
+        }
+
+    def write_records(self, path):
+        """One row per query: offsets and RTTs in ms, rcode empty for timeouts."""
+        with open(path, 'w', newline='') as out:
+            w = csv.writer(out)
+            w.writerow(['index', 'domain', 'send_offset_ms', 'rtt_ms', 'rcode', 'status', 'retransmits'])
+            for r in sorted(self.records, key=lambda r: r.index):
+                w.writerow([r.index, r.domain, f"{(r.sent_ns - self.start_ns) / 1e6:.3f}",
+                            f"{r.rtt_ns / 1e6:.3f}" if r.rtt_ns is not None else '',
+                            '' if r.rcode is None else r.rcode, r.status, r.retransmits])
+
+
+def print_summary(stats):
+    print("\n--- Native Load Generator Summary ---")
+    print(f"  Queries Sent:         {stats['sent']}")
+    print(f"  Answered:             {stats['answered']} ({stats['noerror']} NOERROR)")
+    print(f"  Timed Out:            {stats['timeouts']}")
+    print(f"  Retransmissions:      {stats['retransmits']} ({stats['retransmitted_queries']} queries)")
+    print(f"  Duration:             {stats['duration_s']:.2f} s")
+    print(f"  Offered Rate:         {stats['offered_qps']:.2f} queries/sec (over {stats['send_window_s']:.2f} s of sending)")
+    print(f"  Answered Rate:        {stats['answered_qps']:.2f} queries/sec")
+    print(f"  Latency p50/p90/p99:  {stats['p50_ms']:.3f} / {stats['p90_ms']:.3f} / {stats['p99_ms']:.3f} ms")
+    print(f"  Latency p99.9/max:    {stats['p999_ms']:.3f} / {stats['max_ms']:.3f} ms")
+    if stats['max_lag_ms'] is not None:
+        print(f"  Max Send Lag:         {stats['max_lag_ms']:.3f} ms")
+
+
+NATIVE_USAGE = ("[--native] [--server 10.0.0.5] [--port 53] [--qps N | --concurrency N] "
+                "[--count N] [--timeout 2] [--retries N] [--records out.csv] [--speed N]")
+
+
+def parse_native_args(argv):
+    """Reads the --native options shared by bench.py and qbench.py into kwargs."""
+    def flag(name, cast, default=None):
+        if name in argv:
+            return cast(argv[argv.index(name) + 1])
+        return default
+    return {
+        'server': flag('--server', str, "10.0.0.5"),
+        'port': flag('--port', int, 53),
+        'qps': flag('--qps', float),
+        'concurrency': flag('--concurrency', int),
+        'count': flag('--count', int),
+        'timeout': flag('--timeout', float, QUERY_TIMEOUT),
+        'retries': flag('--retries', int, 0),
+        'speed': flag('--speed', float, 1.0),
+        'records_path': flag('--records', str),
+    }
+
+
+def run_native_benchmark(domains, server, port=53, qps=None, concurrency=None, count=None,
+                         records_path=None, timeout=QUERY_TIMEOUT, retries=0, speed=1.0, schedule=None):
+    """
+    Entry point for the benchmark scripts. Replays 'schedule' (see run_replay)
+    'speed' times faster when it is given, runs open loop when 'qps' is given,
+    closed loop otherwise ('concurrency' clients, 1 by default).
+    """
+    if not domains and not schedule:
+        print("[Warning] The list of domains to test is empty. Aborting benchmark.")
+        return None
+    count = count or len(domains)
+    generator = LoadGenerator(server, port, timeout=timeout, retries=retries)
+    if schedule:
+        span = schedule[-1][0] / speed
+        print(f"--> Replay: {len(schedule)} queries over {span:.2f} s ({speed:g}x) to {server}:{port}...")
+        asyncio.run(generator.run_replay(schedule, speed))
+    elif qps:
+        print(f"--> Open loop: {count} queries at {qps} queries/sec to {server}:{port}...")
+        asyncio.run(generator.run_open_loop(domains, qps, count))
+    else:
+        concurrency = concurrency or 1
+        print(f"--> Closed loop: {count} queries from {concurrency} clients to {server}:{port}...")
+        asyncio.run(generator.run_closed_loop(domains, concurrency, count))
+    stats = generator.summary()
+    print_summary(stats)
+    if records_path:
+        generator.write_records(records_path)
+        print(f"--> Per-query records saved to '{records_path}'")
+    return stats
@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+"""
+Per-stage latency metrics for cr.py, served in the Prometheus text format.
+
+A handler starts a StageTimer when the datagram is read and calls lap(stage)
+as each stage ends; the time since the previous lap (perf_counter_ns) is
+charged to that stage:
+  queue    - datagram received until the handler runs
+  parse    - question name / type parsed
+  cache    - cache lookup
+  upstream - forwarding (coalesced and hedged) or the iterative walk
+  send     - answer sent to the client
+  store    - answer stored in the cache
+  total    - datagram received until the handler is done
+
+The hot path takes no lock: Metrics.begin() and Metrics.finish() only append
+to a deque (atomic in CPython). A single fold, run every FOLD_INTERVAL seconds
+by the endpoint thread and before every scrape, drains it into the counters
+and the log-bucketed histograms. The endpoint answers GET /metrics on a TCP
+port and/or a UNIX socket:
+
+    curl -s 127.0.0.1:9153/metrics
+    curl -s --unix-socket /tmp/dns-metrics.sock http://localhost/metrics
+"""
+import collections
+import http.server
+import os
+import socketserver
+import threading
+import time
+
+STAGES = ('queue', 'parse', 'cache', 'upstream', 'send', 'store', 'total')
+QUEUE, PARSE, CACHE, UPSTREAM, SEND, STORE, TOTAL = range(len(STAGES))
+
+# power-of-two buckets: the first ends at 2**HIST_MIN_SHIFT ns (~1 us), the
+# last one is open-ended and starts at 2**(HIST_MIN_SHIFT + HIST_BUCKETS - 2) ns (~4.3 s)
+HIST_MIN_SHIFT = 10
+HIST_BUCKETS = 24
+
+# seconds between folds of the pending observations
+FOLD_INTERVAL = 1.0
+# QPS is the rate of finished queries over this many seconds
+RATE_WINDOW = 10.0
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class StageTimer:
+    """Stage durations of one query in nanoseconds, None for stages it skipped."""
+    __slots__ = ('received_ns', 'last_ns', 'stages')
+
+    def __init__(self, received_ns=None):
+        now = time.perf_counter_ns()
+        self.received_ns = now if received_ns is None else received_ns
+        self.last_ns = now
+        self.stages = [None] * len(STAGES)
+        self.stages[QUEUE] = now - self.received_ns
+
+    def lap(self, stage):
+        """Charges the time since the previous lap to 'stage'."""
+        now = time.perf_counter_ns()
+        self.stages[stage] = (self.stages[stage] or 0) + now - self.last_ns
+        self.last_ns = now
+
+    def stop(self):
+        self.stages[TOTAL] = self.last_ns - self.received_ns
+
+
+class Histogram:
+    """Counts of nanosecond values in power-of-two buckets, plus their sum."""
+
+    def __init__(self):
+        self.counts = [0] * HIST_BUCKETS
+        self.count = 0
+        self.sum_ns = 0
+
+    def record(self, value_ns):
+        index = min(max(value_ns.bit_length() - HIST_MIN_SHIFT, 0), HIST_BUCKETS - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.sum_ns += value_ns
+
+    def cumulative(self):
+        """[(upper bound in seconds, count of values below it), ...] without the +Inf bucket."""
+        running = 0
+        buckets = []
+        for index, count in enumerate(self.counts[:-1]):
+            running += count
+            buckets.append(((1 << (index + HIST_MIN_SHIFT)) / 1e9, running))
+        return buckets
+
+
+class Metrics:
+
+    def __init__(self):
+        self.pending = collections.deque()
+        self.fold_lock = threading.Lock()
+        self.started = 0
+        self.finished = 0
+        self.outcomes = collections.Counter()
+        self.histograms = [Histogram() for _ in STAGES]
+        self.history = collections.deque()
+
+    def begin(self):
+        self.pending.append(None)
+
+    def finish(self, timer, outcome):
+        """'timer' is the query's stopped StageTimer, 'outcome' its QueryRecord outcome."""
+        self.pending.append((outcome, timer.stages))
+
+    def fold(self):
+        with self.fold_lock:
+            while True:
+                try:
+                    item = self.pending.popleft()
+                except IndexError:
+                    break
+                if item is None:
+                    self.started += 1
+                    continue
+                outcome, stages = item
+                self.finished += 1
+                self.outcomes[outcome or 'None'] += 1
+                for histogram, value in zip(self.histograms, stages):
+                    if value is not None:
+                        histogram.record(value)
+            now = time.monotonic()
+            self.history.append((now, self.finished))
+            while len(self.history) > 1 and now - self.history[0][0] > RATE_WINDOW:
+                self.history.popleft()
+
+    def qps(self):
+        (first_time, first_count), (last_time, last_count) = self.history[0], self.history[-1]
+        return (last_count - first_count) / (last_time - first_time) if last_time > first_time else 0.0
+
+    def render(self, families=()):
+        """
+        Prometheus text of the folded metrics. 'families' are extra
+        (name, type, help, [(labels dict, value), ...]) tuples, e.g. cache counters.
+        """
+        self.fold()
+        families = [
+            ('dns_queries_total', 'counter', 'Queries handled, by outcome.',
+             [({'outcome': outcome}, count) for outcome, count in sorted(self.outcomes.items())]),
+            ('dns_queries_per_second', 'gauge', f'Queries finished per second over the last {RATE_WINDOW:g} s.',
+             [({}, self.qps())]),
+            ('dns_queries_in_flight', 'gauge', 'Queries received and not yet answered.',
+             [({}, self.started - self.finished)]),
+        ] + list(families)
+        lines = []
+        for name, kind, help_text, samples in families:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            lines += [f"{name}{format_labels(labels)} {format_value(value)}" for labels, value in samples]
+        name = 'dns_stage_duration_seconds'
+        lines += [f"# HELP {name} Time spent per query in each handler stage.",
+                  f"# TYPE {name} histogram"]
+        for stage, histogram in zip(STAGES, self.histograms):
+            for upper, count in histogram.cumulative():
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{format_value(upper)}"}} {count}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {format_value(histogram.sum_ns / 1e9)}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    # label values here are outcomes and server addresses, nothing to escape
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render(self.server.collect()).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TCPMetricsServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class UnixMetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def start_endpoint(metrics, collect, port=None, socket_path=None, listen_ip='127.0.0.1'):
+    """
+    Serves 'metrics' on listen_ip:port and/or the UNIX socket 'socket_path' from
+    daemon threads; 'collect' returns the extra families for each scrape.
+    Returns the servers, shut them down with stop_endpoint().
+    """
+    servers = []
+    if port is not None:
+        servers.append(TCPMetricsServer((listen_ip, port), MetricsHandler))
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        servers.append(UnixMetricsServer(socket_path, MetricsHandler))
+    for server in servers:
+        server.metrics = metrics
+        server.collect = collect
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def fold_forever():
+        while True:
+            time.sleep(FOLD_INTERVAL)
+            metrics.fold()
+
+    threading.Thread(target=fold_forever, daemon=True).start()
+    return servers
+
+
+def stop_endpoint(servers):
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+        if isinstance(server, UnixMetricsServer) and os.path.exists(server.server_address):
+            os.unlink(server.server_address)
@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+"""
+Negative-answer and failure cache for the forwarder in cr.py.
+
+Junk names (typos, expired domains, tracking hosts) make up a good part of the
+domain lists, and every repeated lookup of one used to cost an upstream round
+trip. They are kept here, apart from the answer cache, so they cannot evict
+real answers from it:
+  NXDOMAIN  - per name, for the SOA minimum (RFC 2308). The name does not exist
+              for any type, and neither does anything below it (RFC 8020), so a
+              query for a.b.junk.example is answered from the entry for junk.example.
+  NODATA    - per (name, type, class), for the SOA minimum.
+  failures  - SERVFAIL answers and upstream timeouts hold the (name, type, class)
+              down for FAILURE_HOLD_DOWN seconds, doubled for every further
+              failure up to FAILURE_HOLD_MAX (RFC 9520). Queries in that window
+              get SERVFAIL at once instead of another 2 s wait.
+Answers are rebuilt from the cached authority records, with the client's ID and
+question and with TTLs counted down. Each entry remembers what the upstream
+cost the first time, and every answer from the cache adds that to the savings.
+"""
+import threading
+import time
+from collections import OrderedDict
+import dnswire
+from dns_cache import NEGATIVE_TTL_CAP, NEGATIVE_TTL_DEFAULT
+
+MAX_ENTRIES = 10000
+FAILURE_HOLD_DOWN = 5.0
+FAILURE_HOLD_MAX = 60.0
+# RFC 8020 NXDOMAIN cut; some broken authoritative servers answer NXDOMAIN for
+# empty non-terminals, set to False if that bites
+NXDOMAIN_CUT = True
+
+NXDOMAIN, NODATA, FAILURE = 'nxdomain', 'nodata', 'failure'
+
+
+class NegativeEntry:
+    __slots__ = ('kind', 'flags', 'authority', 'count', 'ttl_offsets', 'ttls', 'stored_at',
+                 'expires_at', 'cost_ms', 'failures')
+
+    def __init__(self, kind, flags, authority, count, ttl_offsets, ttls, stored_at, lifetime, cost_ms):
+        self.kind = kind
+        self.flags = flags
+        self.authority = authority
+        self.count = count
+        self.ttl_offsets = ttl_offsets
+        self.ttls = ttls
+        self.stored_at = stored_at
+        self.expires_at = stored_at + lifetime
+        self.cost_ms = cost_ms
+        self.failures = 1
+
+
+def _authority_records(response):
+    """
+    Authority section written out uncompressed, so it can follow any question.
+    Returns (bytes, record count, ttl offsets into the bytes, ttls, SOA minimum).
+    """
+    out = bytearray()
+    offsets, ttls = [], []
+    soa_minimum = None
+    for section, name_off, rtype, rclass, ttl, _, rdata_off, rdlength in dnswire.iter_records(response):
+        if section != 1:
+            continue
+        owner = dnswire.encode_name(dnswire.read_name(response, name_off)[0])
+        offsets.append(len(out) + len(owner) + 4)
+        ttls.append(ttl)
+        out += owner + dnswire.RR_FIXED.pack(rtype, rclass, ttl, 0)
+        rdata = dnswire.expand_rdata(response, rtype, rdata_off, rdlength)
+        dnswire.U16.pack_into(out, len(out) - 2, len(rdata))
+        out += rdata
+        if rtype == dnswire.TYPE_SOA:
+            soa_minimum = min(ttl, dnswire.U32.unpack_from(response, rdata_off + rdlength - 4)[0])
+    return bytes(out), len(ttls), offsets, ttls, soa_minimum
+
+
+class NegativeCache:
+
+    def __init__(self, max_entries=MAX_ENTRIES, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.clock = clock
+        # (name, class) for NXDOMAIN, (name, type, class) for NODATA and failures
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.nxdomain_hits = 0
+        self.synthesized = 0
+        self.nodata_hits = 0
+        self.failure_hits = 0
+        self.saved_ms = 0.0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _store(self, key, entry):
+        # called with the lock held
+        self.entries.pop(key, None)
+        self.entries[key] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _live(self, key, now):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if now >= entry.expires_at:
+            # an expired failure is kept a while longer, so the next one gets a longer hold-down
+            if entry.kind != FAILURE or now >= entry.expires_at + FAILURE_HOLD_MAX:
+                del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, response, cost_ms=0.0):
+        """
+        Stores an NXDOMAIN or NODATA answer (without answer records) for 'key',
+        a (name, type, class) cache key. Returns the lifetime used, 0 if the
+        response is not a negative answer.
+        """
+        _, flags, _, ancount, _, _ = dnswire.unpack_header(response)
+        rcode = flags & 0x000F
+        if ancount or flags & dnswire.FLAG_TC or rcode not in (dnswire.RCODE_NOERROR, dnswire.RCODE_NXDOMAIN):
+            return 0
+        authority, count, offsets, ttls, soa_minimum = _authority_records(response)
+        lifetime = min(soa_minimum if soa_minimum is not None else NEGATIVE_TTL_DEFAULT, NEGATIVE_TTL_CAP)
+        if lifetime <= 0:
+            return 0
+        name, qtype, qclass = key
+        kind = NXDOMAIN if rcode == dnswire.RCODE_NXDOMAIN else NODATA
+        entry = NegativeEntry(kind, flags, authority, count, offsets, ttls, self.clock(), lifetime, cost_ms)
+        with self.lock:
+            self._store((name, qclass) if kind == NXDOMAIN else key, entry)
+        return lifetime
+
+    def hold_down(self, key, cost_ms=0.0):
+        """
+        Records a SERVFAIL or timeout for 'key', returns the hold-down in seconds.
+        Failures while the name is already held down (e.g. coalesced queries
+        sharing one timeout) do not extend it.
+        """
+        now = self.clock()
+        with self.lock:
+            previous = self.entries.get(key)
+            if previous is not None and previous.kind == FAILURE and now < previous.expires_at:
+                return previous.expires_at - now
+            failures = previous.failures + 1 if previous is not None and previous.kind == FAILURE else 1
+            hold = min(FAILURE_HOLD_DOWN * 2 ** (failures - 1), FAILURE_HOLD_MAX)
+            entry = NegativeEntry(FAILURE, dnswire.RCODE_SERVFAIL, b'', 0, [], [], now, hold, cost_ms)
+            entry.failures = failures
+            self._store(key, entry)
+        return hold
+
+    def get(self, key, query):
+        """
+        Returns (response for 'query', kind) when the cache can answer it, else
+        None. 'kind' is NXDOMAIN, NODATA or FAILURE (the response is then SERVFAIL).
+        """
+        name, qtype, qclass = key
+        now = self.clock()
+        with self.lock:
+            entry = self._live(key, now)
+            if entry is None:
+                entry = self._live((name, qclass), now)
+                synthesized = False
+                if entry is None and NXDOMAIN_CUT:
+                    # the closest enclosing name known not to exist
+                    labels = name.split('.')
+                    for start in range(1, len(labels)):
+                        entry = self._live(('.'.join(labels[start:]), qclass), now)
+                        if entry is not None:
+                            synthesized = True
+                            break
+                if entry is None:
+                    return None
+                if synthesized:
+                    self.synthesized += 1
+                else:
+                    self.nxdomain_hits += 1
+            elif entry.kind == FAILURE:
+                self.failure_hits += 1
+            else:
+                self.nodata_hits += 1
+            self.saved_ms += entry.cost_ms
+        return self._answer(entry, query, int(now - entry.stored_at)), entry.kind
+
+    @staticmethod
+    def _answer(entry, query, elapsed):
+        qid, query_flags = dnswire.HEADER.unpack_from(query)[:2]
+        flags = (entry.flags & ~dnswire.FLAG_RD | query_flags & dnswire.FLAG_RD
+                 | dnswire.FLAG_QR | dnswire.FLAG_RA)
+        authority = bytearray(entry.authority)
+        dnswire.patch_ttls(authority, entry.ttl_offsets, entry.ttls, elapsed)
+        # entries are keyed on the first question, so that is the one answered
+        return (dnswire.HEADER.pack(qid, flags, 1, 0, entry.count, 0)
+                + dnswire.question_section(query) + bytes(authority))
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'nxdomain_hits': self.nxdomain_hits,
+            'synthesized': self.synthesized,
+            'nodata_hits': self.nodata_hits,
+            'failure_hits': self.failure_hits,
+            'saved_ms': self.saved_ms,
+        }
+
+
+def format_negative_stats(stats):
+    saved = stats['nxdomain_hits'] + stats['synthesized'] + stats['nodata_hits'] + stats['failure_hits']
+    return (f"[Negative] entries {stats['entries']}, NXDOMAIN hits {stats['nxdomain_hits']} "
+            f"(+{stats['synthesized']} below a cached NXDOMAIN), NODATA hits {stats['nodata_hits']}, "
+            f"held-down failures {stats['failure_hits']}: {saved} upstream queries and "
+            f"{stats['saved_ms'] / 1000:.1f} s saved")
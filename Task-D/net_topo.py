@@ -2,14 +2,36 @@
 """
 creates the Mininet topology, configures clients to use the
 custom resolver, and launches the resolver script.
+With --bench the Task-B workloads then run on h1-h4 at the same time against it.
 """
+import os
+import sys
+import time
 from mininet.net import Mininet
 from mininet.node import Host, OVSKernelSwitch
 from mininet.cli import CLI
 from mininet.link import TCLink
 from mininet.log import setLogLevel, info
 
-def build_dns_topology():
+TASK_B_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Task-B')
+sys.path.insert(0, TASK_B_DIR)
+import multihost
+
+# seconds the resolver gets to bind before the benchmark starts
+RESOLVER_STARTUP_WAIT = 2.0
+
+def run_parallel_benchmark(net, extra_args=()):
+    """Every client resolves its own domains_hN_unique.txt through 10.0.0.5, all at once."""
+    jobs = [(h, os.path.join(TASK_B_DIR, f'domains_{h}_unique.txt'), f'{h}_dns_results.csv')
+            for h in ['h1', 'h2', 'h3', 'h4']]
+    finished = multihost.run_parallel(net, jobs, extra_args)
+    if finished:
+        report = multihost.merge_results(finished)
+        multihost.print_report(report)
+        multihost.write_report(report, 'aggregate_dns_results.csv')
+        info("--> Aggregate report saved to 'aggregate_dns_results.csv'\n")
+
+def build_dns_topology(bench=False, extra_args=()):
     """Initializes and configures the Mininet network for the DNS."""
     net = Mininet(controller=None, switch=OVSKernelSwitch, host=Host, link=TCLink)
     info('--> Creating network hosts...\n')
@@ -55,6 +77,10 @@ def build_dns_topology():
     # run the resolver in the background (&) on the 'dns' node
     resolver_node.cmd('sudo python3 cr.py > /tmp/resolver.log 2>&1 &')
     info('--> Resolver script is now running.\n')
+    if bench:
+        time.sleep(RESOLVER_STARTUP_WAIT)
+        info('--> Running the h1-h4 workloads in parallel...\n')
+        run_parallel_benchmark(net, extra_args)
     info('--> Mininet CLI is ready.\n')
     CLI(net)
     info('--> Shutting down network.\n')
@@ -62,4 +88,8 @@ def build_dns_topology():
 
 if __name__ == '__main__':
     setLogLevel('info')
-    build_dns_topology()
+    # --bench [--concurrency N] runs the parallel multi-host benchmark before the CLI
+    extra = []
+    if '--concurrency' in sys.argv:
+        extra = ['--concurrency', sys.argv[sys.argv.index('--concurrency') + 1]]
+    build_dns_topology(bench='--bench' in sys.argv, extra_args=extra)
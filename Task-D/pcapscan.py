@@ -0,0 +1,264 @@
+#!/usr/bin/python3
+"""
+Streaming extraction of DNS queries from pcap / pcapng captures.
+
+The capture is mmap'ed and walked record by record with struct.unpack_from, so
+memory use does not grow with the file size and no packet objects are built.
+Only what is needed to reach a DNS question is decoded: the link layer
+(Ethernet with VLAN tags, Linux cooked v1/v2, raw IP, BSD loopback), IPv4/IPv6,
+UDP, and the first question of messages sent to UDP port 53 with QR=0.
+Replaces the scapy rdpcap() full load and the tshark step for building the
+domains_h*_unique.txt lists.
+"""
+import mmap
+import struct
+import sys
+import dnswire
+
+DNS_PORT = 53
+
+PCAP_MAGIC_US = 0xA1B2C3D4
+PCAP_MAGIC_NS = 0xA1B23C4D
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+# pcapng block types
+PCAPNG_IDB = 1
+PCAPNG_OPB = 2
+PCAPNG_SPB = 3
+PCAPNG_EPB = 6
+# interface option carrying the timestamp resolution
+PCAPNG_IF_TSRESOL = 9
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+# DLT_RAW as some platforms write it
+LINKTYPE_RAW_ALIASES = (12, 14)
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = (0x8100, 0x88A8, 0x9100)
+IPPROTO_UDP = 17
+# IPv6 extension headers that may sit between the fixed header and UDP
+IPV6_EXTENSIONS = (0, 43, 60)
+IPV6_FRAGMENT = 44
+
+U16_BE = struct.Struct('!H')
+UDP_HEADER = struct.Struct('!HHHH')
+
+
+class PcapError(ValueError):
+    """Raised when the file is neither pcap nor pcapng."""
+
+
+def _network_offset(link, frame):
+    """Offset of the IP header in 'frame' and its ethertype, or (None, None)."""
+    if link == LINKTYPE_ETHERNET:
+        off = 12
+        ethertype = U16_BE.unpack_from(frame, off)[0]
+        while ethertype in ETHERTYPE_VLAN:
+            off += 4
+            ethertype = U16_BE.unpack_from(frame, off)[0]
+        return off + 2, ethertype
+    if link == LINKTYPE_LINUX_SLL:
+        return 16, U16_BE.unpack_from(frame, 14)[0]
+    if link == LINKTYPE_LINUX_SLL2:
+        return 20, U16_BE.unpack_from(frame, 0)[0]
+    if link in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        # address family in host (NULL) or network (LOOP) order: 2 is IPv4, 24/28/30 IPv6
+        family = max(frame[0:4]) if frame[0:4].count(0) == 3 else None
+        if family == 2:
+            return 4, ETHERTYPE_IPV4
+        if family in (24, 28, 30):
+            return 4, ETHERTYPE_IPV6
+        return None, None
+    if link in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6) or link in LINKTYPE_RAW_ALIASES:
+        version = frame[0] >> 4
+        return 0, ETHERTYPE_IPV4 if version == 4 else ETHERTYPE_IPV6 if version == 6 else None
+    return None, None
+
+
+def _udp_payload(link, frame):
+    """DNS payload of a UDP datagram to port 53 inside 'frame', or None."""
+    off, ethertype = _network_offset(link, frame)
+    if off is None:
+        return None
+    if ethertype == ETHERTYPE_IPV4:
+        if frame[off] >> 4 != 4 or frame[off + 9] != IPPROTO_UDP:
+            return None
+        if U16_BE.unpack_from(frame, off + 6)[0] & 0x1FFF:
+            return None  # not the first fragment, no UDP header here
+        off += (frame[off] & 0x0F) * 4
+    elif ethertype == ETHERTYPE_IPV6:
+        next_header = frame[off + 6]
+        off += 40
+        while next_header in IPV6_EXTENSIONS or next_header == IPV6_FRAGMENT:
+            if next_header == IPV6_FRAGMENT:
+                if U16_BE.unpack_from(frame, off + 2)[0] & 0xFFF8:
+                    return None
+                next_header, off = frame[off], off + 8
+            else:
+                next_header, off = frame[off], off + (frame[off + 1] + 1) * 8
+        if next_header != IPPROTO_UDP:
+            return None
+    else:
+        return None
+    _, dst_port, length, _ = UDP_HEADER.unpack_from(frame, off)
+    if dst_port != DNS_PORT:
+        return None
+    return frame[off + 8:off + max(length, 8)]
+
+
+def _query(payload):
+    """(qname, qtype) of a DNS query message, None for responses and junk."""
+    _, flags, qdcount, _, _, _ = dnswire.unpack_header(payload)
+    if flags & dnswire.FLAG_QR or qdcount == 0:
+        return None
+    qname, qtype, _, _ = dnswire.parse_question(payload)
+    return qname, qtype
+
+
+def _pcap_frames(mm):
+    """Yields (timestamp, link type, frame bytes) of a classic pcap file."""
+    magic = struct.unpack_from('<I', mm, 0)[0]
+    endian = '<' if magic in (PCAP_MAGIC_US, PCAP_MAGIC_NS) else '>'
+    magic = struct.unpack_from(endian + 'I', mm, 0)[0]
+    if magic not in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+        raise PcapError("not a pcap file")
+    fraction = 1e-9 if magic == PCAP_MAGIC_NS else 1e-6
+    link = struct.unpack_from(endian + 'I', mm, 20)[0] & 0x0FFFFFFF
+    record = struct.Struct(endian + 'IIII')
+    pos = 24
+    end = len(mm)
+    while pos + record.size <= end:
+        ts_sec, ts_frac, caplen, _ = record.unpack_from(mm, pos)
+        pos += record.size
+        if pos + caplen > end:
+            return  # capture cut off mid-record
+        yield ts_sec + ts_frac * fraction, link, mm[pos:pos + caplen]
+        pos += caplen
+
+
+def _tsresol(options, endian):
+    """Seconds per timestamp unit from the options of an interface block."""
+    pos = 0
+    while pos + 4 <= len(options):
+        code, length = struct.unpack_from(endian + 'HH', options, pos)
+        if code == 0:
+            break
+        if code == PCAPNG_IF_TSRESOL and length >= 1:
+            value = options[pos + 4]
+            return 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+        pos += 4 + (length + 3) // 4 * 4
+    return 1e-6
+
+
+def _pcapng_frames(mm):
+    """Yields (timestamp, link type, frame bytes) of a pcapng file, every section."""
+    pos = 0
+    end = len(mm)
+    endian = '<'
+    interfaces = []
+    timestamp = 0.0
+    while pos + 12 <= end:
+        block_type = struct.unpack_from(endian + 'I', mm, pos)[0]
+        if block_type == PCAPNG_SHB:
+            # every section header may switch the byte order
+            endian = '<' if struct.unpack_from('<I', mm, pos + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC else '>'
+            interfaces = []
+        block_length = struct.unpack_from(endian + 'I', mm, pos + 4)[0]
+        if block_length < 12 or pos + block_length > end:
+            return
+        body = pos + 8
+        if block_type == PCAPNG_IDB:
+            link = struct.unpack_from(endian + 'H', mm, body)[0]
+            interfaces.append((link, _tsresol(mm[body + 8:pos + block_length - 4], endian)))
+        elif block_type in (PCAPNG_EPB, PCAPNG_OPB):
+            if block_type == PCAPNG_EPB:
+                interface, ts_high, ts_low, caplen = struct.unpack_from(endian + 'IIII', mm, body)
+            else:
+                interface, _, ts_high, ts_low, caplen = struct.unpack_from(endian + 'HHIII', mm, body)
+            if interface < len(interfaces):
+                link, unit = interfaces[interface]
+                timestamp = ((ts_high << 32) | ts_low) * unit
+                data = body + 20
+                yield timestamp, link, mm[data:data + min(caplen, block_length - 32)]
+        elif block_type == PCAPNG_SPB and interfaces:
+            # simple packets carry no timestamp, they get the previous one
+            caplen = min(block_length - 16, struct.unpack_from(endian + 'I', mm, body)[0])
+            yield timestamp, interfaces[0][0], mm[body + 4:body + 4 + caplen]
+        pos += block_length
+
+
+def iter_dns_queries(path):
+    """Yields (timestamp, qname, qtype) for every DNS query to UDP port 53, in capture order."""
+    with open(path, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return  # empty file
+    with mm:
+        if len(mm) < 24:
+            raise PcapError(f"{path} is too short for a capture file")
+        if struct.unpack_from('<I', mm, 0)[0] == PCAPNG_SHB:
+            frames = _pcapng_frames(mm)
+        else:
+            frames = _pcap_frames(mm)
+        for timestamp, link, frame in frames:
+            try:
+                payload = _udp_payload(link, frame)
+                query = _query(payload) if payload is not None else None
+            except (IndexError, struct.error, dnswire.WireError):
+                continue  # truncated or malformed packet
+            if query is not None:
+                yield (timestamp,) + query
+
+
+def query_schedule(path):
+    """[(seconds since the first query, qname, qtype), ...] of every query, for replays."""
+    schedule = []
+    first = None
+    for timestamp, qname, qtype in iter_dns_queries(path):
+        if first is None:
+            first = timestamp
+        # pcapng files can interleave interfaces, never go back in time
+        offset = max(timestamp - first, schedule[-1][0] if schedule else 0.0)
+        schedule.append((offset, qname.rstrip('.'), qtype))
+    return schedule
+
+
+def unique_query_names(path):
+    """Query names without the trailing dot, each once, in first-seen order."""
+    seen = {}
+    for _, qname, _ in iter_dns_queries(path):
+        qname = qname.rstrip('.')
+        if qname and qname not in seen:
+            seen[qname] = None
+    return list(seen)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1].startswith('--'):
+        print(f"Usage: python3 {sys.argv[0]} <capture.pcap|.pcapng> [domains_unique.txt] [--all domains.txt]")
+        sys.exit(1)
+    capture = sys.argv[1]
+    unique_path = sys.argv[2] if len(sys.argv) > 2 and not sys.argv[2].startswith('--') else None
+    all_path = sys.argv[sys.argv.index('--all') + 1] if '--all' in sys.argv else None
+
+    if all_path:
+        with open(all_path, 'w') as out:
+            for _, qname, _ in iter_dns_queries(capture):
+                out.write(qname.rstrip('.') + "\n")
+    names = unique_query_names(capture)
+    if unique_path:
+        with open(unique_path, 'w') as out:
+            out.writelines(name + "\n" for name in names)
+        print(f"--> {len(names)} unique query names saved to '{unique_path}'")
+    else:
+        for name in names:
+            print(name)
@@ -1,71 +1,193 @@
 #!/usr/bin/env python3
+import json
+import os
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import re
 import sys
+import querylog
 
 LOG_FILE = "/tmp/resolver.log"
 NUM_QUERIES = 10
+# beyond this many bars the domain names on the x axis are left out
+MAX_LABELLED_QUERIES = 50
+
+# patterns are compiled once and matched against raw bytes lines
+DOMAIN_RE = re.compile(rb'b\. Domain Name: (.*)')
+CACHE_RE = re.compile(rb'i\. Cache State: (\w+)')
+VISITED_RE = re.compile(rb'j\. Servers Visited: (\d+)')
+LATENCY_RE = re.compile(rb'h\. Overall Time: ([\d.]+) ms')
+RECORD_END = b'------------------------'
+COLUMNS = ('domain', 'cache_state', 'latency_ms', 'servers_visited')
+
+def cache_dir_for(log_path):
+    return log_path + ".cache"
+
+def load_state(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, "state.json")) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def reset_cache(cache_dir, inode):
+    """Drops all chunks, used when the log was rotated or truncated."""
+    os.makedirs(cache_dir, exist_ok=True)
+    for name in os.listdir(cache_dir):
+        if name.startswith("chunk_"):
+            os.remove(os.path.join(cache_dir, name))
+    return {'inode': inode, 'offset': 0, 'chunks': 0}
+
+def parse_new_records(log_path, offset):
+    """
+    Parses the log from byte 'offset' on. Returns (columns, new_offset); the
+    offset only moves past complete records, so a record that is still being
+    written is picked up by the next run.
+    """
+    columns = {name: [] for name in COLUMNS}
+    curr = None
+    consumed = offset
+
+    def finish(record):
+        if record.get('servers_visited') is None:
+            record['servers_visited'] = 0 if record['cache_state'] in querylog.CACHE_SERVED_STATES else 1
+        for name in COLUMNS:
+            columns[name].append(record[name])
+
+    with open(log_path, "rb") as file:
+        file.seek(offset)
+        pos = offset
+        for line in file:
+            pos += len(line)
+            if line.startswith(RECORD_END):
+                if curr is not None:
+                    finish(curr)
+                    curr = None
+                consumed = pos
+                continue
+            # looking for lines mentioning the queried domain name
+            domain = DOMAIN_RE.match(line)
+            if domain:
+                if curr is not None:
+                    finish(curr)
+                curr = {'domain': domain.group(1).strip().decode('utf-8', 'replace'),
+                        'cache_state': '', 'latency_ms': np.nan, 'servers_visited': None}
+                continue
+            if curr is None:
+                continue
+            # cache hits (positive or negative) are answered locally, no server gets contacted
+            cache = CACHE_RE.match(line)
+            if cache:
+                curr['cache_state'] = cache.group(1).decode()
+                continue
+            # iterative mode reports how many servers the walk contacted
+            visited = VISITED_RE.match(line)
+            if visited:
+                curr['servers_visited'] = int(visited.group(1))
+                continue
+            # pull out the resolution time (latency)
+            latency = LATENCY_RE.match(line)
+            if latency:
+                curr['latency_ms'] = float(latency.group(1))
+    return columns, consumed
+
+def parse_structured_records(log_path, offset):
+    """Same as parse_new_records for the jsonl/binary logs of cr.py --log-format."""
+    columns = {name: [] for name in COLUMNS}
+    consumed = offset
+    for record, consumed in querylog.read_records(log_path, offset):
+        columns['domain'].append(record['domain'])
+        columns['cache_state'].append(record['cache_state'] or '')
+        columns['latency_ms'].append(np.nan if record['total_ms'] is None else record['total_ms'])
+        columns['servers_visited'].append(record['servers_visited'])
+    return columns, consumed
 
 def extract_query_info(log_path):
-    """Turn resolver/forwarder logfile text into a structured table for plotting."""
+    """
+    Turn resolver/forwarder logfile text into a structured table for plotting.
+    Only the part of the log added since the last run is parsed; parsed records
+    are kept as .npz column chunks in <log>.cache/ and concatenated on load.
+    """
     print(f"Loading log file: {log_path}")
-    queries = []
-    curr = {}
     try:
-        with open(log_path, "r") as file:
-            for line in file:
-                # looking for lines mentioning the queried domain name
-                domain = re.search(r'b\. Domain Name: (.*)', line)
-                if domain:
-                    if curr:
-                        queries.append(curr)
-                    curr = {'domain': domain.group(1).strip()}
-                # pull out the resolution time (latency)
-                latency = re.search(r'h\. Overall Time: ([\d.]+) ms', line)
-                if latency and curr:
-                    curr['latency_ms'] = float(latency.group(1))
-                    curr['servers_visited'] = 1
-        # adding the last found query
-        if curr:
-            queries.append(curr)
+        stat = os.stat(log_path)
     except FileNotFoundError:
         print(f"Log file not found at {log_path}. Did you run the DNS experiment?")
         return None
-    if not queries:
+    cache_dir = cache_dir_for(log_path)
+    state = load_state(cache_dir)
+    if state is None or state['inode'] != stat.st_ino or stat.st_size < state['offset']:
+        state = reset_cache(cache_dir, stat.st_ino)
+
+    if querylog.detect_format(log_path) == 'text':
+        columns, offset = parse_new_records(log_path, state['offset'])
+    else:
+        columns, offset = parse_structured_records(log_path, state['offset'])
+    parsed = len(columns['domain'])
+    if parsed:
+        np.savez(os.path.join(cache_dir, f"chunk_{state['chunks']:06d}.npz"),
+                 domain=np.array(columns['domain'], dtype=str),
+                 cache_state=np.array(columns['cache_state'], dtype=str),
+                 latency_ms=np.array(columns['latency_ms'], dtype=np.float64),
+                 servers_visited=np.array(columns['servers_visited'], dtype=np.int32))
+        state['chunks'] += 1
+    print(f"Parsed {parsed} new queries ({offset - state['offset']} new bytes)")
+    state['offset'] = offset
+    with open(os.path.join(cache_dir, "state.json"), "w") as f:
+        json.dump(state, f)
+
+    chunks = []
+    for i in range(state['chunks']):
+        with np.load(os.path.join(cache_dir, f"chunk_{i:06d}.npz")) as chunk:
+            chunks.append({name: chunk[name] for name in COLUMNS})
+    if not chunks or not sum(len(c['domain']) for c in chunks):
         print("No queries found in log. Check your DNS experiment and log formatting.")
         return None
-    return pd.DataFrame(queries)
+    return pd.DataFrame({name: np.concatenate([c[name] for c in chunks]) for name in COLUMNS})
 
-def make_plots():
-    """parsing the DNS logs and draw/save the requested plots."""
-    df = extract_query_info(LOG_FILE)
+def make_plots(log_path=LOG_FILE, num_queries=NUM_QUERIES):
+    """parsing the DNS logs and draw/save the requested plots (num_queries=None plots all)."""
+    df = extract_query_info(log_path)
     if df is None:
         sys.exit(1)
-    subset = df.head(NUM_QUERIES)
+    subset = df if num_queries is None else df.head(num_queries)
     print(f"Preparing plots for {len(subset)} queries...")
+    # one bar per query (repeated domains get their own bar), names only while readable
+    positions = np.arange(len(subset))
+    labelled = len(subset) <= MAX_LABELLED_QUERIES
     plt.figure(figsize=(12, 6))
-    plt.bar(subset['domain'], subset['latency_ms'], color='darkcyan')
+    plt.bar(positions, subset['latency_ms'], color='darkcyan')
     plt.title(f'DNS Resolution Latency (First {len(subset)} Queries)')
-    plt.xlabel('Domain Name')
+    plt.xlabel('Domain Name' if labelled else 'Query')
     plt.ylabel('Latency (ms)')
-    plt.xticks(rotation=45, ha='right')
+    if labelled:
+        plt.xticks(positions, subset['domain'], rotation=45, ha='right')
     plt.tight_layout()
     plt.savefig('plot_latency.png')
     print("Latency plot saved as 'plot_latency.png'")
     plt.close()
-    # DNS servers hit for each query (always 1 in this setup)
+    # DNS servers hit for each query (0 for cache hits, 1 when forwarded, per hop when iterative)
     plt.figure(figsize=(12, 6))
-    plt.bar(subset['domain'], subset['servers_visited'], color='coral')
+    plt.bar(positions, subset['servers_visited'], color='coral')
     plt.title(f'DNS Servers Contacted (First {len(subset)} Queries)')
-    plt.xlabel('Domain Name')
+    plt.xlabel('Domain Name' if labelled else 'Query')
     plt.ylabel('Servers Visited')
     plt.yticks(range(0, int(subset['servers_visited'].max()) + 2))
-    plt.xticks(rotation=45, ha='right')
+    if labelled:
+        plt.xticks(positions, subset['domain'], rotation=45, ha='right')
     plt.tight_layout()
     plt.savefig('plot_servers_visited.png')
     print("Servers visited plot saved as 'plot_servers_visited.png'")
     plt.close()
 
 if __name__ == "__main__":
-    make_plots()
+    log_path = LOG_FILE
+    num_queries = NUM_QUERIES
+    if '--log' in sys.argv:
+        log_path = sys.argv[sys.argv.index('--log') + 1]
+    if '--num' in sys.argv:
+        num_queries = int(sys.argv[sys.argv.index('--num') + 1])
+    if '--all' in sys.argv:
+        num_queries = None
+    make_plots(log_path, num_queries)
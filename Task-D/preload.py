@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+"""
+Warms the cache of a running cr.py with the names of a domain list or a pcap.
+
+Every name is queried once through the resolver with the native load
+generator, so the answers land in its cache exactly as real traffic would put
+them there. Run cr.py with --cache-file to keep the warmed cache across restarts.
+"""
+import asyncio
+import sys
+from loadgen import LoadGenerator, print_summary
+from qbench import scan_pcap_for_domains
+
+PRELOAD_CONCURRENCY = 32
+
+
+def read_names(path):
+    """Domain list (one name per line) or, for .pcap/.pcapng files, the DNS query names in it."""
+    if path.endswith(('.pcap', '.pcapng')):
+        return scan_pcap_for_domains(path)
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def preload(names, server, port, concurrency=PRELOAD_CONCURRENCY):
+    generator = LoadGenerator(server, port)
+    asyncio.run(generator.run_closed_loop(names, concurrency, len(names)))
+    return generator.summary()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1].startswith('--'):
+        print(f"Usage: python3 {sys.argv[0]} <domains.txt | capture.pcap> [--server 10.0.0.5] [--port 53] "
+              "[--concurrency 32]")
+        sys.exit(1)
+    server = "10.0.0.5"
+    port = 53
+    concurrency = PRELOAD_CONCURRENCY
+    if '--server' in sys.argv:
+        server = sys.argv[sys.argv.index('--server') + 1]
+    if '--port' in sys.argv:
+        port = int(sys.argv[sys.argv.index('--port') + 1])
+    if '--concurrency' in sys.argv:
+        concurrency = int(sys.argv[sys.argv.index('--concurrency') + 1])
+
+    domain_list = read_names(sys.argv[1])
+    if not domain_list:
+        print("[Warning] No names to preload.")
+        sys.exit(1)
+    print(f"--> Preloading {len(domain_list)} names into {server}:{port}...")
+    print_summary(preload(domain_list, server, port, concurrency))
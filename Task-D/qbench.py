@@ -7,31 +7,18 @@ import sys
 import subprocess
 import time
 import re
-from scapy.all import rdpcap, DNS, DNSQR
+import loadgen
+import pcapscan
 
-# directly use the pcap file to extract the domains, was taking too much time in macOS due to swap memory caching
-# so we used tshark instead and moved on with the bench.py script to further evaluate the metrics needed.
 def scan_pcap_for_domains(capture_filename):
     """
-    Scans a packet capture file to extract all unique domain names from DNS queries.
+    Extracts the unique domain names of the DNS queries in a pcap/pcapng file,
+    in the order they were first seen. The capture is streamed (pcapscan), so
+    large files are not loaded into memory the way scapy's rdpcap() did.
     """
-    unique_domains = set()
     print(f"--> Analyzing '{capture_filename}' for DNS queries...")
     try:
-        packets = rdpcap(capture_filename)
-        # iterate through each packet to find DNS queries
-        for packet in packets:
-            # A DNS query has a DNS layer, a DNS Question Record (DNSQR), and the 'qr' flag set to 0.
-            if packet.haslayer(DNS) and packet.haslayer(DNSQR) and packet[DNS].qr == 0:
-                try:
-                    # The qname is in bytes (e.g., b'google.com.') - decode and clean it up.
-                    domain = packet[DNSQR].qname.decode('utf-8').rstrip('.')
-                    if domain:
-                        unique_domains.add(domain)
-                except UnicodeDecodeError:
-                    # Silently ignore domains that can't be decoded properly.
-                    pass
-                    
+        unique_domains = pcapscan.unique_query_names(capture_filename)
     except FileNotFoundError:
         print(f"[ERROR] The file '{capture_filename}' was not found.")
         return []
@@ -42,7 +29,7 @@ def scan_pcap_for_domains(capture_filename):
     if not unique_domains:
         print("--> No valid DNS queries were found in the capture file.")
         
-    return list(unique_domains)
+    return unique_domains
 
 def run_performance_test(domain_list):
     """
@@ -101,14 +88,21 @@ def run_performance_test(domain_list):
     print(f"  Overall Throughput:   {queries_per_second:.2f} queries/sec")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print(f"Usage: python3 {sys.argv[0]} <path_to_pcap_file>")
+    if len(sys.argv) < 2 or sys.argv[1].startswith('--'):
+        print(f"Usage: python3 {sys.argv[0]} <path_to_pcap_file> [--replay] {loadgen.NATIVE_USAGE}")
         sys.exit(1)
         
     pcap_filename = sys.argv[1]
     domains_to_test = scan_pcap_for_domains(pcap_filename)
     
-    if domains_to_test:
+    if domains_to_test and '--replay' in sys.argv:
+        # every query of the capture (repeats included) at its original pacing, or --speed N times faster
+        loadgen.run_native_benchmark(domains_to_test, schedule=pcapscan.query_schedule(pcap_filename),
+                                     **loadgen.parse_native_args(sys.argv))
+    elif domains_to_test and '--native' in sys.argv:
+        # raw UDP queries from asyncio instead of two dig processes per domain
+        loadgen.run_native_benchmark(domains_to_test, **loadgen.parse_native_args(sys.argv))
+    elif domains_to_test:
         run_performance_test(domains_to_test)
     else:
         print("--> Benchmark finished with no domains to test.")
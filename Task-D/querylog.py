@@ -0,0 +1,262 @@
+#!/usr/bin/python3
+"""
+Structured per-query log for cr.py.
+
+Handlers fill one QueryRecord per query and hand it to a QueryLogger. The
+logger only puts it on a bounded in-memory queue (a full queue drops the record
+and counts it, it never blocks); a background thread encodes and writes batches
+and rotates the file by size. Formats:
+  text   - the original "a. Timestamp ... h. Overall Time" block, what plot.py parses
+  jsonl  - one JSON object per line with a fixed set of keys
+  binary - length-prefixed fixed-layout records after an 8-byte file magic
+read_records() reads jsonl and binary logs back without any regex.
+"""
+import datetime
+import json
+import math
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+
+LOG_QUEUE_SIZE = 10000
+LOG_MAX_BYTES = 64 * 1024 * 1024
+LOG_BACKUPS = 3
+# records written per wake-up of the writer thread at most
+WRITE_BATCH = 512
+
+BINARY_MAGIC = b'DNSQLOG1'
+# length, timestamp, upstream rtt, total, qtype, cache state, strategy, outcome,
+# servers visited, upstream IPv4 - followed by the domain bytes
+BINARY_RECORD = struct.Struct('<HdffHBBBB4s')
+
+# the binary format stores these as their index, only ever append to them
+CACHE_STATES = ['NOT_FOUND', 'HIT', 'NEGATIVE']
+# answered from a cache without contacting any server
+CACHE_SERVED_STATES = ('HIT', 'NEGATIVE')
+STRATEGIES = ['Cache', 'Forward (Non-recursive)', 'Iterative']
+OUTCOMES = ['Received', 'Timeout', 'Failed', 'Error', 'Stale']
+
+FIELDS = ('timestamp', 'domain', 'qtype', 'cache_state', 'strategy', 'upstream',
+          'outcome', 'upstream_rtt_ms', 'total_ms', 'servers_visited', 'error', 'hops')
+
+
+class QueryRecord:
+    """Everything logged about one query, filled in by the handler as it goes."""
+    __slots__ = FIELDS
+
+    def __init__(self, timestamp, domain, qtype):
+        self.timestamp = timestamp
+        self.domain = domain
+        self.qtype = qtype
+        self.cache_state = 'NOT_FOUND'
+        self.strategy = None
+        self.upstream = None
+        self.outcome = None
+        self.upstream_rtt_ms = None
+        self.total_ms = None
+        self.servers_visited = 0
+        self.error = None
+        self.hops = []
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in FIELDS}
+
+    def to_text(self):
+        """The multi-line block cr.py has always printed."""
+        lines = ["DNS Query Log (Alternate)",
+                 f"a. Timestamp: {datetime.datetime.fromtimestamp(self.timestamp).isoformat()}",
+                 f"b. Domain Name: {self.domain}",
+                 f"i. Cache State: {self.cache_state}"]
+        if self.strategy:
+            lines.append(f"c. Resolution Strategy: {self.strategy}")
+        if self.strategy == 'Iterative':
+            lines += [f"d. Hop {number}: {hop}" for number, hop in enumerate(self.hops, 1)]
+            lines.append(f"j. Servers Visited: {self.servers_visited}")
+        elif self.upstream:
+            lines.append(f"d. Upstream DNS Contacted: {self.upstream}")
+            lines.append("e. Action: Relayed Upstream")
+        if self.strategy != 'Cache' and self.outcome in ('Received', 'Timeout', 'Failed'):
+            lines.append(f"f. Upstream Response: {self.outcome}")
+        elif self.outcome == 'Stale':
+            lines.append("f. Upstream Response: Timeout, Served Stale")
+        if self.upstream_rtt_ms is not None:
+            lines.append(f"g. Upstream RTT: {self.upstream_rtt_ms:.2f} ms")
+        if self.error:
+            lines.append(f"[Forwarder] Error during forwarding: {self.error}")
+        if self.total_ms is not None and self.outcome != 'Timeout':
+            lines.append(f"h. Overall Time: {self.total_ms:.2f} ms")
+        lines.append("------------------------\n")
+        return "\n".join(lines) + "\n"
+
+
+def _index(values, value):
+    try:
+        return values.index(value)
+    except ValueError:
+        return 255
+
+
+def encode_binary(record):
+    domain = record.domain.encode('utf-8', 'replace')[:255]
+    try:
+        upstream = socket.inet_aton(record.upstream) if record.upstream else bytes(4)
+    except OSError:
+        upstream = bytes(4)
+    body = BINARY_RECORD.pack(
+        BINARY_RECORD.size - 2 + len(domain), record.timestamp,
+        math.nan if record.upstream_rtt_ms is None else record.upstream_rtt_ms,
+        math.nan if record.total_ms is None else record.total_ms,
+        record.qtype, _index(CACHE_STATES, record.cache_state),
+        _index(STRATEGIES, record.strategy), _index(OUTCOMES, record.outcome),
+        min(record.servers_visited, 255), upstream)
+    return body + domain
+
+
+def encode_jsonl(record):
+    return (json.dumps(record.to_dict(), separators=(',', ':')) + "\n").encode('utf-8')
+
+
+def encode_text(record):
+    return record.to_text().encode('utf-8')
+
+
+ENCODERS = {'text': encode_text, 'jsonl': encode_jsonl, 'binary': encode_binary}
+
+
+class QueryLogger:
+    """Bounded queue + background writer thread with size-based rotation."""
+
+    def __init__(self, fmt='text', path=None, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS,
+                 queue_size=LOG_QUEUE_SIZE):
+        if fmt not in ENCODERS:
+            raise ValueError(f"unknown log format: {fmt}")
+        # on stdout the records would be mixed with the server's print()ed messages
+        if fmt != 'text' and path is None:
+            raise ValueError(f"the {fmt} log needs a file")
+        self.fmt = fmt
+        self.encode = ENCODERS[fmt]
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.written = 0
+        self.dropped = 0
+        self.file = None
+        self.size = 0
+        self._open()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _open(self):
+        if self.path is None:
+            self.file = sys.stdout.buffer
+            return
+        self.file = open(self.path, 'ab')
+        self.size = self.file.tell()
+        if self.fmt == 'binary' and self.size == 0:
+            self.file.write(BINARY_MAGIC)
+            self.size = len(BINARY_MAGIC)
+
+    def _rotate(self):
+        """path -> path.1 -> path.2 ..., the oldest backup is dropped."""
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def log(self, record):
+        """Never blocks: when the writer has fallen behind the record is dropped."""
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < WRITE_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            data = b''.join(self.encode(r) for r in batch if r is not None)
+            if data:
+                if self.path is None:
+                    sys.stdout.flush()  # keep order with the print()ed server messages
+                self.file.write(data)
+                self.file.flush()
+                self.size += len(data)
+                self.written += len(batch) - stop
+                if self.path is not None and self.size >= self.max_bytes:
+                    self._rotate()
+            if stop:
+                return
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.path is not None:
+            self.file.close()
+
+
+def detect_format(path):
+    """'binary', 'jsonl' or 'text' from the first bytes of the file."""
+    with open(path, 'rb') as f:
+        head = f.read(len(BINARY_MAGIC))
+    if head == BINARY_MAGIC:
+        return 'binary'
+    if head.startswith(b'{'):
+        return 'jsonl'
+    return 'text'
+
+
+def read_records(path, offset=0):
+    """
+    Yields (record dict, offset after the record) for a jsonl or binary log,
+    starting at byte 'offset'. A partially written last record is not yielded.
+    """
+    fmt = detect_format(path)
+    with open(path, 'rb') as f:
+        if fmt == 'jsonl':
+            f.seek(offset)
+            pos = offset
+            for line in f:
+                if not line.endswith(b"\n"):
+                    return
+                pos += len(line)
+                yield json.loads(line), pos
+        elif fmt == 'binary':
+            base = max(offset, len(BINARY_MAGIC))
+            f.seek(base)
+            data = f.read()
+            pos = 0
+            while pos + 2 <= len(data):
+                length = struct.unpack_from('<H', data, pos)[0]
+                end = pos + 2 + length
+                if end > len(data):
+                    return
+                (_, ts, upstream_rtt, total, qtype, cache_state, strategy, outcome,
+                 servers_visited, upstream) = BINARY_RECORD.unpack_from(data, pos)
+                domain = data[pos + BINARY_RECORD.size:end].decode('utf-8', 'replace')
+                yield {
+                    'timestamp': ts, 'domain': domain, 'qtype': qtype,
+                    'cache_state': CACHE_STATES[cache_state] if cache_state < len(CACHE_STATES) else None,
+                    'strategy': STRATEGIES[strategy] if strategy < len(STRATEGIES) else None,
+                    'upstream': socket.inet_ntoa(upstream) if upstream != bytes(4) else None,
+                    'outcome': OUTCOMES[outcome] if outcome < len(OUTCOMES) else None,
+                    'upstream_rtt_ms': None if math.isnan(upstream_rtt) else upstream_rtt,
+                    'total_ms': None if math.isnan(total) else total,
+                    'servers_visited': servers_visited, 'error': None, 'hops': [],
+                }, base + end
+                pos = end
+        else:
+            raise ValueError(f"{path} is a text log, parse it with plot.py")
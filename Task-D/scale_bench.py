@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+"""
+QPS scaling of cr.py --workers 1..N.
+
+For every worker count the resolver is started on its own, warmed up with one
+pass over the domain list, and then loaded with the native closed-loop load
+generator. SO_REUSEPORT spreads flows (source address/port pairs) rather than
+single queries, so the generator uses many client sockets.
+"""
+import asyncio
+import csv
+import os
+import signal
+import subprocess
+import sys
+import time
+from loadgen import LoadGenerator
+
+# seconds the resolver gets to bind before the first query
+STARTUP_WAIT = 1.5
+CLIENT_SOCKETS = 64
+
+
+def read_domains(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def measure(domains, server, port, concurrency, count):
+    generator = LoadGenerator(server, port, sockets=CLIENT_SOCKETS)
+    asyncio.run(generator.run_closed_loop(domains, concurrency, count))
+    return generator.summary()
+
+
+def upstream_args(argv):
+    """--upstreams / --upstream-port of the benchmark command line, handed on to cr.py."""
+    args = []
+    for flag in ('--upstreams', '--upstream-port'):
+        if flag in argv:
+            args += [flag, argv[argv.index(flag) + 1]]
+    return args
+
+
+def start_resolver(*args):
+    """Starts cr.py with 'args'; None (and a message) if it exits during startup."""
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "cr.py")] + list(args)
+    print(f"--> {' '.join(cmd[1:])}")
+    resolver = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(STARTUP_WAIT)
+    if resolver.poll() is not None:
+        print(f"[Error] resolver exited with code {resolver.returncode}, aborting")
+        return None
+    return resolver
+
+
+def stop_resolver(resolver):
+    """Ctrl+C, so the resolver runs its shutdown (reports, cache snapshot)."""
+    resolver.send_signal(signal.SIGINT)
+    try:
+        resolver.wait(10)
+    except subprocess.TimeoutExpired:
+        resolver.kill()
+        resolver.wait()
+
+
+def run_scaling(domains, max_workers, engine, listen_ip, port, concurrency, count, extra_args=()):
+    results = []
+    for workers in range(1, max_workers + 1):
+        resolver = start_resolver("--engine", engine, "--listen", listen_ip, "--port", str(port),
+                                  "--workers", str(workers), *extra_args)
+        if resolver is None:
+            break
+        try:
+            measure(domains, listen_ip, port, concurrency, len(domains))  # warm-up
+            stats = measure(domains, listen_ip, port, concurrency, count)
+        finally:
+            stop_resolver(resolver)
+        stats['workers'] = workers
+        results.append(stats)
+        print(f"    {stats['answered_qps']:.0f} answered queries/sec, "
+              f"p50 {stats['p50_ms']:.3f} ms, p99 {stats['p99_ms']:.3f} ms, {stats['timeouts']} timeouts")
+    return results
+
+
+def print_table(results):
+    if not results:
+        return
+    base = results[0]['answered_qps'] or 1.0
+    print("\n--- Worker Scaling Summary ---")
+    print(f"{'workers':>8}{'answered qps':>14}{'speed-up':>10}{'p50 ms':>10}{'p99 ms':>10}{'timeouts':>10}")
+    for r in results:
+        print(f"{r['workers']:>8}{r['answered_qps']:>14.0f}{r['answered_qps'] / base:>9.2f}x"
+              f"{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['timeouts']:>10}")
+
+
+def write_results(results, path):
+    with open(path, 'w', newline='') as out:
+        w = csv.writer(out)
+        w.writerow(['workers', 'answered_qps', 'p50_ms', 'p99_ms', 'timeouts'])
+        for r in results:
+            w.writerow([r['workers'], f"{r['answered_qps']:.1f}", f"{r['p50_ms']:.3f}",
+                        f"{r['p99_ms']:.3f}", r['timeouts']])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1].startswith('--'):
+        print(f"Usage: python3 {sys.argv[0]} <domain_file.txt> [--max-workers N] [--engine async] "
+              "[--listen 127.0.0.1] [--port 5353] [--concurrency 64] [--count 20000] [--out scaling.csv] "
+              "[--upstreams 127.0.0.1 --upstream-port 5300]")
+        sys.exit(1)
+    max_workers = os.cpu_count() or 1
+    engine = "async"
+    listen_ip = "127.0.0.1"
+    port = 5353
+    concurrency = 64
+    count = 20000
+    out_path = None
+    if '--max-workers' in sys.argv:
+        max_workers = int(sys.argv[sys.argv.index('--max-workers') + 1])
+    if '--engine' in sys.argv:
+        engine = sys.argv[sys.argv.index('--engine') + 1]
+    if '--listen' in sys.argv:
+        listen_ip = sys.argv[sys.argv.index('--listen') + 1]
+    if '--port' in sys.argv:
+        port = int(sys.argv[sys.argv.index('--port') + 1])
+    if '--concurrency' in sys.argv:
+        concurrency = int(sys.argv[sys.argv.index('--concurrency') + 1])
+    if '--count' in sys.argv:
+        count = int(sys.argv[sys.argv.index('--count') + 1])
+    if '--out' in sys.argv:
+        out_path = sys.argv[sys.argv.index('--out') + 1]
+
+    domain_list = read_domains(sys.argv[1])
+    if not domain_list:
+        print("[Warning] The list of domains to test is empty. Aborting benchmark.")
+        sys.exit(1)
+    scaling = run_scaling(domain_list, max_workers, engine, listen_ip, port, concurrency, count,
+                          upstream_args(sys.argv))
+    print_table(scaling)
+    if out_path:
+        write_results(scaling, out_path)
+        print(f"--> Results saved to '{out_path}'")
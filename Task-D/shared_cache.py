@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+"""
+Answer cache tier in a memory-mapped file, shared by every resolver process on
+the host (cr.py --shared-cache path) and kept across restarts.
+
+The file is a fixed hash table: a 64-byte header, then SLOTS slots of
+SLOT_SIZE bytes. A key hashes (crc32, the same in every process) to a bucket
+of WAYS neighbouring slots. A slot holds a sequence number, the key's crc,
+the stored / expiry wall-clock times, the key, the answer's wire bytes and the
+offsets of its TTL fields. Answers too big for a slot are not shared.
+
+Reads take no lock and make no system call (seqlock): the reader reads the
+slot's sequence number, copies the slot, and reads the sequence number again.
+An odd number means a write is in progress; a changed number means the copy
+may be torn. Either way the reader tries again and after READ_RETRIES gives up
+(a miss). A writer holds an fcntl lock on the bucket, which keeps out writers
+in other processes, plus a thread lock for its own process. It makes the
+number odd, writes the slot, then makes it even again. A writer that died
+half-way leaves an odd number behind. Readers miss on that slot until the
+next write to it.
+
+Times are wall-clock (time.time()), so entries age correctly across restarts.
+"""
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+import dnswire
+from compact_cache import encode_key, ttl_table
+from dns_cache import answer_lifetime
+
+SLOTS = 65536
+SLOT_SIZE = 512
+WAYS = 4
+READ_RETRIES = 3
+
+MAGIC = b'DNSSHM01'
+# magic, slot count, slot size, ways
+FILE_HEADER = struct.Struct('<8sIII')
+HEADER_SIZE = 64
+# sequence, key crc, stored at, expires at, key length, wire length, TTL count
+SLOT_HEADER = struct.Struct('<IIddHHH')
+SLOT_DATA = 32
+U32 = struct.Struct('<I')
+TTL = struct.Struct('!I')
+
+
+class SharedCache:
+    """
+    get() / put() like DNSCache, on the file at 'path'. An existing file with
+    the same layout is reused, anything else is replaced by an empty table.
+    """
+
+    def __init__(self, path, slots=SLOTS, slot_size=SLOT_SIZE, ways=WAYS, clock=time.time):
+        if slots % ways or slot_size < SLOT_DATA + 64:
+            raise ValueError(f"bad shared cache layout: {slots} slots of {slot_size} bytes, {ways} ways")
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.ways = ways
+        self.buckets = slots // ways
+        self.clock = clock
+        size = HEADER_SIZE + slots * slot_size
+        header = FILE_HEADER.pack(MAGIC, slots, slot_size, ways)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        # the first process to open the file sets it up, the others wait for it
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+        try:
+            if os.fstat(self.fd).st_size != size or os.pread(self.fd, FILE_HEADER.size, 0) != header:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, size)
+                os.pwrite(self.fd, header, 0)
+                self.reused = False
+            else:
+                self.reused = True
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+        self.map = mmap.mmap(self.fd, size)
+        # slices of the view compare and copy without an intermediate bytes object
+        self.view = memoryview(self.map)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.too_big = 0
+        self.torn_reads = 0
+
+    def _bucket(self, key_bytes):
+        crc = zlib.crc32(key_bytes)
+        return crc, HEADER_SIZE + (crc % self.buckets) * self.ways * self.slot_size
+
+    def _read(self, offset, crc, key_bytes):
+        """
+        (stored_at, expires_at, response, ttl_offsets) of the slot if it holds the
+        key, else None. The key is compared in place, only the response is copied.
+        """
+        view = self.view
+        for _ in range(READ_RETRIES):
+            seq, slot_crc, stored_at, expires_at, key_length, wire_length, ttl_count = \
+                SLOT_HEADER.unpack_from(view, offset)
+            if seq & 1:
+                self.torn_reads += 1
+                continue
+            if slot_crc != crc or key_length != len(key_bytes):
+                return None
+            start = offset + SLOT_DATA + key_length
+            if start + wire_length + 2 * ttl_count > offset + self.slot_size:
+                self.torn_reads += 1  # lengths from a header being rewritten
+                continue
+            matches = view[offset + SLOT_DATA:start] == key_bytes
+            response = bytearray(view[start:start + wire_length])
+            ttl_offsets = ttl_table(ttl_count).unpack_from(view, start + wire_length)
+            if U32.unpack_from(view, offset)[0] != seq:
+                self.torn_reads += 1
+                continue
+            if not matches:
+                return None
+            return stored_at, expires_at, response, ttl_offsets
+        return None
+
+    def get(self, key, query):
+        """Ready-to-send response for 'query' from the shared table, or None."""
+        key_bytes = encode_key(key)
+        crc, bucket = self._bucket(key_bytes)
+        now = self.clock()
+        for way in range(self.ways):
+            found = self._read(bucket + way * self.slot_size, crc, key_bytes)
+            if found is None:
+                continue
+            stored_at, expires_at, response, ttl_offsets = found
+            if now >= expires_at:
+                break
+            question_end = dnswire.skip_name(query, 12) + 4
+            response[:2] = query[:2]
+            response[12:question_end] = query[12:question_end]
+            elapsed = int(now - stored_at)
+            for ttl_off in ttl_offsets:
+                ttl = TTL.unpack_from(response, ttl_off)[0]
+                TTL.pack_into(response, ttl_off, ttl - elapsed if ttl > elapsed else 0)
+            self.hits += 1
+            return bytes(response)
+        self.misses += 1
+        return None
+
+    def put(self, key, response):
+        """Shares an upstream answer, returns the lifetime used (0 if not stored)."""
+        lifetime, ttl_offsets, _, _ = answer_lifetime(response)
+        if lifetime <= 0:
+            return 0
+        key_bytes = encode_key(key)
+        body = key_bytes + bytes(response) + ttl_table(len(ttl_offsets)).pack(*ttl_offsets)
+        if SLOT_DATA + len(body) > self.slot_size:
+            self.too_big += 1
+            return 0
+        crc, bucket = self._bucket(key_bytes)
+        now = self.clock()
+        mm = self.map
+        view = self.view
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, self.ways * self.slot_size, bucket)
+            try:
+                # the slot already holding the key, else an empty or expired one, else the one expiring first
+                target, target_expiry = None, None
+                for way in range(self.ways):
+                    offset = bucket + way * self.slot_size
+                    _, slot_crc, _, expires_at, key_length, _, _ = SLOT_HEADER.unpack_from(mm, offset)
+                    if (slot_crc == crc and key_length == len(key_bytes)
+                            and view[offset + SLOT_DATA:offset + SLOT_DATA + key_length] == key_bytes):
+                        target = offset
+                        break
+                    if expires_at <= now:
+                        expires_at = 0.0
+                    if target is None or expires_at < target_expiry:
+                        target, target_expiry = offset, expires_at
+                seq = U32.unpack_from(mm, target)[0]
+                # an odd number left behind by a writer that died stays odd while we write
+                seq = (seq + 1 if seq % 2 == 0 else seq + 2) & 0xFFFFFFFF
+                U32.pack_into(mm, target, seq)
+                mm[target + SLOT_DATA:target + SLOT_DATA + len(body)] = body
+                SLOT_HEADER.pack_into(mm, target, seq, crc, now, now + lifetime, len(key_bytes), len(response),
+                                      len(ttl_offsets))
+                U32.pack_into(mm, target, (seq + 1) & 0xFFFFFFFF)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, self.ways * self.slot_size, bucket)
+            self.stores += 1
+        return lifetime
+
+    def entries(self):
+        """Number of live entries in the table (a full scan)."""
+        now = self.clock()
+        return sum(1 for slot in range(self.slots)
+                   if SLOT_HEADER.unpack_from(self.map, HEADER_SIZE + slot * self.slot_size)[3] > now)
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'too_big': self.too_big,
+            'torn_reads': self.torn_reads,
+        }
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+        os.close(self.fd)
+
+
+def format_shared_stats(stats):
+    return (f"[Shared cache] {stats['path']}: hits {stats['hits']}, misses {stats['misses']}, "
+            f"stores {stats['stores']} ({stats['too_big']} answers too big for a slot), "
+            f"torn reads retried {stats['torn_reads']}")
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+"""
+In-flight query coalescing ("singleflight") for the forwarder.
+
+When several clients ask the same (qname, qtype, qclass) while the first of
+these queries is still waiting on the upstream, only that first query is sent.
+The others wait for its answer and each gets a copy carrying its own
+transaction ID and question bytes. Failures (timeouts included) are shared the
+same way, so a burst never turns into a burst of upstream retries.
+"""
+import asyncio
+import copy
+import threading
+import dnswire
+
+
+def adopt(payload, result):
+    """A waiter's copy of the leader's (response, upstream) result."""
+    response, upstream = result
+    return dnswire.answer_for(payload, response), upstream
+
+
+def waiter_error(error):
+    """
+    A new exception of the leader's type for one waiter. Raising the leader's
+    own exception in every waiter would share and keep growing its traceback.
+    """
+    return copy.copy(error)
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Thread-based version for the sync/threaded engines."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.upstream = 0
+        self.coalesced = 0
+
+    def query(self, key, payload, fetch):
+        """
+        Returns fetch(payload), running it only once for all callers that ask
+        for 'key' at the same time. The leader's timeout bounds everyone's wait.
+        fetch returns (response, upstream); waiters get their own copy of the
+        response together with the same upstream.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+                self.upstream += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise waiter_error(call.error) from call.error
+            return adopt(payload, call.result)
+        try:
+            call.result = fetch(payload)
+            return call.result
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+
+    def stats(self):
+        return {'upstream': self.upstream, 'coalesced': self.coalesced, 'in_flight': len(self.calls)}
+
+
+class AsyncSingleFlight:
+    """asyncio version, the waiters share one future."""
+
+    def __init__(self):
+        self.calls = {}
+        self.upstream = 0
+        self.coalesced = 0
+
+    async def query(self, key, payload, fetch):
+        """Same as SingleFlight.query with 'fetch' a coroutine function."""
+        future = self.calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            # shield: a waiter giving up must not cancel the shared query
+            try:
+                result = await asyncio.shield(future)
+            except Exception as err:
+                raise waiter_error(err) from err
+            return adopt(payload, result)
+        future = self.calls[key] = asyncio.get_running_loop().create_future()
+        self.upstream += 1
+        try:
+            result = await fetch(payload)
+            future.set_result(result)
+            return result
+        except Exception as err:
+            future.set_exception(err)
+            future.exception()  # nobody may be waiting, don't warn about it
+            raise
+        finally:
+            del self.calls[key]
+            if not future.done():
+                future.cancel()
+
+    def stats(self):
+        return {'upstream': self.upstream, 'coalesced': self.coalesced, 'in_flight': len(self.calls)}
+
+
+def format_coalescing_stats(stats):
+    total = stats['upstream'] + stats['coalesced']
+    saved = 100.0 * stats['coalesced'] / total if total else 0.0
+    return (f"[Coalescing] upstream queries {stats['upstream']}, coalesced {stats['coalesced']} "
+            f"({saved:.1f}% of forwarded queries saved), in flight {stats['in_flight']}")
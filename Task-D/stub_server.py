@@ -0,0 +1,274 @@
+#!/usr/bin/python3
+"""
+Local stub upstream for offline, repeatable benchmarks of cr.py.
+
+Answers authoritatively from a small zone file (A/AAAA/CNAME records) that
+--make-zone generates from the domains_h*_unique.txt lists; addresses are
+derived from a hash of the name, so every run gets the same zone. Each answer
+is delayed by a sample of the configured latency distribution, and queries can
+be dropped (--loss) or answered NXDOMAIN (--nxdomain) at a given rate. With
+--seed the random choices repeat from run to run. UDP answers larger than the
+query's EDNS(0) buffer (512 bytes without one) are truncated, and the same
+port serves DNS over TCP. It needs neither root nor Mininet:
+
+    python3 stub_server.py --make-zone stub.zone ../Task-B/domains_h*_unique.txt
+    python3 stub_server.py stub.zone --port 5300 --latency uniform:5,20 --loss 0.01
+    python3 cr.py --engine async --listen 127.0.0.1 --port 5353 --upstreams 127.0.0.1 --upstream-port 5300
+"""
+import asyncio
+import hashlib
+import ipaddress
+import math
+import random
+import socket
+import sys
+import dnstcp
+import dnswire
+
+ZONE_TTL = 300
+# SOA minimum, i.e. how long resolvers may cache the NXDOMAIN / NODATA answers
+NEGATIVE_TTL = 60
+# RFC 2544 benchmarking range and the IPv6 documentation prefix
+ADDRESS_NET_V4 = ipaddress.ip_network("198.18.0.0/15")
+ADDRESS_NET_V6 = ipaddress.ip_network("2001:db8::/32")
+SOA_RDATA = (dnswire.encode_name("ns.stub.invalid") + dnswire.encode_name("hostmaster.stub.invalid")
+             + dnswire.U32.pack(1) + dnswire.U32.pack(3600) + dnswire.U32.pack(600)
+             + dnswire.U32.pack(86400) + dnswire.U32.pack(NEGATIVE_TTL))
+# rdata encoders of the record types a zone file may contain
+RDATA = {
+    'A': (dnswire.TYPE_A, lambda value: socket.inet_pton(socket.AF_INET, value)),
+    'AAAA': (dnswire.TYPE_AAAA, lambda value: socket.inet_pton(socket.AF_INET6, value)),
+    'CNAME': (dnswire.TYPE_CNAME, dnswire.encode_name),
+}
+
+
+def _hashed_address(name, network):
+    digest = int.from_bytes(hashlib.sha1(name.encode()).digest(), 'big')
+    return network[digest % network.num_addresses]
+
+
+def make_zone(domain_files, path, ttl=ZONE_TTL):
+    """Writes one A and one AAAA record per unique name of the lists, returns the name count."""
+    names = {}
+    for domain_file in domain_files:
+        with open(domain_file) as f:
+            for line in f:
+                name = line.strip().lower().rstrip('.')
+                if name:
+                    names[name] = None
+    with open(path, 'w') as out:
+        out.write(f"; generated from {', '.join(domain_files)}\n")
+        for name in names:
+            out.write(f"{name}. {ttl} IN A {_hashed_address(name, ADDRESS_NET_V4)}\n")
+            out.write(f"{name}. {ttl} IN AAAA {_hashed_address(name, ADDRESS_NET_V6)}\n")
+    return len(names)
+
+
+class Zone:
+    """name -> {qtype: [(ttl, rdata), ...]} read from a 'name ttl IN type value' file."""
+
+    def __init__(self):
+        self.records = {}
+
+    @classmethod
+    def load(cls, path):
+        zone = cls()
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                line = line.split(';', 1)[0].strip()
+                if not line:
+                    continue
+                fields = line.split()
+                if len(fields) != 5 or fields[2].upper() != 'IN' or fields[3].upper() not in RDATA:
+                    raise ValueError(f"{path}:{number}: expected 'name ttl IN A|AAAA|CNAME value'")
+                name, ttl, _, rtype, value = fields
+                qtype, encode = RDATA[rtype.upper()]
+                zone.records.setdefault(name.lower().rstrip('.'), {}).setdefault(qtype, []).append(
+                    (int(ttl), encode(value)))
+        return zone
+
+    def __len__(self):
+        return len(self.records)
+
+    def answer(self, query, nxdomain=False):
+        """Response to 'query'; names outside the zone (or 'nxdomain') get NXDOMAIN."""
+        qid, flags, _, _, _, _ = dnswire.unpack_header(query)
+        qname, qtype, qclass, end = dnswire.parse_question(query)
+        rrsets = None if nxdomain else self.records.get(qname.lower().rstrip('.'))
+        answers = []
+        rcode = dnswire.RCODE_NOERROR
+        if rrsets is None:
+            rcode = dnswire.RCODE_NXDOMAIN
+        else:
+            # a CNAME answers every type, the resolver follows it
+            for ttl, rdata in rrsets.get(qtype) or rrsets.get(dnswire.TYPE_CNAME, []):
+                rtype = qtype if qtype in rrsets else dnswire.TYPE_CNAME
+                # the owner is a pointer to the name in the question
+                answers.append(b'\xc0\x0c' + dnswire.RR_FIXED.pack(rtype, qclass, ttl, len(rdata)) + rdata)
+        authority = []
+        if not answers:
+            # negative answers carry the SOA the resolver takes the cache TTL from
+            authority.append(b'\xc0\x0c' + dnswire.RR_FIXED.pack(dnswire.TYPE_SOA, qclass, NEGATIVE_TTL,
+                                                                 len(SOA_RDATA)) + SOA_RDATA)
+        flags = dnswire.FLAG_QR | dnswire.FLAG_AA | dnswire.FLAG_RA | (flags & dnswire.FLAG_RD) | rcode
+        header = dnswire.HEADER.pack(qid, flags, 1, len(answers), len(authority), 0)
+        return header + bytes(query[12:end]) + b''.join(answers) + b''.join(authority)
+
+
+def udp_answer(query, response):
+    """The response as sent over UDP: with an OPT record for EDNS(0) queries, TC if too big."""
+    opt = dnswire.find_opt(query)
+    if opt is None:
+        return dnswire.truncated(response) if len(response) > dnswire.CLASSIC_UDP_SIZE else response
+    response = dnswire.add_opt(response)
+    if len(response) > max(opt[1], dnswire.CLASSIC_UDP_SIZE):
+        response = dnswire.add_opt(dnswire.truncated(response))
+    return response
+
+
+def latency_sampler(spec, rng):
+    """
+    Seconds-returning sampler for 'fixed:MS', 'uniform:LO,HI', 'normal:MEAN,SD',
+    'lognormal:MEDIAN,SIGMA' or 'exp:MEAN' (all in milliseconds); '0' for none.
+    """
+    kind, _, args = spec.partition(':')
+    values = [float(v) for v in args.split(',') if v]
+    if kind in ('0', 'none'):
+        return lambda: 0.0
+    if kind == 'fixed' and len(values) == 1:
+        return lambda: values[0] / 1000
+    if kind == 'uniform' and len(values) == 2:
+        return lambda: rng.uniform(*values) / 1000
+    if kind == 'normal' and len(values) == 2:
+        return lambda: max(rng.gauss(*values), 0.0) / 1000
+    if kind == 'lognormal' and len(values) == 2:
+        return lambda: rng.lognormvariate(math.log(values[0]), values[1]) / 1000
+    if kind == 'exp' and len(values) == 1:
+        return lambda: rng.expovariate(1 / values[0]) / 1000
+    raise ValueError(f"unknown latency distribution: {spec}")
+
+
+class StubProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, zone, latency, loss, nxdomain_rate, rng):
+        self.zone = zone
+        self.latency = latency
+        self.loss = loss
+        self.nxdomain_rate = nxdomain_rate
+        self.rng = rng
+        self.transport = None
+        self.stats = {'queries': 0, 'answered': 0, 'dropped': 0, 'nxdomain': 0, 'malformed': 0,
+                      'truncated': 0, 'tcp': 0}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def respond(self, data, send, over_tcp=False):
+        """Answers one query through send(response), after the sampled delay."""
+        self.stats['queries'] += 1
+        # always draw both numbers, so a seed gives the same choices for the same query order
+        drop = self.rng.random() < self.loss
+        nxdomain = self.rng.random() < self.nxdomain_rate
+        try:
+            response = self.zone.answer(data, nxdomain)
+            if over_tcp:
+                self.stats['tcp'] += 1
+                if dnswire.find_opt(data) is not None:
+                    response = dnswire.add_opt(response)
+            else:
+                response = udp_answer(data, response)
+        except (dnswire.WireError, IndexError):
+            self.stats['malformed'] += 1
+            return
+        if drop and not over_tcp:
+            self.stats['dropped'] += 1
+            return
+        if dnswire.rcode(response) == dnswire.RCODE_NXDOMAIN:
+            self.stats['nxdomain'] += 1
+        if dnswire.unpack_header(response)[1] & dnswire.FLAG_TC:
+            self.stats['truncated'] += 1
+        self.stats['answered'] += 1
+        delay = self.latency()
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, send, response)
+        else:
+            send(response)
+
+    def datagram_received(self, data, addr):
+        self.respond(data, lambda response: self.transport.sendto(response, addr))
+
+    async def tcp_connection(self, reader, writer):
+        try:
+            while True:
+                length = dnstcp.LENGTH.unpack(await reader.readexactly(2))[0]
+                self.respond(await reader.readexactly(length),
+                             lambda response: writer.write(dnstcp.frame(response)), over_tcp=True)
+        except (asyncio.IncompleteReadError, OSError):
+            writer.close()
+
+    def error_received(self, exc):
+        pass
+
+
+def format_stub_stats(stats):
+    return (f"[Stub] queries {stats['queries']} ({stats['tcp']} over TCP), answered {stats['answered']} "
+            f"({stats['nxdomain']} NXDOMAIN, {stats['truncated']} truncated), dropped {stats['dropped']}, "
+            f"malformed {stats['malformed']}")
+
+
+async def serve(zone, listen_ip, port, latency, loss, nxdomain_rate, rng):
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: StubProtocol(zone, latency, loss, nxdomain_rate, rng), local_addr=(listen_ip, port))
+    tcp_server = await asyncio.start_server(protocol.tcp_connection, listen_ip, port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        tcp_server.close()
+        transport.close()
+        print(format_stub_stats(protocol.stats))
+
+
+if __name__ == "__main__":
+    if '--make-zone' in sys.argv:
+        zone_path = sys.argv[sys.argv.index('--make-zone') + 1]
+        lists = [a for a in sys.argv[sys.argv.index('--make-zone') + 2:] if not a.startswith('--')]
+        if not lists:
+            print(f"Usage: python3 {sys.argv[0]} --make-zone out.zone domains_h1_unique.txt [...]")
+            sys.exit(1)
+        print(f"--> {make_zone(lists, zone_path)} names written to '{zone_path}'")
+        sys.exit(0)
+    if len(sys.argv) < 2 or sys.argv[1].startswith('--'):
+        print(f"Usage: python3 {sys.argv[0]} <zone file> [--listen 127.0.0.1] [--port 5300] "
+              "[--latency fixed:MS|uniform:LO,HI|normal:MEAN,SD|lognormal:MEDIAN,SIGMA|exp:MEAN] "
+              "[--loss 0.01] [--nxdomain 0.05] [--seed N]")
+        print(f"       python3 {sys.argv[0]} --make-zone out.zone domains_h1_unique.txt [...]")
+        sys.exit(1)
+    listen_ip = "127.0.0.1"
+    port = 5300
+    latency_spec = "0"
+    loss = 0.0
+    nxdomain_rate = 0.0
+    seed = None
+    if '--listen' in sys.argv:
+        listen_ip = sys.argv[sys.argv.index('--listen') + 1]
+    if '--port' in sys.argv:
+        port = int(sys.argv[sys.argv.index('--port') + 1])
+    if '--latency' in sys.argv:
+        latency_spec = sys.argv[sys.argv.index('--latency') + 1]
+    if '--loss' in sys.argv:
+        loss = float(sys.argv[sys.argv.index('--loss') + 1])
+    if '--nxdomain' in sys.argv:
+        nxdomain_rate = float(sys.argv[sys.argv.index('--nxdomain') + 1])
+    if '--seed' in sys.argv:
+        seed = int(sys.argv[sys.argv.index('--seed') + 1])
+
+    random_source = random.Random(seed)
+    stub_zone = Zone.load(sys.argv[1])
+    sampler = latency_sampler(latency_spec, random_source)
+    print(f"Stub upstream active at {listen_ip}:{port} ({len(stub_zone)} names, latency {latency_spec}, "
+          f"loss {loss:g}, NXDOMAIN {nxdomain_rate:g})...")
+    try:
+        asyncio.run(serve(stub_zone, listen_ip, port, sampler, loss, nxdomain_rate, random_source))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+"""
+Supervisor for cr.py --workers N.
+
+A single resolver process is held to one core by the GIL. With --workers the
+main process forks N workers that all bind the listen address with
+SO_REUSEPORT, so the kernel spreads client flows across them. Each worker keeps
+its own answer cache and sends its counters to the supervisor every few
+seconds; the supervisor prints the merged totals and restarts workers that die.
+"""
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+# a worker exiting with this code could not start (e.g. the bind was refused),
+# restarting it would only fail again
+EXIT_NO_RESTART = 3
+# seconds between liveness checks and between merged reports
+CHECK_INTERVAL = 1.0
+REPORT_INTERVAL = 10.0
+# how long workers get to finish their own shutdown before being terminated
+STOP_TIMEOUT = 3.0
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+class Supervisor:
+    """
+    Runs target(index, stats_queue, *args) in 'count' forked processes. Workers
+    put (pid, stats dict) on stats_queue; numeric values are summed across them.
+    """
+
+    def __init__(self, count, target, args=()):
+        self.ctx = multiprocessing.get_context('fork')
+        self.count = count
+        self.target = target
+        self.args = tuple(args)
+        self.stats_queue = self.ctx.Queue()
+        self.workers = {}
+        self.latest = {}     # pid -> last stats of a running worker
+        self.retired = {}    # summed final stats of workers that have exited
+        self.restarts = 0
+
+    def _start(self, index):
+        proc = self.ctx.Process(target=self.target, args=(index, self.stats_queue) + self.args,
+                                name=f"cr-worker-{index}", daemon=True)
+        proc.start()
+        self.latest[proc.pid] = {}
+        return proc
+
+    def _drain(self, timeout=0):
+        """Reads pending stats, waiting up to 'timeout' for the first one."""
+        while True:
+            try:
+                pid, stats = self.stats_queue.get(timeout=timeout) if timeout else self.stats_queue.get_nowait()
+            except queue.Empty:
+                return
+            timeout = 0
+            if pid in self.latest:  # ignore stragglers of retired workers
+                self.latest[pid] = stats
+
+    def _retire(self, proc):
+        for key, value in self.latest.pop(proc.pid, {}).items():
+            self.retired[key] = self.retired.get(key, 0) + value
+
+    def _check(self):
+        dead = [(index, proc) for index, proc in self.workers.items() if not proc.is_alive()]
+        if not dead:
+            return
+        self._drain()
+        for index, proc in dead:
+            self._retire(proc)
+            if proc.exitcode == EXIT_NO_RESTART:
+                print(f"[Supervisor] worker {index} (pid {proc.pid}) failed to start, not restarting")
+                del self.workers[index]
+                continue
+            print(f"[Supervisor] worker {index} (pid {proc.pid}) exited with code {proc.exitcode}, restarting")
+            self.restarts += 1
+            self.workers[index] = self._start(index)
+
+    def merged(self):
+        total = dict(self.retired)
+        for stats in self.latest.values():
+            for key, value in stats.items():
+                total[key] = total.get(key, 0) + value
+        return total
+
+    def stop(self):
+        """Interrupts the workers so they report their final counters, kills stragglers."""
+        for proc in self.workers.values():
+            if proc.is_alive():
+                os.kill(proc.pid, signal.SIGINT)
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for proc in self.workers.values():
+            proc.join(max(deadline - time.monotonic(), 0))
+        for proc in self.workers.values():
+            if proc.is_alive():
+                proc.kill()
+                proc.join()
+        self._drain()
+        for proc in self.workers.values():
+            self._retire(proc)
+        self.workers = {}
+
+    def run(self, format_stats):
+        """
+        Blocks until Ctrl+C / SIGTERM or until no worker is left;
+        format_stats(merged) gives the report line.
+        """
+        # inherited by the workers, so a plain kill shuts everything down cleanly
+        signal.signal(signal.SIGTERM, _interrupt)
+        for index in range(self.count):
+            self.workers[index] = self._start(index)
+        next_report = time.monotonic() + REPORT_INTERVAL
+        try:
+            while self.workers:
+                self._drain(CHECK_INTERVAL)
+                self._check()
+                if time.monotonic() >= next_report:
+                    print(self.report(format_stats))
+                    next_report += REPORT_INTERVAL
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            print(self.report(format_stats))
+
+    def report(self, format_stats):
+        return (f"[Supervisor] {len(self.workers)} workers running, {self.restarts} restarts: "
+                f"{format_stats(self.merged())}")
@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+"""
+Long-lived pool of upstream UDP sockets for the threaded/sync engines.
+
+Opening a socket per query costs several syscalls and an ephemeral port each
+time. The pool keeps a few connected sockets open for the life of the resolver;
+every socket has a receiver thread that hands answers to the waiting query by
+transaction ID, so many queries can share one socket at the same time.
+"""
+import errno
+import random
+import socket
+import struct
+import threading
+from dnswire import question_section
+
+# number of upstream sockets kept open
+POOL_SIZE = 4
+# range the random source ports are drawn from
+SOURCE_PORT_RANGE = (1024, 65535)
+BIND_ATTEMPTS = 20
+RECV_SIZE = 4096
+
+
+def open_upstream_socket(server, port):
+    """
+    Returns a UDP socket bound to a random source port and connected to
+    (server, port). Connecting makes the kernel drop datagrams from any other
+    source, so only the upstream can answer on it.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for _ in range(BIND_ATTEMPTS):
+        try:
+            sock.bind(('', random.randint(*SOURCE_PORT_RANGE)))
+            break
+        except OSError as err:
+            if err.errno != errno.EADDRINUSE:
+                sock.close()
+                raise
+    else:
+        sock.bind(('', 0))  # let the kernel pick
+    sock.connect((server, port))
+    return sock
+
+
+class _Waiter:
+    __slots__ = ('question', 'event', 'response')
+
+    def __init__(self, question, event=None):
+        self.question = question
+        # several waiters may share one event, e.g. a query and its hedge
+        self.event = event if event is not None else threading.Event()
+        self.response = None
+
+
+class PooledSocket:
+    """One upstream socket plus the receiver thread demultiplexing its answers."""
+
+    def __init__(self, index, server, port):
+        self.index = index
+        self.server = server
+        self.sock = open_upstream_socket(server, port)
+        self.source_port = self.sock.getsockname()[1]
+        self.waiters = {}
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.sent = 0
+        self.received = 0
+        self.timeouts = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self._receive_loop, daemon=True)
+        self.thread.start()
+
+    def _receive_loop(self):
+        while not self.closed:
+            try:
+                data = self.sock.recv(RECV_SIZE)
+            except OSError:
+                if self.closed:
+                    return
+                continue  # ICMP port unreachable etc., the query will time out
+            if len(data) < 12:
+                continue
+            qid = struct.unpack_from('!H', data)[0]
+            with self.lock:
+                waiter = self.waiters.get(qid)
+                # a clashing ID or a spoofed answer must not wake the waiter
+                if waiter is None or data[12:12 + len(waiter.question)] != waiter.question:
+                    continue
+                del self.waiters[qid]
+                self.received += 1
+            waiter.response = data
+            waiter.event.set()
+
+    def send(self, payload, event=None):
+        """
+        Sends payload under a free random ID without waiting. Returns (qid, waiter);
+        waiter.event is set once waiter.response holds the answer. Every send
+        must be paired with a finish().
+        """
+        waiter = _Waiter(question_section(payload), event)
+        with self.lock:
+            qid = random.getrandbits(16)
+            while qid in self.waiters:
+                qid = random.getrandbits(16)
+            self.waiters[qid] = waiter
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            self.sent += 1
+        try:
+            self.sock.send(struct.pack('!H', qid) + payload[2:])
+        except OSError:
+            self.finish(qid, waiter)
+            raise
+        return qid, waiter
+
+    def finish(self, qid, waiter, timed_out=False):
+        """Forgets a query sent with send(), answered or not."""
+        with self.lock:
+            if self.waiters.get(qid) is waiter:
+                del self.waiters[qid]
+            self.in_flight -= 1
+            if timed_out:
+                self.timeouts += 1
+
+    def query(self, payload, timeout):
+        """Sends payload under a free random ID, returns the answer or raises socket.timeout."""
+        qid, waiter = self.send(payload)
+        answered = False
+        try:
+            answered = waiter.event.wait(timeout)
+            if not answered:
+                raise socket.timeout("upstream query timed out")
+            return payload[:2] + waiter.response[2:]
+        finally:
+            self.finish(qid, waiter, timed_out=not answered)
+
+    def stats(self):
+        return {
+            'server': self.server,
+            'socket': self.index,
+            'source_port': self.source_port,
+            'in_flight': self.in_flight,
+            'peak_in_flight': self.peak_in_flight,
+            'sent': self.sent,
+            'received': self.received,
+            'timeouts': self.timeouts,
+        }
+
+    def close(self):
+        self.closed = True
+        # close() alone does not wake a thread blocked in recv() on Linux, shutdown() does
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        if self.thread is not threading.current_thread():
+            self.thread.join(1.0)
+        self.sock.close()
+
+
+class UpstreamSocketPool:
+    """Thread-safe pool, each query goes to the socket with the fewest queries in flight."""
+
+    def __init__(self, server, port=53, size=POOL_SIZE):
+        self.server = server
+        self.port = port
+        self.sockets = [PooledSocket(i, server, port) for i in range(size)]
+
+    def query(self, payload, timeout=2.0):
+        pooled = min(self.sockets, key=lambda s: s.in_flight)
+        return pooled.query(payload, timeout)
+
+    def send(self, payload, event=None):
+        """Non-blocking send, returns (pooled_socket, qid, waiter) for pooled_socket.finish()."""
+        pooled = min(self.sockets, key=lambda s: s.in_flight)
+        return (pooled,) + pooled.send(payload, event)
+
+    def stats(self):
+        return [s.stats() for s in self.sockets]
+
+    def close(self):
+        for s in self.sockets:
+            s.close()
+
+
+def format_pool_stats(stats):
+    """One line per socket, used by cr.py for its periodic pool report."""
+    return "\n".join(
+        f"[Pool] {s['server']} socket {s['socket']} port {s['source_port']}: in-flight {s['in_flight']} "
+        f"(peak {s['peak_in_flight']}), sent {s['sent']}, received {s['received']}, "
+        f"timeouts {s['timeouts']}"
+        for s in stats)
@@ -0,0 +1,358 @@
+#!/usr/bin/python3
+"""
+Upstream selection, retransmission and hedged forwarding for cr.py.
+
+Every upstream server keeps an RFC 6298 retransmission timer (SRTT/RTTVAR),
+a window of recent RTTs for its p95 and a failure score that decays over time.
+A query goes to the fastest healthy upstream. If that one has not answered
+after its own p95, the same query is sent once more to the runner-up; if it
+has not answered after its RTO, it is retransmitted to the same upstream with
+the timer doubled each time (at most MAX_RETRANSMITS times). The first answer
+to any of these copies is used. Every copy goes out under its own transaction
+ID, so an answer always tells which copy it belongs to and its RTT sample is
+unambiguous (no need for Karn's rule of dropping samples of retransmissions).
+"""
+import asyncio
+import socket
+import threading
+import time
+from collections import deque
+
+# RFC 6298: SRTT/RTTVAR gains, RTO = SRTT + max(G, K * RTTVAR)
+SRTT_ALPHA = 1 / 8
+RTTVAR_BETA = 1 / 4
+RTO_K = 4
+CLOCK_GRANULARITY_MS = 1.0
+# RFC 6298 asks for 1 s before the first sample; the floor is far below its
+# TCP value, DNS paths here are a few 5-10 ms hops
+INITIAL_RTO_MS = 1000.0
+MIN_RTO_MS = 20.0
+MAX_RTO_MS = 2000.0
+# retransmissions per query to the chosen upstream (the hedge is not counted)
+MAX_RETRANSMITS = 3
+# recent RTTs kept per upstream for the p95 and how often it is recomputed
+RTT_WINDOW = 200
+P95_REFRESH = 16
+# hedge delay bounds; below MIN_SAMPLES answers 2 x SRTT (or the default) is used
+MIN_HEDGE_DELAY_MS = 5.0
+DEFAULT_HEDGE_DELAY_MS = 100.0
+MIN_SAMPLES = 10
+# a failure adds 1 to the score, an answer halves it, and the score halves
+# every FAILURE_HALF_LIFE seconds; upstreams at or above the threshold are unhealthy
+FAILURE_HALF_LIFE = 30.0
+FAILURE_THRESHOLD = 2.0
+
+
+class RtoEstimator:
+    """RFC 6298 retransmission timer fed with RTT samples in milliseconds."""
+
+    def __init__(self):
+        self.srtt_ms = None
+        self.rttvar_ms = None
+
+    def sample(self, rtt_ms):
+        if self.srtt_ms is None:
+            self.srtt_ms = rtt_ms
+            self.rttvar_ms = rtt_ms / 2
+        else:
+            self.rttvar_ms += RTTVAR_BETA * (abs(self.srtt_ms - rtt_ms) - self.rttvar_ms)
+            self.srtt_ms += SRTT_ALPHA * (rtt_ms - self.srtt_ms)
+
+    def rto(self):
+        """Current timeout in seconds."""
+        if self.srtt_ms is None:
+            return INITIAL_RTO_MS / 1000
+        rto_ms = self.srtt_ms + max(CLOCK_GRANULARITY_MS, RTO_K * self.rttvar_ms)
+        return min(max(rto_ms, MIN_RTO_MS), MAX_RTO_MS) / 1000
+
+
+class Upstream:
+    """Latency and health bookkeeping of one upstream server."""
+
+    def __init__(self, server, clock=time.monotonic):
+        self.server = server
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.timer = RtoEstimator()
+        self.rtts = deque(maxlen=RTT_WINDOW)
+        self.p95_ms = None
+        self.new_samples = 0
+        self.failure = 0.0
+        self.failure_at = clock()
+        self.sent = 0
+        self.answered = 0
+        self.failures = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.retransmits = 0
+
+    @property
+    def srtt_ms(self):
+        return self.timer.srtt_ms
+
+    def rto(self):
+        with self.lock:
+            return self.timer.rto()
+
+    def _failure_now(self, now):
+        return self.failure * 0.5 ** ((now - self.failure_at) / FAILURE_HALF_LIFE)
+
+    def failure_score(self):
+        with self.lock:
+            return self._failure_now(self.clock())
+
+    def healthy(self):
+        return self.failure_score() < FAILURE_THRESHOLD
+
+    def rank(self):
+        """
+        Sort key: healthy first, then by smoothed RTT. Untried upstreams come
+        first, ones that were tried but never gave an RTT (failed sends) last.
+        """
+        srtt_ms = self.srtt_ms
+        if srtt_ms is None:
+            srtt_ms = float('inf') if self.failures else 0.0
+        return (not self.healthy(), srtt_ms)
+
+    def record_rtt(self, rtt_ms, lower_bound=False):
+        """
+        Adds an RTT sample without touching the health score. A lower bound
+        (the answer never arrived in time) only moves the SRTT, it would
+        otherwise inflate the p95 that the hedge delay is based on.
+        """
+        with self.lock:
+            if lower_bound:
+                # an upstream that never answered gets the bound as its first estimate
+                if self.timer.srtt_ms is None:
+                    self.timer.sample(rtt_ms)
+                elif rtt_ms > self.timer.srtt_ms:
+                    self.timer.srtt_ms += SRTT_ALPHA * (rtt_ms - self.timer.srtt_ms)
+                return
+            self.timer.sample(rtt_ms)
+            self.rtts.append(rtt_ms)
+            self.new_samples += 1
+            if self.p95_ms is None or self.new_samples >= P95_REFRESH:
+                ordered = sorted(self.rtts)
+                self.p95_ms = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+                self.new_samples = 0
+
+    def record_answer(self, rtt_ms):
+        self.record_rtt(rtt_ms)
+        with self.lock:
+            now = self.clock()
+            self.failure = self._failure_now(now) / 2
+            self.failure_at = now
+            self.answered += 1
+
+    def record_failure(self):
+        with self.lock:
+            now = self.clock()
+            self.failure = self._failure_now(now) + 1
+            self.failure_at = now
+            self.failures += 1
+
+    def hedge_delay(self):
+        """Seconds to wait for this upstream before hedging to the runner-up."""
+        with self.lock:
+            if len(self.rtts) >= MIN_SAMPLES:
+                delay = self.p95_ms
+            elif self.srtt_ms is not None:
+                delay = 2 * self.srtt_ms
+            else:
+                delay = DEFAULT_HEDGE_DELAY_MS
+        return max(delay, MIN_HEDGE_DELAY_MS) / 1000
+
+    def stats(self):
+        return {
+            'server': self.server,
+            'srtt_ms': self.srtt_ms,
+            'rto_ms': self.rto() * 1000,
+            'p95_ms': self.p95_ms,
+            'failure_score': self.failure_score(),
+            'sent': self.sent,
+            'answered': self.answered,
+            'failures': self.failures,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'retransmits': self.retransmits,
+        }
+
+
+class UpstreamSelector:
+
+    def __init__(self, servers, hedging=True):
+        self.upstreams = [Upstream(server) for server in servers]
+        self.hedging = hedging
+
+    def pick(self):
+        """Returns (primary, runner-up); the runner-up is None without hedging."""
+        ranked = sorted(self.upstreams, key=Upstream.rank)
+        runner_up = ranked[1] if self.hedging and len(ranked) > 1 else None
+        return ranked[0], runner_up
+
+    def stats(self):
+        return [u.stats() for u in self.upstreams]
+
+
+class _Schedule:
+    """When a forwarded query is retransmitted to its upstream and hedged to the runner-up."""
+
+    def __init__(self, primary, runner_up, start, timeout):
+        self.primary = primary
+        self.runner_up = runner_up
+        self.deadline = start + timeout
+        self.hedge_at = start + primary.hedge_delay() if runner_up is not None else None
+        self.rto = primary.rto()
+        self.retransmit_at = start + self.rto if MAX_RETRANSMITS else None
+        self.retransmits = 0
+
+    def next_wakeup(self):
+        return min(t for t in (self.hedge_at, self.retransmit_at, self.deadline) if t is not None)
+
+    def hedge_now(self, now):
+        """The primary failed outright, no point in waiting for the hedge delay."""
+        if self.hedge_at is not None:
+            self.hedge_at = now
+
+    def exhausted(self):
+        """No hedge or retransmission left to send, only the deadline."""
+        return self.hedge_at is None and self.retransmit_at is None
+
+    def due(self, now):
+        """Upstreams to send another copy to at time 'now'."""
+        targets = []
+        if self.hedge_at is not None and now >= self.hedge_at:
+            self.hedge_at = None
+            self.runner_up.hedges += 1
+            targets.append(self.runner_up)
+        if self.retransmit_at is not None and now >= self.retransmit_at:
+            self.retransmits += 1
+            self.primary.retransmits += 1
+            targets.append(self.primary)
+            # exponential backoff for this query (RFC 6298 5.5)
+            self.rto = min(self.rto * 2, MAX_RTO_MS / 1000)
+            self.retransmit_at = now + self.rto if self.retransmits < MAX_RETRANSMITS else None
+        return targets
+
+
+def _settle(primary, sends, winner, now):
+    """
+    Books the outcome of a forwarded query. 'sends' lists (upstream, sent_at, ...)
+    for every copy that went out, in send order; 'winner' is the index of the
+    answered copy.
+    """
+    if winner is None:
+        for upstream in {send[0] for send in sends}:
+            upstream.record_failure()
+        return
+    upstream, sent_at = sends[winner][:2]
+    upstream.record_answer((now - sent_at) * 1000)
+    if upstream is not primary:
+        upstream.hedge_wins += 1
+        primary_sent = next((send[1] for send in sends if send[0] is primary), None)
+        if primary_sent is not None:
+            # the primary was beaten: it took at least this long, which keeps its
+            # SRTT from staying optimistic while its answers keep losing the race
+            primary.record_rtt((now - primary_sent) * 1000, lower_bound=True)
+
+
+def hedged_query(selector, pools, payload, timeout):
+    """
+    Threaded engines: forwards payload over pools[server] (UpstreamSocketPool).
+    Returns (response with the client's ID, server that answered) or raises
+    socket.timeout. A copy that cannot be sent counts as a failure of its
+    upstream; if it was the primary, the runner-up is asked right away.
+    """
+    primary, runner_up = selector.pick()
+    answered = threading.Event()
+    schedule = _Schedule(primary, runner_up, time.perf_counter(), timeout)
+    sends = []
+
+    def send(upstream):
+        sent_at = time.perf_counter()
+        upstream.sent += 1
+        try:
+            sends.append((upstream, sent_at, pools[upstream.server].send(payload, answered)))
+        except OSError:
+            # like an answer that never comes, except that we know it at once
+            upstream.record_failure()
+            if upstream is primary:
+                schedule.hedge_now(time.perf_counter())
+
+    try:
+        send(primary)
+        while not answered.wait(max(schedule.next_wakeup() - time.perf_counter(), 0)):
+            now = time.perf_counter()
+            if now >= schedule.deadline:
+                break
+            for upstream in schedule.due(now):
+                send(upstream)
+            # every send failed and nothing is left to try: no answer can come
+            if not sends and schedule.exhausted():
+                break
+        now = time.perf_counter()
+        winner = next((i for i, send_ in enumerate(sends) if send_[2][2].response is not None), None)
+        _settle(primary, sends, winner, now)
+        if winner is None:
+            raise socket.timeout("upstream query timed out")
+        return payload[:2] + sends[winner][2][2].response[2:], sends[winner][0].server
+    finally:
+        for _, _, (pooled, qid, waiter) in sends:
+            pooled.finish(qid, waiter, timed_out=not answered.is_set())
+
+
+async def hedged_query_async(selector, pools, payload, timeout):
+    """
+    Async engine: same as hedged_query over async_engine.UpstreamPool objects.
+    Raises asyncio.TimeoutError when no copy is answered in time.
+    """
+    primary, runner_up = selector.pick()
+    schedule = _Schedule(primary, runner_up, time.perf_counter(), timeout)
+    sends = []
+    pending = set()
+
+    def send(upstream):
+        remaining = schedule.deadline - time.perf_counter()
+        task = asyncio.ensure_future(pools[upstream.server].query(payload, remaining))
+        sends.append((upstream, time.perf_counter(), task))
+        pending.add(task)
+        upstream.sent += 1
+
+    try:
+        send(primary)
+        while True:
+            wait = max(schedule.next_wakeup() - time.perf_counter(), 0)
+            if pending:
+                done, _ = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                done = set()
+                await asyncio.sleep(wait)
+            for index, (upstream, _, task) in enumerate(sends):
+                if task not in done:
+                    continue
+                pending.discard(task)
+                if task.exception() is None:
+                    _settle(primary, sends, index, time.perf_counter())
+                    return task.result(), upstream.server
+                if upstream is primary:
+                    schedule.hedge_now(time.perf_counter())
+            now = time.perf_counter()
+            if now >= schedule.deadline:
+                _settle(primary, sends, None, now)
+                raise asyncio.TimeoutError()
+            for upstream in schedule.due(now):
+                send(upstream)
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def format_upstream_stats(stats):
+    """One line per upstream, printed next to the pool report."""
+    def ms(value):
+        return "-" if value is None else f"{value:.2f} ms"
+    return "\n".join(
+        f"[Upstream] {s['server']}: srtt {ms(s['srtt_ms'])}, rto {ms(s['rto_ms'])}, p95 {ms(s['p95_ms'])}, "
+        f"failure score {s['failure_score']:.2f}, sent {s['sent']}, answered {s['answered']}, "
+        f"retransmits {s['retransmits']}, failures {s['failures']}, hedges {s['hedges']} (won {s['hedge_wins']})"
+        for s in stats)
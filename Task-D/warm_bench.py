@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+"""
+Cold vs warm start of cr.py.
+
+  cold - the resolver starts with an empty cache and the domain list is resolved once
+  warm - the resolver is restarted with the cache snapshot the cold run left
+         behind (--cache-file) and the same list is resolved again
+
+With --preload the warm snapshot is built from another list or pcap instead,
+e.g. names seen on one host preloaded for the queries of another.
+"""
+import csv
+import glob
+import os
+import sys
+from preload import preload, read_names
+from scale_bench import measure, read_domains, start_resolver, stop_resolver, upstream_args
+
+
+def remove_snapshot(path):
+    for snapshot in [path] + glob.glob(f"{glob.escape(path)}.w*"):
+        if os.path.exists(snapshot):
+            os.remove(snapshot)
+
+
+def run_scenario(name, domains, resolver_args, listen_ip, port, concurrency):
+    resolver = start_resolver(*resolver_args)
+    if resolver is None:
+        return None
+    try:
+        stats = measure(domains, listen_ip, port, concurrency, len(domains))
+    finally:
+        stop_resolver(resolver)
+    stats['scenario'] = name
+    print(f"    {name}: {stats['answered_qps']:.0f} answered queries/sec, p50 {stats['p50_ms']:.3f} ms, "
+          f"p99 {stats['p99_ms']:.3f} ms, {stats['timeouts']} timeouts")
+    return stats
+
+
+def run_start_bench(domains, snapshot, engine, listen_ip, port, concurrency, preload_names=None, extra_args=()):
+    resolver_args = ["--engine", engine, "--listen", listen_ip, "--port", str(port), "--cache-file", snapshot,
+                     *extra_args]
+    remove_snapshot(snapshot)
+    results = []
+    cold = run_scenario("cold", domains, resolver_args, listen_ip, port, concurrency)
+    if cold is None:
+        return results
+    results.append(cold)
+    if preload_names:
+        remove_snapshot(snapshot)
+        resolver = start_resolver(*resolver_args)
+        if resolver is None:
+            return results
+        try:
+            preload(preload_names, listen_ip, port)
+        finally:
+            stop_resolver(resolver)
+    warm = run_scenario("warm", domains, resolver_args, listen_ip, port, concurrency)
+    if warm is not None:
+        results.append(warm)
+    return results
+
+
+def print_table(results):
+    print("\n--- Cold vs Warm Start ---")
+    print(f"{'scenario':>10}{'answered qps':>14}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'timeouts':>10}")
+    for r in results:
+        print(f"{r['scenario']:>10}{r['answered_qps']:>14.0f}{r['p50_ms']:>10.3f}{r['p90_ms']:>10.3f}"
+              f"{r['p99_ms']:>10.3f}{r['timeouts']:>10}")
+
+
+def write_results(results, path):
+    with open(path, 'w', newline='') as out:
+        w = csv.writer(out)
+        w.writerow(['scenario', 'answered_qps', 'p50_ms', 'p90_ms', 'p99_ms', 'timeouts'])
+        for r in results:
+            w.writerow([r['scenario'], f"{r['answered_qps']:.1f}", f"{r['p50_ms']:.3f}", f"{r['p90_ms']:.3f}",
+                        f"{r['p99_ms']:.3f}", r['timeouts']])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1].startswith('--'):
+        print(f"Usage: python3 {sys.argv[0]} <domain_file.txt> [--engine async] [--listen 127.0.0.1] [--port 5353] "
+              "[--concurrency 16] [--snapshot /tmp/cr-cache.snap] [--preload domains.txt|capture.pcap] "
+              "[--out start.csv] [--upstreams 127.0.0.1 --upstream-port 5300]")
+        sys.exit(1)
+    engine = "async"
+    listen_ip = "127.0.0.1"
+    port = 5353
+    concurrency = 16
+    snapshot_path = "/tmp/cr-cache.snap"
+    preload_path = None
+    out_path = None
+    if '--engine' in sys.argv:
+        engine = sys.argv[sys.argv.index('--engine') + 1]
+    if '--listen' in sys.argv:
+        listen_ip = sys.argv[sys.argv.index('--listen') + 1]
+    if '--port' in sys.argv:
+        port = int(sys.argv[sys.argv.index('--port') + 1])
+    if '--concurrency' in sys.argv:
+        concurrency = int(sys.argv[sys.argv.index('--concurrency') + 1])
+    if '--snapshot' in sys.argv:
+        snapshot_path = sys.argv[sys.argv.index('--snapshot') + 1]
+    if '--preload' in sys.argv:
+        preload_path = sys.argv[sys.argv.index('--preload') + 1]
+    if '--out' in sys.argv:
+        out_path = sys.argv[sys.argv.index('--out') + 1]
+
+    domain_list = read_domains(sys.argv[1])
+    if not domain_list:
+        print("[Warning] The list of domains to test is empty. Aborting benchmark.")
+        sys.exit(1)
+    preload_list = read_names(preload_path) if preload_path else None
+    scenarios = run_start_bench(domain_list, snapshot_path, engine, listen_ip, port, concurrency, preload_list,
+                                upstream_args(sys.argv))
+    print_table(scenarios)
+    if out_path:
+        write_results(scenarios, out_path)
+        print(f"--> Results saved to '{out_path}'")
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+"""
+micro-benchmark of the dnswire parser against the original slice/find based
+extract_domain_name from cr.py. Reports ns per call for a few packet shapes.
+"""
+import sys
+import timeit
+import dnswire
+
+
+def legacy_extract_domain_name(packet):
+    """the original parser from cr.py, kept here as the baseline"""
+    try:
+        question = packet[12:]
+        qname_termination = question.find(b'\x00')
+        raw_qname = question[:qname_termination]
+        domain_parts = []
+        idx = 0
+        while idx < len(raw_qname):
+            seg_len = raw_qname[idx]
+            idx += 1
+            domain_parts.append(raw_qname[idx: idx + seg_len].decode('utf-8'))
+            idx += seg_len
+        return ".".join(domain_parts)
+    except Exception:
+        return None
+
+
+def sample_packets():
+    """a short name, a long name and a full answer with compressed names"""
+    short = dnswire.build_query(0x1234, 'ntp.ubuntu.com')
+    long_name = dnswire.build_query(0x1234, 'a.very.long.sub.domain.name.for.parsing.example.co.uk')
+    answer = bytearray(dnswire.build_query(0x1234, 'www.example.com'))
+    answer[2:4] = dnswire.U16.pack(0x8180)
+    answer[6:8] = dnswire.U16.pack(4)
+    for i in range(4):
+        # name is a pointer back to the question (offset 12)
+        answer += b'\xc0\x0c' + dnswire.RR_FIXED.pack(dnswire.TYPE_A, dnswire.CLASS_IN, 300, 4) + bytes([10, 0, 0, i])
+    return [('short query', short), ('long query', long_name), ('4-record answer', bytes(answer))]
+
+
+def time_ns(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e9
+
+
+def run_benchmark(number):
+    print(f"--> {number} calls per measurement, best of 5\n")
+    print(f"{'packet':<18}{'legacy qname':>14}{'dnswire qname':>15}{'parse question':>16}{'scan ttls':>11}{'patch id+ttl':>14}")
+    for label, packet in sample_packets():
+        offsets, ttls, _ = dnswire.scan_ttls(packet)
+        buf = bytearray(packet)
+
+        def patch():
+            dnswire.patch_id(buf, 0x4321)
+            dnswire.patch_ttls(buf, offsets, ttls, 7)
+
+        legacy = time_ns(lambda: legacy_extract_domain_name(packet), number)
+        qname = time_ns(lambda: dnswire.qname_from_query(packet), number)
+        question = time_ns(lambda: dnswire.parse_question(packet), number)
+        scan = time_ns(lambda: dnswire.scan_ttls(packet), number)
+        patched = time_ns(patch, number)
+        print(f"{label:<18}{legacy:>11.0f} ns{qname:>12.0f} ns{question:>13.0f} ns{scan:>8.0f} ns{patched:>11.0f} ns")
+
+
+if __name__ == "__main__":
+    calls = 100000
+    if '--number' in sys.argv:
+        calls = int(sys.argv[sys.argv.index('--number') + 1])
+    run_benchmark(calls)